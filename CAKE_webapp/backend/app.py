@@ -1,16 +1,23 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
 import json
 import os
-import pickle
+import sys
+import atexit
 from datetime import datetime
 from openai import OpenAI
 import threading
-from sentence_transformers import SentenceTransformer
-import faiss
-import numpy as np
 from json import JSONDecodeError
 
+# The knowledge store is shared with the CAKE pipelines in the repository root
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+from pipelines.Knowledge_Extraction_Pipeline.knowledge_index import KnowledgeIndex, RETRIEVAL_HOPS
+from pipelines.Knowledge_Extraction_Pipeline.session_store import SessionStore, DEFAULT_SESSION
+from pipelines.Knowledge_Extraction_Pipeline.answer_cache import AnswerCache
+from pipelines.instrumentation import profiler
+from pipelines.manifest import text_hash
+from knowledge_worker import KnowledgeWorker, valid_triplets
+
 app = Flask(__name__)
 CORS(app)
 
@@ -19,21 +26,30 @@ class Chatbot:
                 messages_file='messages.json', 
                 knowledge_file='./public/data/user_knowledge.json', 
                 faiss_index_file='faiss_index.pkl',
-                model_name='all-MiniLM-L6-v2'):
+                model_name='all-MiniLM-L6-v2',
+                journal_file='user_knowledge.jsonl',
+                answer_cache_file='answer_cache.jsonl'):
         self.messages_file = messages_file
         self.knowledge_file = knowledge_file
         self.faiss_index_file = faiss_index_file
         
         self.client = OpenAI(api_key="") # Add your OpenAI API key here
 
-        self.model = SentenceTransformer(model_name)
-        self.index = None
-        self.knowledge_data = []
         self.initialize_files()
-        self.load_faiss_index()
+        # One append per message, the recent turns of every session are kept in memory
+        self.sessions = SessionStore(os.path.splitext(messages_file)[0] + ".jsonl", messages_file)
+        # The journal stays out of public/, only the JSON snapshot is served to the frontend. The index is shared
+        # with the other worker processes of the server (gunicorn -w N): every write saves a new snapshot of it,
+        # the other workers open that one on their next search.
+        self.knowledge_index = KnowledgeIndex(knowledge_file, faiss_index_file, model_name, journal_file, shared=True)
+        self.store = self.knowledge_index.store
+        # After a crash the journal has the triplets the index is missing
+        self.knowledge_index.sync()
+        # Users ask the same questions, those are answered from the cache until the knowledge changes
+        self.answer_cache = AnswerCache(answer_cache_file)
 
     def initialize_files(self):
-        for file in [self.messages_file, self.knowledge_file]:
+        for file in [self.knowledge_file]:
             if not os.path.exists(file):
                 with open(file, 'w') as f:
                     json.dump([], f)
@@ -82,64 +98,47 @@ class Chatbot:
             print(f"Error extracting knowledge: {e}")
             return []
 
-    def save_message(self, role, content):
-        messages = self.load_json_data(self.messages_file)
-        message = {"role": role, "content": content, "timestamp": datetime.utcnow().isoformat()}
-        messages.append(message)
-        self.save_json_data(self.messages_file, messages)
+    def save_message(self, role, content, session_id=DEFAULT_SESSION):
+        return self.sessions.append(session_id, role, content)
+
+    def recent_messages(self, session_id=DEFAULT_SESSION, n=3):
+        # Only role and content go to the chat completion
+        return [{"role": m["role"], "content": m["content"]} for m in self.sessions.recent(session_id, n)]
 
     def save_knowledge(self, triplets):
         if not triplets:
             return
-        knowledge = self.load_json_data(self.knowledge_file)
-        existing_set = {(t['subject'], t['predicate'], t['object']) for t in knowledge}
-        new_triplets = []
         for triplet in triplets:
             triplet['timestamp'] = datetime.utcnow().isoformat()
-            key = (triplet['subject'], triplet['predicate'], triplet['object'])
-            if key not in existing_set:
-                knowledge.append(triplet)
-                new_triplets.append(triplet)
-                existing_set.add(key)
-        self.save_json_data(self.knowledge_file, knowledge)
-        if new_triplets:
-            self.update_faiss_index(new_triplets)
-
-    def update_faiss_index(self, triplets):
-        texts = [f"{t['subject']} {t['predicate']} {t['object']}" for t in triplets]
-        embeddings = self.model.encode(texts)
-        if self.index is None:
-            self.index = faiss.IndexFlatL2(embeddings.shape[1])
-        self.index.add(np.array(embeddings, dtype=np.float32))
-        self.knowledge_data.extend(triplets)
-        self.save_faiss_index()
-
-    def save_faiss_index(self):
-        with open(self.faiss_index_file, 'wb') as f:
-            pickle.dump((self.index, self.knowledge_data), f)
-
-    def load_faiss_index(self):
-        if os.path.exists(self.faiss_index_file):
-            with open(self.faiss_index_file, 'rb') as f:
-                self.index, self.knowledge_data = pickle.load(f)
-        else:
-            self.index = None
-            self.knowledge_data = []
+        self.knowledge_index.add(triplets)
+        # Appended to the journal right away, the snapshot for the frontend a moment later
+        self.knowledge_index.commit()
+        self.store.export_later()
 
-    def search_knowledge(self, query, top_k=5):
-        if self.index is None or len(self.knowledge_data) == 0:
-            return []
-        query_embedding = self.model.encode([query])
-        distances, indices = self.index.search(np.array(query_embedding, dtype=np.float32), top_k)
-        results = []
-        for idx in indices[0]:
-            if idx == -1:
-                continue
-            results.append(self.knowledge_data[idx])
-        return results
+    def flush(self):
+        self.knowledge_index.flush()
 
-    def generate_response(self, conversation_history, user_message):
-        knowledge_matches = self.search_knowledge(user_message, top_k=5)
+    def search_knowledge(self, query, top_k=5, hops=RETRIEVAL_HOPS, query_embedding=None):
+        return self.knowledge_index.search(query, top_k, hops, query_embedding=query_embedding)
+
+    def cached_answer(self, conversation_history, user_message):
+        # The earlier turns are part of the prompt, an answer is only reused after the same turns ("and how long does
+        # that take?" means something else in every conversation). A first question is shared by all sessions.
+        earlier = conversation_history
+        if earlier and earlier[-1] == {"role": "user", "content": user_message}:
+            earlier = earlier[:-1]
+        version = f"{self.knowledge_index.version}/{text_hash(json.dumps(earlier, ensure_ascii=False))}"
+        answer = self.answer_cache.get_exact(user_message, version)
+        if answer is not None:
+            return None, version, answer
+        # The encoder only runs when the entity index does not fill the search, the embedding is None otherwise
+        embedding = None
+        if self.knowledge_index.needs_embedding(user_message):
+            embedding = self.knowledge_index.encode_query(user_message)
+        return embedding, version, self.answer_cache.get(embedding, version)
+
+    def build_messages(self, conversation_history, user_message, query_embedding=None):
+        knowledge_matches = self.search_knowledge(user_message, top_k=5, query_embedding=query_embedding)
         print(knowledge_matches)
         current_time = datetime.utcnow().isoformat()
         system_message = f"Current date and time: {current_time}\n"
@@ -152,46 +151,160 @@ class Chatbot:
 
         enriched_history = [{"role": "system", "content": f"You are a helpful assistant; {system_message}"}] + conversation_history
         enriched_history.append({"role": "user", "content": user_message})
+        return enriched_history
 
+    def generate_response(self, conversation_history, user_message):
+        embedding, version, answer = self.cached_answer(conversation_history, user_message)
+        if answer is not None:
+            return answer
         try:
             response = self.client.chat.completions.create(
                 model="gpt-4o-mini",
-                messages=enriched_history,
+                messages=self.build_messages(conversation_history, user_message, embedding),
                 #temperature=0.7,
             )
-            return response.choices[0].message.content
+            answer = response.choices[0].message.content
+            self.answer_cache.put(embedding, version, answer, user_message)
+            return answer
         except Exception as e:
             print(f"Error generating response: {e}")
             return "I apologize, but I'm having trouble generating a response right now."
 
+    def stream_response(self, conversation_history, user_message, stats):
+        # The text of the answer piece by piece, the time to the first piece and between pieces go into stats
+        embedding, version, answer = self.cached_answer(conversation_history, user_message)
+        stats["cached"] = answer is not None
+        if answer is not None:
+            return profiler.token_stream("webapp_chat", iter([answer]), stats)
+
+        def pieces():
+            try:
+                chunks = self.client.chat.completions.create(
+                    model="gpt-4o-mini",
+                    messages=self.build_messages(conversation_history, user_message, embedding),
+                    stream=True,
+                )
+                answer = []
+                for chunk in chunks:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        answer.append(chunk.choices[0].delta.content)
+                        yield chunk.choices[0].delta.content
+                # Only a complete answer goes into the cache
+                self.answer_cache.put(embedding, version, "".join(answer), user_message)
+            except Exception as e:
+                print(f"Error generating response: {e}")
+                yield "I apologize, but I'm having trouble generating a response right now."
+        return profiler.token_stream("webapp_chat", pieces(), stats)
+
 chatbot = Chatbot()
+# The knowledge of a message is extracted in the background, the answer does not wait for it
+knowledge_worker = KnowledgeWorker(chatbot, jobs_dir='knowledge_jobs')
+# atexit runs the last registered first: the queued messages are done before the flush
+atexit.register(chatbot.flush)
+atexit.register(knowledge_worker.stop)
+
+def queue_extraction(user_message, session_id):
+    job_id = knowledge_worker.submit(user_message, session_id)
+    if job_id is None:
+        print("Knowledge extraction queue is full, skipping this message")
+    return job_id
 
 @app.route('/api/chat', methods=['POST'])
 def chat():
     try:
         data = request.json
         user_message = data.get('message')
+        session_id = str(data.get('session_id') or DEFAULT_SESSION)
         
         if not user_message:
             return jsonify({"error": "No message provided"}), 400
 
-        chatbot.save_message(role='user', content=user_message)
-        conversation = chatbot.load_json_data(chatbot.messages_file)[-3:]
+        chatbot.save_message(role='user', content=user_message, session_id=session_id)
+        conversation = chatbot.recent_messages(session_id)
         assistant_response = chatbot.generate_response(conversation, user_message)
-        chatbot.save_message(role='assistant', content=assistant_response)
-        
-        user_knowledge_response = chatbot.extract_valuable_knowledge(user_message)
-        
-        if user_knowledge_response:
-            chatbot.save_knowledge(user_knowledge_response)
+        chatbot.save_message(role='assistant', content=assistant_response, session_id=session_id)
+
+        # The extracted knowledge follows on /api/knowledge/<knowledge_job>, null when the queue was full
+        job_id = queue_extraction(user_message, session_id)
 
         return jsonify({
             "response": assistant_response,
-            "extracted_knowledge": user_knowledge_response
+            "session_id": session_id,
+            "knowledge_job": job_id,
         })
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+def sse(data, event=None):
+    return (f"event: {event}\n" if event else "") + f"data: {json.dumps(data)}\n\n"
+
+@app.route('/api/chat/stream', methods=['GET', 'POST'])
+def chat_stream():
+    # Server-Sent Events: a "data" event per piece of the answer, then a "done" event with the whole answer and the
+    # latencies, and a "knowledge" event once the knowledge of the message is extracted. GET (for EventSource) takes
+    # message and session_id as query parameters.
+    data = request.json if request.method == 'POST' else request.args
+    user_message = data.get('message')
+    session_id = str(data.get('session_id') or DEFAULT_SESSION)
+    if not user_message:
+        return jsonify({"error": "No message provided"}), 400
+
+    def events():
+        chatbot.save_message(role='user', content=user_message, session_id=session_id)
+        conversation = chatbot.recent_messages(session_id)
+        stats = {}
+        pieces = []
+        for piece in chatbot.stream_response(conversation, user_message, stats):
+            pieces.append(piece)
+            yield sse({"token": piece})
+        assistant_response = "".join(pieces)
+        chatbot.save_message(role='assistant', content=assistant_response, session_id=session_id)
+        print(f"Streamed {stats.get('tokens')} pieces, first after {stats.get('ttft_seconds')}s, "
+              f"{stats.get('inter_token_ms_mean')} ms between pieces")
+
+        job_id = queue_extraction(user_message, session_id)
+        yield sse({"response": assistant_response, "session_id": session_id, "knowledge_job": job_id,
+                   "latency": stats}, event="done")
+        if job_id:
+            yield sse(knowledge_worker.wait(job_id), event="knowledge")
+
+    return Response(stream_with_context(events()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.route('/api/knowledge/<job_id>', methods=['GET'])
+def knowledge_job(job_id):
+    # status is queued, running, done (knowledge holds the extracted triplets) or failed
+    job = knowledge_worker.status(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown knowledge job"}), 404
+    return jsonify(job)
+
+@app.route('/api/knowledge', methods=['POST'])
+def add_knowledge():
+    # Triplets saved as they are, without the extraction (also the writes of the load test)
+    data = request.json or {}
+    try:
+        triplets = valid_triplets(data.get('knowledge'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    chatbot.save_knowledge(triplets)
+    return jsonify({"saved": len(triplets)})
+
+@app.route('/api/knowledge/search', methods=['GET'])
+def knowledge_search():
+    # The triplets retrieved for a question, without asking the language model (also used by the load test)
+    query = request.args.get('query')
+    if not query:
+        return jsonify({"error": "No query provided"}), 400
+    top_k = request.args.get('top_k', 5, type=int)
+    hops = request.args.get('hops', RETRIEVAL_HOPS, type=int)
+    return jsonify({"results": chatbot.search_knowledge(query, top_k, hops)})
+
+@app.route('/api/knowledge/queue', methods=['GET'])
+def knowledge_queue():
+    return jsonify({"pending": knowledge_worker.pending()})
+
 if __name__ == "__main__":
-    app.run()
+    # One process, a thread per request. For more, run it with gunicorn, see the README.
+    app.run(threaded=True)
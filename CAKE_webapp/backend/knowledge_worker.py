@@ -0,0 +1,179 @@
+"""
+Antonio van Dijck
+studentnumber: 12717673
+Email: antonio.van.dijck@student.uva.nl
+
+The background worker of the webapp that extracts knowledge from the chat messages. /api/chat answers as soon as the
+answer is ready and only queues the message here. The worker takes the queued messages in batches, extracts the
+knowledge of every message and saves the knowledge of the whole batch at once (one journal append, one snapshot).
+The queue is bounded: when the worker falls behind, new messages are turned away instead of piling up, and the
+caller can tell the client. The result of every job can be looked up by its id for a while afterwards. With a jobs
+directory the state of every job is also written there, so any worker process of the server can answer for it.
+"""
+
+import os
+import json
+import time
+import uuid
+import queue
+import threading
+from collections import OrderedDict
+from pipelines.manifest import atomic_write_json
+
+QUEUE_SIZE = 100        # messages waiting for extraction before new ones are turned away
+BATCH_SIZE = 8
+BATCH_WAIT = 0.5        # seconds to wait for more messages to fill a batch
+KEEP_RESULTS = 1000
+RESULT_TTL = 3600       # seconds a job file is kept in the jobs directory
+TRIPLET_FIELDS = ("subject", "predicate", "object")
+
+def valid_triplets(knowledge):
+    # The triplets of an extraction that can be saved, the language model does not always stick to the schema
+    if not isinstance(knowledge, list):
+        raise ValueError(f"Expected a list of triplets, got {type(knowledge).__name__}")
+    return [triplet for triplet in knowledge if isinstance(triplet, dict) and
+            all(isinstance(triplet.get(field), str) and triplet[field].strip() for field in TRIPLET_FIELDS)]
+
+class KnowledgeWorker:
+    def __init__(self, chatbot, queue_size=QUEUE_SIZE, batch_size=BATCH_SIZE, batch_wait=BATCH_WAIT, jobs_dir=None):
+        self.chatbot = chatbot
+        self.jobs_dir = jobs_dir
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.jobs = OrderedDict()       # job id -> {"status", "knowledge", ...}, oldest first
+        self.lock = threading.Lock()
+        self.done = threading.Condition(self.lock)
+        self.stopping = False
+        self.thread = threading.Thread(target=self._run, name="knowledge-worker", daemon=True)
+        self.thread.start()
+
+    def submit(self, message, session_id):
+        # Returns the job id, or None when the queue is full
+        job_id = uuid.uuid4().hex
+        job = {"status": "queued", "session_id": session_id, "knowledge": None, "queued_at": time.time()}
+        with self.lock:
+            if self.stopping:
+                return None
+            self.jobs[job_id] = job
+            while len(self.jobs) > KEEP_RESULTS:
+                self.jobs.popitem(last=False)
+        self._write(job_id, dict(job))
+        try:
+            self.queue.put_nowait((job_id, message))
+        except queue.Full:
+            with self.lock:
+                self.jobs.pop(job_id, None)
+            if self.jobs_dir:
+                os.remove(os.path.join(self.jobs_dir, f"{job_id}.json"))
+            return None
+        return job_id
+
+    def status(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job:
+                return dict(job, job_id=job_id)
+        # A job of another worker process
+        if self.jobs_dir and job_id.isalnum():
+            try:
+                with open(os.path.join(self.jobs_dir, f"{job_id}.json"), 'r', encoding='utf-8') as f:
+                    return dict(json.load(f), job_id=job_id)
+            except (OSError, json.JSONDecodeError):
+                pass
+        return None
+
+    def wait(self, job_id, timeout=30.0):
+        # The job once it is done or failed, or as it is when the timeout passes
+        deadline = time.time() + timeout
+        with self.lock:
+            while job_id in self.jobs and self.jobs[job_id]["status"] in ("queued", "running"):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.done.wait(remaining)
+        return self.status(job_id)
+
+    def pending(self):
+        return self.queue.qsize()
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.time() + self.batch_wait
+        while len(batch) < self.batch_size and batch[-1] is not None:
+            try:
+                batch.append(self.queue.get(timeout=max(0.0, deadline - time.time())))
+            except queue.Empty:
+                break
+        return batch
+
+    def _set(self, job_id, **fields):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            job = dict(job, **fields) if job else None
+        if job:
+            # On disk before anyone here sees it, the client may ask another worker process next
+            self._write(job_id, job)
+        with self.lock:
+            if job_id in self.jobs:
+                self.jobs[job_id].update(fields)
+            self.done.notify_all()
+
+    def _write(self, job_id, job):
+        if self.jobs_dir:
+            os.makedirs(self.jobs_dir, exist_ok=True)
+            atomic_write_json(os.path.join(self.jobs_dir, f"{job_id}.json"), job)
+
+    def _prune(self):
+        if not self.jobs_dir or not os.path.isdir(self.jobs_dir):
+            return
+        cutoff = time.time() - RESULT_TTL
+        for entry in os.scandir(self.jobs_dir):
+            try:
+                if entry.name.endswith(".json") and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except OSError:
+                pass    # removed by another worker process
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            jobs = [job for job in batch if job is not None]
+            if jobs:
+                self._process(jobs)
+            if len(jobs) < len(batch):
+                return      # stop() was called and everything before it is done
+
+    def _process(self, jobs):
+        knowledge = []
+        results = {}
+        for job_id, message in jobs:
+            self._set(job_id, status="running")
+            try:
+                # Checked per job, a malformed answer for one message does not fail the whole batch
+                extracted = self.chatbot.extract_valuable_knowledge(message)
+                results[job_id] = valid_triplets(extracted)
+                if len(results[job_id]) < len(extracted):
+                    print(f"Dropped {len(extracted) - len(results[job_id])} malformed triplets")
+                knowledge.extend(results[job_id])
+            except Exception as e:
+                print(f"Error extracting knowledge: {e}")
+                self._set(job_id, status="failed", error=str(e))
+        try:
+            # The knowledge of the whole batch is saved together
+            self.chatbot.save_knowledge(knowledge)
+        except Exception as e:
+            print(f"Error saving knowledge: {e}")
+            for job_id in results:
+                self._set(job_id, status="failed", error=str(e))
+            return
+        for job_id, triplets in results.items():
+            self._set(job_id, status="done", knowledge=triplets, done_at=time.time())
+        self._prune()
+
+    def stop(self, timeout=60.0):
+        # Finish the queued messages, then stop, for a clean shutdown
+        with self.lock:
+            self.stopping = True
+        self.queue.put(None)
+        self.thread.join(timeout)
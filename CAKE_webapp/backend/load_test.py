@@ -0,0 +1,134 @@
+"""
+Antonio van Dijck
+studentnumber: 12717673
+Email: antonio.van.dijck@student.uva.nl
+
+Load test of the webapp backend. A number of client threads send knowledge searches (GET /api/knowledge/search, no
+OpenAI calls) as fast as the server answers them, and the throughput and latency are printed. With -write_fraction
+that part of the requests saves a new triplet instead (POST /api/knowledge), a mixed read/write load. With -workers
+the backend is started with gunicorn once for every number of worker processes, all of them sharing one
+memory-mapped index. The speedup column is the throughput relative to the first number of workers, it only grows
+when the machine has a core to spare for every extra worker. Run it from CAKE_webapp:
+
+    python backend/load_test.py -workers 1 2 4 8
+    python backend/load_test.py -workers 1 2 4 8 -write_fraction 0.1
+    python backend/load_test.py -url http://127.0.0.1:5000     # a server that is already running
+"""
+
+import time
+import json
+import uuid
+import argparse
+import subprocess
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+QUERIES = ["What does the charcoal canister do?", "How do you replace the fuel filter?",
+           "Which tools are needed for the brakes?", "What is the torque of the wheel nuts?",
+           "Why does the engine overheat?", "How often should the oil be changed?",
+           "What causes a check engine light?", "Where is the cabin air filter?"]
+
+def fetch(url, data=None):
+    started = time.perf_counter()
+    request = url
+    if data is not None:
+        request = urllib.request.Request(url, json.dumps(data).encode("utf-8"), {"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=60) as response:
+        response.read()
+    return time.perf_counter() - started
+
+def _percentiles(latencies):
+    if not latencies:
+        return None, None
+    return float(np.percentile(latencies, 50)), float(np.percentile(latencies, 99))
+
+def run_load(base_url, requests=2000, concurrency=32, queries=QUERIES, top_k=5, write_fraction=0.0):
+    # Every 1 / write_fraction-th request is a write, spread evenly over the run
+    every = round(1 / write_fraction) if write_fraction else 0
+    calls = []
+    for i in range(requests):
+        if every and i % every == every - 1:
+            triplet = {"subject": f"load test {uuid.uuid4().hex[:8]}", "predicate": "is part of",
+                       "object": queries[i % len(queries)].rstrip("?")}
+            calls.append(("write", f"{base_url}/api/knowledge", {"knowledge": [triplet]}))
+        else:
+            query = urllib.parse.urlencode({"query": queries[i % len(queries)], "top_k": top_k})
+            calls.append(("read", f"{base_url}/api/knowledge/search?{query}", None))
+    latencies = {"read": [], "write": []}
+    errors = 0
+
+    def worker(call):
+        kind, url, data = call
+        try:
+            return kind, fetch(url, data)
+        except Exception:
+            return kind, None
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        for kind, latency in pool.map(worker, calls):
+            if latency is None:
+                errors += 1
+            else:
+                latencies[kind].append(latency * 1000)
+    seconds = time.perf_counter() - started
+    done = len(latencies["read"]) + len(latencies["write"])
+    p50, p99 = _percentiles(latencies["read"] + latencies["write"])
+    write_p50, write_p99 = _percentiles(latencies["write"])
+    return {"requests": requests, "writes": len(latencies["write"]), "errors": errors, "seconds": seconds,
+            "throughput": done / seconds, "p50_ms": p50, "p99_ms": p99, "write_p50_ms": write_p50,
+            "write_p99_ms": write_p99}
+
+def start_server(workers, port, threads=4, timeout=300):
+    # Not --preload: every worker opens the index itself, the memory-mapped pages are shared anyway
+    server = subprocess.Popen(["gunicorn", "-w", str(workers), "--threads", str(threads), "-b", f"127.0.0.1:{port}",
+                               "--pythonpath", "backend", "app:app"])
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"gunicorn stopped with exit code {server.returncode}")
+        try:
+            fetch(f"http://127.0.0.1:{port}/api/knowledge/queue")
+            # Every worker loads the encoder, wait until the slowest one answers searches
+            for _ in range(4 * workers):
+                fetch(f"http://127.0.0.1:{port}/api/knowledge/search?query=warmup")
+            return server
+        except OSError:
+            time.sleep(1)
+    server.terminate()
+    raise RuntimeError("The server did not start in time")
+
+def load_test(worker_counts=(1, 2, 4), requests=2000, concurrency=32, port=5055, write_fraction=0.0):
+    results = {}
+    print(f"{requests} requests from {concurrency} clients, {write_fraction:.0%} writes")
+    print(f"{'workers':>7} {'req/s':>8} {'speedup':>8} {'p50 ms':>8} {'p99 ms':>8} {'write p50':>10} {'errors':>7}")
+    for workers in worker_counts:
+        server = start_server(workers, port)
+        try:
+            results[workers] = r = run_load(f"http://127.0.0.1:{port}", requests, concurrency,
+                                            write_fraction=write_fraction)
+        finally:
+            server.terminate()
+            server.wait()
+        speedup = r["throughput"] / results[worker_counts[0]]["throughput"]
+        write_p50 = f"{r['write_p50_ms']:.1f}" if r["write_p50_ms"] is not None else "-"
+        print(f"{workers:>7} {r['throughput']:>8.1f} {speedup:>8.2f} {r['p50_ms']:>8.1f} {r['p99_ms']:>8.1f} "
+              f"{write_p50:>10} {r['errors']:>7}")
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test of the CAKE webapp backend.")
+    parser.add_argument("-url", help="Test a server that is already running instead of starting gunicorn.")
+    parser.add_argument("-workers", type=int, nargs="+", default=[1, 2, 4], help="Numbers of gunicorn workers to test.")
+    parser.add_argument("-requests", type=int, default=2000, help="Requests per run.")
+    parser.add_argument("-concurrency", type=int, default=32, help="Client threads sending the requests.")
+    parser.add_argument("-write_fraction", type=float, default=0.0, help="Part of the requests that save a triplet.")
+    args = parser.parse_args()
+
+    if args.url:
+        print(json.dumps(run_load(args.url.rstrip("/"), args.requests, args.concurrency,
+                                  write_fraction=args.write_fraction), indent=2))
+    else:
+        load_test(args.workers, args.requests, args.concurrency, write_fraction=args.write_fraction)
@@ -8,6 +8,7 @@ The main file to run the different components of the CAKE pipeline.
 
 import argparse
 from pipelines.ContextAware_Knowledge_Extraction_Pipeline import CAKE
+from pipelines.instrumentation import profiler, PROFILE_FILE
 
 def main():
     parser = argparse.ArgumentParser(description="Run different components of the CAKE pipeline.")
@@ -15,24 +16,38 @@ def main():
     parser.add_argument("-eval", action="store_true", help="Evaluate the pipeline.")
     parser.add_argument("-chat", action="store_true", help="Run chatbot with extracted knowledge.")
     parser.add_argument("-run_all", action="store_true", help="Run all components (pipeline, evaluation, chat).")
+    parser.add_argument("-batch", metavar="LINKS_FILE", help="Run the pipeline for every video link in a file, one job directory per video.")
+    parser.add_argument("-workers", type=int, help="Number of worker processes for -batch (default: cores / 4).")
+    parser.add_argument("-shard_seconds", type=int, help="Transcribe long audio in parallel shards of about this many seconds.")
+    parser.add_argument("-llm_workers", type=int, help="Number of llama.cpp worker processes for the knowledge extraction (default: based on cores and memory).")
+    parser.add_argument("-profile", "--profile", nargs="?", const=PROFILE_FILE, metavar="REPORT_FILE",
+                        help=f"Record per-stage timings to a JSON lines report (default: {PROFILE_FILE}).")
 
     args = parser.parse_args()
 
     video_url = "https://www.youtube.com/watch?v=g4lHxSAyf7M"  # Example video
     cake = CAKE()
 
-    # Check if no arguments were provided, then default to running all
-    if not any(vars(args).values()) or args.run_all:
-        cake.run_pipeline(video_url)
+    if args.profile:
+        profiler.enable(args.profile)
+
+    # Check if no component was chosen, then default to running all (the tuning flags alone do not choose one)
+    tuning = {"profile", "workers", "shard_seconds", "llm_workers"}
+    if not any(value for key, value in vars(args).items() if key not in tuning) or args.run_all:
+        cake.run_pipeline(video_url, args.shard_seconds, args.llm_workers)
         cake.evaluate()
         cake.chat()
     else:
         if args.run:
-            cake.run_pipeline(video_url)
+            cake.run_pipeline(video_url, args.shard_seconds, args.llm_workers)
+        if args.batch:
+            cake.run_batch(args.batch, args.workers, args.shard_seconds, args.llm_workers)
         if args.eval:
             cake.evaluate()
         if args.chat:
             cake.chat()
 
+    profiler.summary()
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -6,25 +6,31 @@ Email: antonio.van.dijck@student.uva.nl
 The class CAKE is the CAKE pipeline that runs the ContextAware_Knowledge_Extraction_Pipeline and the Knowledge_Extraction_Pipeline as a whole.
 """
 
-from .Semantic_Context_Transcription_Pipeline.SCT_pipeline import *
-from .Knowledge_Extraction_Pipeline.CAKE_pipeline import *
-from .Knowledge_Extraction_Pipeline.chat import *
-from .Knowledge_Extraction_Pipeline.evaluate import *
+from .batch import run_batch
 import sys
 import os
 
+# The pipelines are imported when a mode needs them, so every CLI mode only loads its own dependencies and models
+
 class CAKE:
     def __init__(self):
         pass    
 
-    def ContextAware_Knowledge_Extraction_Pipeline(self, video_url):
-        Semantic_Context_Transcription_Pipeline(video_url)
-        Knowledge_Extraction_Pipeline()
+    def ContextAware_Knowledge_Extraction_Pipeline(self, video_url, shard_seconds=None, llm_workers=None):
+        from .Semantic_Context_Transcription_Pipeline.SCT_pipeline import Semantic_Context_Transcription_Pipeline
+        from .Knowledge_Extraction_Pipeline.CAKE_pipeline import Knowledge_Extraction_Pipeline
+        Semantic_Context_Transcription_Pipeline(video_url, shard_seconds=shard_seconds)
+        Knowledge_Extraction_Pipeline(workers=llm_workers)
+
+    def run_pipeline(self, video_url, shard_seconds=None, llm_workers=None):
+        self.ContextAware_Knowledge_Extraction_Pipeline(video_url, shard_seconds, llm_workers)
 
-    def run_pipeline(self, video_url):
-        self.ContextAware_Knowledge_Extraction_Pipeline(video_url)
+    # Run the pipeline for a list (or file) of video links, one job directory per video
+    def run_batch(self, links, workers=None, shard_seconds=None, llm_workers=None):
+        return run_batch(links, workers, shard_seconds=shard_seconds, llm_workers=llm_workers)
 
     def chat(self):
+        from .Knowledge_Extraction_Pipeline.chat import Chatbot
         chatbot = Chatbot()
         chatbot.chat()
 
@@ -33,6 +39,7 @@ class CAKE:
     # You need to change the questions.json to evaluate other videos
     
     def evaluate(self):
+        from .Knowledge_Extraction_Pipeline.evaluate import run_evaluation
         #model_paths = ["models/Qwen2.5-7B-Instruct-Q4_K_M.gguf"]
         model_dir = "pipelines/Knowledge_Extraction_Pipeline/data/models"
         questions_path = "pipelines/Knowledge_Extraction_Pipeline/data/questions.json"
@@ -7,31 +7,68 @@ The Knowledge Extraction Pipeline is a component of the CAKE pipeline that extra
 """
 
 from .knowledge_extractor import *
+from ..manifest import Manifest, text_hash
+from ..instrumentation import profiler
+from .extraction_pool import extract_chunks
 import json
 import os
 
-def Knowledge_Extraction_Pipeline():
+COMMIT_EVERY = 8  # chunks per commit of the knowledge journal and the manifest
+
+def chunk_key(chunk):
+    # A chunk only has to be processed again when its text, its times, the model or the prompts change
+    return text_hash(chunk.get("text", ""), chunk.get("start"), chunk.get("end"), LLM_MODEL_PATH, PROMPT_VERSION)
+
+def Knowledge_Extraction_Pipeline(chunks_file='pipelines/Semantic_Context_Transcription_Pipeline/result/output_audio_1_chunks.json',
+                                  knowledge_file='pipelines/Knowledge_Extraction_Pipeline/result/knowledge.json',
+                                  faiss_index_file='pipelines/Knowledge_Extraction_Pipeline/result/faiss_index.pkl',
+                                  questions_file='pipelines/Knowledge_Extraction_Pipeline/data/questions.json',
+                                  manifest_file=None,
+                                  workers=None,
+                                  cores=None,
+                                  memory_mb=None):
     # Load the chunks from output_chunks.json
-    with open('pipelines/Semantic_Context_Transcription_Pipeline/result/output_audio_1_chunks.json', 'r', encoding='utf-8') as file:
+    with open(chunks_file, 'r', encoding='utf-8') as file:
         data = json.load(file)
     chunks = data.get("chunks", [])
+
+    with profiler.stage("knowledge_extraction", chunks_file=chunks_file, chunks=len(chunks)):
+        extract_knowledge_from_chunks(chunks, knowledge_file, faiss_index_file, questions_file, manifest_file, workers,
+                                      cores, memory_mb)
+
+def extract_knowledge_from_chunks(chunks, knowledge_file, faiss_index_file, questions_file, manifest_file=None, workers=None,
+                                  cores=None, memory_mb=None):
     print(f"Total chunks loaded: {len(chunks)}")
 
+    # The manifest remembers which chunks are done, so an interrupted run resumes where it stopped
+    manifest = Manifest(manifest_file or os.path.join(os.path.dirname(knowledge_file), "manifest.json"))
+
     # Extract Knowledge from Each Chunk
-    knowledge_extractor = KnowledgeExtractor()
+    os.makedirs(os.path.dirname(knowledge_file), exist_ok=True)
+    os.makedirs(os.path.dirname(faiss_index_file), exist_ok=True)
+    with profiler.stage("model_load", model="knowledge_extractor"):
+        knowledge_extractor = KnowledgeExtractor(knowledge_file=knowledge_file, faiss_index_file=faiss_index_file)
 
     # Start processing all chunks for eval 
-    all_generated_questions = []  # Store all questions
+    questions_per_chunk = {}  # Store all questions, by chunk number
 
+    pending = []
     for i, chunk in enumerate(chunks, start=1):
-        text = chunk.get("text", "")
+        key = chunk_key(chunk)
+        done = manifest.chunk_result(key)
+        if done is not None:
+            print(f"Skipping chunk {i}, already processed.")
+            questions_per_chunk[i] = done["questions"]
+            continue
+        pending.append((i, chunk, key))
+
+    # The chunks run in parallel in the llama.cpp worker pool, but the results come back in chunk order
+    results = extract_chunks([chunk.get("text", "") for _, chunk, _ in pending], workers, cores=cores, memory_mb=memory_mb)
+
+    for processed, ((i, chunk, key), (extracted_knowledge, generated_questions)) in enumerate(zip(pending, results), start=1):
         start_time = chunk.get("start")
         end_time = chunk.get("end")
-
-        print(f"\nProcessing chunk {i} (Start: {start_time}, End: {end_time})")
-
-        # Extract valuable knowledge from the chunk text
-        extracted_knowledge = knowledge_extractor.extract_valuable_knowledge(text)
+        print(f"\nProcessed chunk {i} (Start: {start_time}, End: {end_time})")
 
         if extracted_knowledge:
 
@@ -43,19 +80,28 @@ def Knowledge_Extraction_Pipeline():
 
             # Save the extracted knowledge
             knowledge_extractor.save_knowledge(extracted_knowledge)
-            triplet_text = str([f"{t['subject']} {t['predicate']} {t['object']}" for t in extracted_knowledge])
-            generated_questions  = knowledge_extractor.create_questions_from_chunk(triplet_text)
 
             # Append questions to the list
             if generated_questions:
-                all_generated_questions.extend(generated_questions)
                 print(f"Generated {len(generated_questions)} questions from chunk {i}.")
 
             else:
 
                 print(f"No questions generated for chunk {i}.")
 
-    knowledge_extractor.save_questions_to_file(all_generated_questions)
+        questions_per_chunk[i] = generated_questions
+
+        # Only recorded after the knowledge is committed, a crash before the commit redoes the chunks of the batch
+        manifest.record_chunk(key, {"index": i, "triplets": len(extracted_knowledge), "questions": generated_questions or []}, save=False)
+        if processed % COMMIT_EVERY == 0:
+            knowledge_extractor.commit()
+            manifest.save()
+
+    knowledge_extractor.flush()
+    manifest.save()
+
+    all_generated_questions = [q for i in sorted(questions_per_chunk) for q in questions_per_chunk[i]]
+    knowledge_extractor.save_questions_to_file(all_generated_questions, questions_file)
 
     print("\nKnowledge extraction complete.")
-    print("Please check 'knowledge.json' for the extracted valuable knowledge.")
+    print(f"Please check '{knowledge_file}' for the extracted valuable knowledge.")
@@ -0,0 +1,176 @@
+"""
+Antonio van Dijck
+studentnumber: 12717673
+Email: antonio.van.dijck@student.uva.nl
+
+A semantic cache for the answers of the chatbot. An answer is stored under the embedding of its question and the
+version of the knowledge base it was generated from. A question whose embedding is at least `threshold` similar
+(cosine) to a cached one gets the cached answer, as long as the knowledge base did not change since and the entry is
+younger than `ttl` seconds. The same question (up to case and spacing) is found by its text first, so a repeated
+question does not need its embedding; an entry without an embedding only answers the same question. The cache holds at most max_entries answers and drops the least recently used one first.
+With a cache file the answers survive a restart: new entries are appended, and the file is rewritten once it holds
+twice as many lines as the cache. The processes of a multi-worker server share the file, the appends and the rewrite
+hold its lock file and the rewrite keeps the newest entries of all of them.
+"""
+
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+import numpy as np
+from ..manifest import atomic_write_bytes
+from ..locks import FileLock
+
+ANSWER_CACHE_SIZE = 512
+ANSWER_CACHE_TTL = 24 * 3600
+ANSWER_CACHE_THRESHOLD = 0.95
+
+def question_key(question):
+    return " ".join(question.lower().split())
+
+def _unit(vector):
+    if vector is None:
+        return None
+    vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+def _line(entry):
+    vector = entry["vector"].tolist() if entry["vector"] is not None else None
+    return json.dumps({**entry, "vector": vector}, ensure_ascii=False) + "\n"
+
+class AnswerCache:
+    def __init__(self, cache_file=None, max_entries=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL,
+                 threshold=ANSWER_CACHE_THRESHOLD):
+        self.cache_file = cache_file
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self.entries = OrderedDict()    # id -> {"vector", "question", "answer", "version", "created"}, least recently used first
+        self.questions = {}             # (question key, version) -> id
+        self.next_id = 0
+        self.file_lines = 0
+        self.hits = 0
+        self.misses = 0
+        self._matrix = None
+        self._ids = None
+        self.lock = threading.Lock()
+        self.file_lock = FileLock(cache_file + ".lock") if cache_file else None
+        if cache_file and os.path.exists(cache_file):
+            self.load()
+
+    def load(self):
+        with open(self.cache_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                self.file_lines += 1
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue    # torn by a crash
+                entry["vector"] = _unit(entry["vector"])
+                self._insert(entry)
+        self._evict()
+
+    def _insert(self, entry):
+        self.entries[self.next_id] = entry
+        if entry.get("question") is not None:
+            self.questions[(entry["question"], entry["version"])] = self.next_id
+        self.next_id += 1
+        self._matrix = None
+
+    def _remove(self, key):
+        entry = self.entries.pop(key)
+        question = (entry.get("question"), entry["version"])
+        if self.questions.get(question) == key:
+            del self.questions[question]
+        self._matrix = None
+
+    def _evict(self):
+        now = time.time()
+        for key in [key for key, entry in self.entries.items() if now - entry["created"] > self.ttl]:
+            self._remove(key)
+        while len(self.entries) > self.max_entries:
+            self._remove(next(iter(self.entries)))
+
+    def get_exact(self, question, version):
+        # The cached answer for the same question, None on a miss (counted by get(), which comes next)
+        with self.lock:
+            self._evict()
+            key = self.questions.get((question_key(question), version))
+            if key is None:
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]["answer"]
+
+    def get(self, embedding, version):
+        # The cached answer for a question like this one, None on a miss or without an embedding
+        with self.lock:
+            self._evict()
+            if self._matrix is None:
+                self._ids = [key for key, entry in self.entries.items() if entry["vector"] is not None]
+                self._matrix = np.stack([self.entries[key]["vector"] for key in self._ids]) if self._ids else None
+            if embedding is not None and self._matrix is not None:
+                similarities = self._matrix @ _unit(embedding)
+                # Best match first, an answer from another version of the knowledge base does not count
+                for i in np.argsort(-similarities):
+                    if similarities[i] < self.threshold:
+                        break
+                    key = self._ids[i]
+                    if self.entries[key]["version"] == version:
+                        self.entries.move_to_end(key)
+                        self.hits += 1
+                        return self.entries[key]["answer"]
+            self.misses += 1
+            return None
+
+    def put(self, embedding, version, answer, question=None):
+        entry = {"vector": _unit(embedding), "question": question_key(question) if question is not None else None,
+                 "answer": answer, "version": version, "created": time.time()}
+        with self.lock:
+            self._insert(entry)
+            self._evict()
+            if self.cache_file:
+                self._append(entry)
+
+    def _append(self, entry):
+        os.makedirs(os.path.dirname(self.cache_file) or ".", exist_ok=True)
+        with self.file_lock:
+            with open(self.cache_file, 'a', encoding='utf-8') as f:
+                f.write(_line(entry))
+            self.file_lines += 1
+            if self.file_lines > 2 * self.max_entries:
+                self._compact()
+
+    def _compact(self):
+        # The other processes append to the same file, so it is read again: the newest entries of every process that
+        # are not expired are kept, not only the ones in this cache
+        with open(self.cache_file, 'r', encoding='utf-8') as f:
+            lines = f.readlines()
+        if len(lines) > 2 * self.max_entries:
+            now = time.time()
+            kept = []
+            for line in reversed(lines):
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if now - entry["created"] <= self.ttl:
+                    kept.append(line if line.endswith("\n") else line + "\n")
+                    if len(kept) == self.max_entries:
+                        break
+            lines = kept[::-1]
+            atomic_write_bytes(self.cache_file, "".join(lines).encode("utf-8"))
+        self.file_lines = len(lines)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.questions.clear()
+            self._matrix = None
+            if self.cache_file:
+                with self.file_lock:
+                    if os.path.exists(self.cache_file):
+                        os.remove(self.cache_file)
+            self.file_lines = 0
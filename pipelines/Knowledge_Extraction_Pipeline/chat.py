@@ -8,44 +8,40 @@ The Chatbot is a component of the CAKE pipeline that allows the user to chat wit
 
 import json
 import os
-import pickle
 from datetime import datetime
-from llama_cpp import Llama
-import threading
-from sentence_transformers import SentenceTransformer
-import faiss
-import numpy as np
 from json import JSONDecodeError
-
-class LlamaSingleton:
-    _instance = None
-    _lock = threading.Lock()
-
-    def __new__(cls, model_path="pipelines/Knowledge_Extraction_Pipeline/data/models/Qwen2.5-7B-Instruct-Q4_K_M.gguf", chat_format="chatml"):
-        with cls._lock:
-            if cls._instance is None:
-                cls._instance = super(LlamaSingleton, cls).__new__(cls)
-                cls._instance.llm = Llama(model_path=model_path, chat_format=chat_format, n_ctx=2048)
-            return cls._instance
+from ..instrumentation import profiler
+from .llm_provider import get_llm
+from .knowledge_index import KnowledgeIndex, RETRIEVAL_HOPS
+from .session_store import SessionStore, DEFAULT_SESSION
+from .answer_cache import AnswerCache
 
 class Chatbot:
     def __init__(self, 
                  messages_file='pipelines/Knowledge_Extraction_Pipeline/data/messages.json', 
                  knowledge_file='pipelines/Knowledge_Extraction_Pipeline/result/knowledge.json', 
                  faiss_index_file='pipelines/Knowledge_Extraction_Pipeline/result/faiss_index.pkl',
-                 model_name='all-MiniLM-L6-v2'):
+                 model_name='all-MiniLM-L6-v2',
+                 answer_cache_file=None):
         self.messages_file = messages_file
         self.knowledge_file = knowledge_file
         self.faiss_index_file = faiss_index_file
-        self.llm = LlamaSingleton().llm
-        self.model = SentenceTransformer(model_name)
-        self.index = None
-        self.knowledge_data = []
         self.initialize_files()
-        self.load_faiss_index()
+        # The turns are appended to messages.jsonl, messages.json is only read once to move it there
+        self.sessions = SessionStore(os.path.splitext(messages_file)[0] + ".jsonl", messages_file)
+        # Memory-mapped, starting the chat does not read the knowledge base
+        self.knowledge_index = KnowledgeIndex(knowledge_file, faiss_index_file, model_name)
+        self.store = self.knowledge_index.store
+        # Repeated questions are answered from the cache until the knowledge base changes
+        self.answer_cache = AnswerCache(answer_cache_file)
+
+    # Shared with the extractor and the evaluation, loaded on first use
+    @property
+    def llm(self):
+        return get_llm()
 
     def initialize_files(self):
-        for file in [self.messages_file, self.knowledge_file]:
+        for file in [self.knowledge_file]:
             if not os.path.exists(file):
                 with open(file, 'w') as f:
                     json.dump([], f)
@@ -115,64 +111,44 @@ class Chatbot:
         except (JSONDecodeError, KeyError):
             return []
 
-    def save_message(self, role, content):
-        messages = self.load_json_data(self.messages_file)
-        message = {"role": role, "content": content, "timestamp": datetime.utcnow().isoformat()}
-        messages.append(message)
-        self.save_json_data(self.messages_file, messages)
+    def save_message(self, role, content, session_id=DEFAULT_SESSION):
+        return self.sessions.append(session_id, role, content)
+
+    def recent_messages(self, session_id=DEFAULT_SESSION, n=3):
+        return self.sessions.recent(session_id, n)
 
     def save_knowledge(self, triplets):
         if not triplets:
             return
-        knowledge = self.load_json_data(self.knowledge_file)
-        existing_set = {(t['subject'], t['predicate'], t['object']) for t in knowledge}
-        new_triplets = []
         for triplet in triplets:
             triplet['timestamp'] = datetime.utcnow().isoformat()
-            key = (triplet['subject'], triplet['predicate'], triplet['object'])
-            if key not in existing_set:
-                knowledge.append(triplet)
-                new_triplets.append(triplet)
-                existing_set.add(key)
-        self.save_json_data(self.knowledge_file, knowledge)
-        if new_triplets:
-            self.update_faiss_index(new_triplets)
-
-    def update_faiss_index(self, triplets):
-        texts = [f"{t['subject']} {t['predicate']} {t['object']}" for t in triplets]
-        embeddings = self.model.encode(texts)
-        if self.index is None:
-            self.index = faiss.IndexFlatL2(embeddings.shape[1])
-        self.index.add(np.array(embeddings, dtype=np.float32))
-        self.knowledge_data.extend(triplets)
-        self.save_faiss_index()
-
-    def save_faiss_index(self):
-        with open(self.faiss_index_file, 'wb') as f:
-            pickle.dump((self.index, self.knowledge_data), f)
-
-    def load_faiss_index(self):
-        if os.path.exists(self.faiss_index_file):
-            with open(self.faiss_index_file, 'rb') as f:
-                self.index, self.knowledge_data = pickle.load(f)
-        else:
-            self.index = None
-            self.knowledge_data = []
-
-    def search_knowledge(self, query, top_k=5):
-        if self.index is None or len(self.knowledge_data) == 0:
-            return []
-        query_embedding = self.model.encode([query])
-        distances, indices = self.index.search(np.array(query_embedding, dtype=np.float32), top_k)
-        results = []
-        for idx in indices[0]:
-            if idx == -1:
-                continue
-            results.append(self.knowledge_data[idx])
-        return results
-
-    def generate_response(self, conversation_history, user_message):
-        knowledge_matches = self.search_knowledge(user_message, top_k=5)
+        # Embedded and in the journal right away, searchable in the next turn
+        self.knowledge_index.add(triplets)
+        self.knowledge_index.commit()
+
+    def flush(self):
+        # The knowledge JSON snapshot and the index are written once, when the chat ends
+        self.knowledge_index.flush()
+
+    def search_knowledge(self, query, top_k=5, hops=RETRIEVAL_HOPS, query_embedding=None):
+        return self.knowledge_index.search(query, top_k, hops, query_embedding=query_embedding)
+
+    def cached_answer(self, user_message):
+        # (query embedding, knowledge base version, the cached answer or None), the embedding is reused by the search.
+        # The question and the knowledge are the whole prompt (the history is left out in build_messages), if the
+        # history goes back in, it has to be part of the cache key like in the webapp.
+        version = self.knowledge_index.version
+        answer = self.answer_cache.get_exact(user_message, version)
+        if answer is not None:
+            return None, version, answer
+        # The encoder only runs when the entity index does not fill the search, the embedding is None otherwise
+        embedding = None
+        if self.knowledge_index.needs_embedding(user_message):
+            embedding = self.knowledge_index.encode_query(user_message)
+        return embedding, version, self.answer_cache.get(embedding, version)
+
+    def build_messages(self, conversation_history, user_message, query_embedding=None):
+        knowledge_matches = self.search_knowledge(user_message, top_k=5, query_embedding=query_embedding)
         current_time = datetime.utcnow().isoformat()
         system_message = f"Current date and time: {current_time}\n"
         if knowledge_matches:
@@ -185,25 +161,61 @@ class Chatbot:
         enriched_history = [{"role": "system", "content": f"You are a helpful assistent; {system_message}"}] #+ conversation_history
         enriched_history.append({"role": "user", "content": user_message})
         print(enriched_history)
+        return enriched_history
+
+    def generate_response(self, conversation_history, user_message):
+        embedding, version, response = self.cached_answer(user_message)
+        if response is not None:
+            return response
         response = self.llm.create_chat_completion(
-            messages=enriched_history,
+            messages=self.build_messages(conversation_history, user_message, embedding),
             temperature=0.7,
         )['choices'][0]['message']['content']
+        self.answer_cache.put(embedding, version, response, user_message)
         return response
 
-    def chat(self):
+    def stream_response(self, conversation_history, user_message):
+        # The text of the answer piece by piece, as llama.cpp produces it, the latencies end up in self.stream_stats
+        embedding, version, response = self.cached_answer(user_message)
+        self.stream_stats = {"cached": response is not None}
+        if response is not None:
+            return profiler.token_stream("chat", iter([response]), self.stream_stats)
+        chunks = self.llm.create_chat_completion(
+            messages=self.build_messages(conversation_history, user_message, embedding),
+            temperature=0.7,
+            stream=True,
+        )
+        pieces = (chunk['choices'][0]['delta'].get('content') for chunk in chunks)
+        pieces = self._cache_when_done((piece for piece in pieces if piece), embedding, version, user_message)
+        return profiler.token_stream("chat", pieces, self.stream_stats)
+
+    def _cache_when_done(self, pieces, embedding, version, question):
+        # Only an answer that was streamed to the end goes into the cache
+        answer = []
+        for piece in pieces:
+            answer.append(piece)
+            yield piece
+        self.answer_cache.put(embedding, version, "".join(answer), question)
+
+    def chat(self, session_id=DEFAULT_SESSION):
         print("Chatbot is ready! Type 'exit' to end the conversation.")
         while True:
             user_message = input("You: ")
             if user_message.lower().strip() in ['exit', 'quit']:
                 print("Chatbot: Goodbye!")
+                self.flush()
                 break
-            self.save_message(role='user', content=user_message)
-            conversation = self.load_json_data(self.messages_file)[-3:]
-            assistant_response = self.generate_response(conversation, user_message)
-            print(f"Assistant: {assistant_response}")
+            self.save_message(role='user', content=user_message, session_id=session_id)
+            conversation = self.recent_messages(session_id)
+            print("Assistant: ", end="", flush=True)
+            pieces = []
+            for piece in self.stream_response(conversation, user_message):
+                print(piece, end="", flush=True)
+                pieces.append(piece)
+            print()
+            assistant_response = "".join(pieces)
             #generate_speech(assistant_response)
-            self.save_message(role='assistant', content=assistant_response)
+            self.save_message(role='assistant', content=assistant_response, session_id=session_id)
             #user_knowledge_response = self.extract_valuable_knowledge(user_message)
             #print(user_knowledge_response)  
             #if user_knowledge_response:
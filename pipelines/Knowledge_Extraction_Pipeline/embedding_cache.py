@@ -0,0 +1,206 @@
+"""
+Antonio van Dijck
+studentnumber: 12717673
+Email: antonio.van.dijck@student.uva.nl
+
+A persistent, content-addressed cache for sentence embeddings. Every vector is stored under a hash of (model name,
+text) in an append-only file of fixed size records per model, so re-running the pipeline, rebuilding an index or
+switching index types never encodes a text that was encoded before. The CachedEncoder looks up a whole batch at once
+and only sends the misses to the SentenceTransformer, in large batches. The encoder itself is not even loaded when
+everything is cached.
+
+Questions go through a QueryEncoder instead, an in-memory LRU cache shared by the chatbot, the evaluation and the
+webapp. It is keyed by the model and the normalized question, and bounded by the number of entries and by memory.
+Questions are not worth a disk write each, but the same ones are asked (and evaluated) again and again.
+"""
+
+import os
+import re
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+from ..manifest import atomic_write_json
+
+EMBEDDING_CACHE_DIR = "pipelines/data/embedding_cache"
+ENCODE_BATCH_SIZE = 256
+QUERY_CACHE_SIZE = 10_000
+QUERY_CACHE_MB = 64
+
+def _model_dir_name(model_name):
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", model_name)
+
+class EmbeddingCache:
+    def __init__(self, model_name, cache_dir=EMBEDDING_CACHE_DIR):
+        self.model_name = model_name
+        self.dir = os.path.join(cache_dir, _model_dir_name(model_name))
+        self.vectors_file = os.path.join(self.dir, "vectors.bin")
+        self.meta_file = os.path.join(self.dir, "meta.json")
+        self.dim = None
+        self.rows = {}
+        self._records = None
+        self._size = 0
+        self._lock = threading.Lock()
+        if os.path.exists(self.meta_file):
+            with open(self.meta_file, "r", encoding="utf-8") as f:
+                self.dim = json.load(f)["dim"]
+            self.refresh()
+
+    def key(self, text):
+        # 64 bits of sha256(model, text), collisions are negligible for millions of texts
+        digest = hashlib.sha256(f"{self.model_name}\0{text}".encode("utf-8")).digest()
+        return int.from_bytes(digest[:8], "little")
+
+    def _dtype(self):
+        return np.dtype([("key", "<u8"), ("vector", "<f4", (self.dim,))])
+
+    def __len__(self):
+        return len(self.rows)
+
+    def refresh(self):
+        # Pick up the records appended since the last look, also the ones of other processes
+        if self.dim is None or not os.path.exists(self.vectors_file):
+            return
+        record_size = self._dtype().itemsize
+        n = os.path.getsize(self.vectors_file) // record_size
+        if n * record_size == self._size:
+            return
+        # A record that is still being written (or was torn by a crash) is not counted until it is complete
+        self._records = np.memmap(self.vectors_file, dtype=self._dtype(), mode="r", shape=(n,))
+        first = self._size // record_size
+        for row, key in enumerate(self._records["key"][first:n].tolist(), start=first):
+            self.rows.setdefault(key, row)
+        self._size = n * record_size
+
+    def get_many(self, keys):
+        # Vector per key, None for a miss
+        with self._lock:
+            if any(key not in self.rows for key in keys):
+                self.refresh()
+            return [np.array(self._records["vector"][self.rows[key]]) if key in self.rows else None for key in keys]
+
+    def put_many(self, keys, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        with self._lock:
+            if self.dim is None:
+                self.dim = int(vectors.shape[1])
+                os.makedirs(self.dir, exist_ok=True)
+                atomic_write_json(self.meta_file, {"model": self.model_name, "dim": self.dim})
+
+            records = np.empty(len(keys), dtype=self._dtype())
+            records["key"] = keys
+            records["vector"] = vectors
+            # One append per batch, a record torn by a crash is cut off first so the new ones stay aligned
+            if os.path.exists(self.vectors_file):
+                size = os.path.getsize(self.vectors_file)
+                if size % records.itemsize:
+                    with open(self.vectors_file, "r+b") as f:
+                        f.truncate(size - size % records.itemsize)
+            with open(self.vectors_file, "ab") as f:
+                f.write(records.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            self.refresh()
+
+class CachedEncoder:
+    def __init__(self, model_name, cache_dir=EMBEDDING_CACHE_DIR, batch_size=ENCODE_BATCH_SIZE):
+        self.model_name = model_name
+        self.cache = EmbeddingCache(model_name, cache_dir)
+        self.batch_size = batch_size
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def model(self):
+        from .llm_provider import get_encoder
+        return get_encoder(self.model_name)
+
+    def encode(self, texts, **kwargs):
+        # Same result as SentenceTransformer.encode(texts) as a float32 array, but every text is only encoded once
+        texts = list(texts)
+        keys = [self.cache.key(text) for text in texts]
+        vectors = self.cache.get_many(keys)
+
+        missing = {}
+        for i, vector in enumerate(vectors):
+            if vector is None:
+                missing.setdefault(keys[i], texts[i])
+        self.hits += len(texts) - sum(vector is None for vector in vectors)
+        self.misses += len(missing)
+
+        if missing:
+            new_keys = list(missing)
+            new_vectors = self.model.encode([missing[key] for key in new_keys], batch_size=self.batch_size,
+                                            convert_to_numpy=True, **kwargs)
+            self.cache.put_many(new_keys, new_vectors)
+            found = dict(zip(new_keys, np.asarray(new_vectors, dtype=np.float32)))
+            vectors = [found[key] if vector is None else vector for key, vector in zip(keys, vectors)]
+
+        if not vectors:
+            return np.empty((0, self.cache.dim or 0), dtype=np.float32)
+        return np.stack(vectors).astype(np.float32, copy=False)
+
+def normalize_query(text):
+    # MiniLM is uncased and ignores extra whitespace, these variants have the same embedding
+    return " ".join(str(text).lower().split())
+
+class QueryEncoder:
+    def __init__(self, model_name, max_entries=QUERY_CACHE_SIZE, max_mb=QUERY_CACHE_MB):
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.max_bytes = max_mb * 2**20
+        self.entries = OrderedDict()    # (model, normalized query) -> vector, least recently used first
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @property
+    def model(self):
+        from .llm_provider import get_encoder
+        return get_encoder(self.model_name)
+
+    def encode(self, query):
+        return self.encode_many([query])[0]
+
+    def encode_many(self, queries):
+        # One row per query, only the queries that are not cached are encoded, in one batch
+        keys = [(self.model_name, normalize_query(query)) for query in queries]
+        vectors = {}
+        with self._lock:
+            for key in keys:
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    vectors[key] = self.entries[key]
+                    self.hits += 1
+                elif key not in vectors:
+                    vectors[key] = None
+                    self.misses += 1
+                else:
+                    self.hits += 1  # the same query twice in one batch
+        missing = [key for key, vector in vectors.items() if vector is None]
+        if missing:
+            encoded = np.asarray(self.model.encode([key[1] for key in missing], batch_size=ENCODE_BATCH_SIZE,
+                                                   convert_to_numpy=True), dtype=np.float32)
+            with self._lock:
+                for key, vector in zip(missing, encoded):
+                    vectors[key] = vector
+                    self._put(key, vector)
+        if not keys:
+            return np.empty((0, 0), dtype=np.float32)
+        return np.stack([vectors[key] for key in keys])
+
+    def _put(self, key, vector):
+        if key in self.entries:
+            return
+        self.entries[key] = vector
+        self.bytes += vector.nbytes + len(key[1])
+        while self.entries and (len(self.entries) > self.max_entries or self.bytes > self.max_bytes):
+            old_key, old_vector = self.entries.popitem(last=False)
+            self.bytes -= old_vector.nbytes + len(old_key[1])
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": round(self.hits / total, 3) if total else None,
+                "entries": len(self.entries), "memory_mb": round(self.bytes / 2**20, 2)}
@@ -0,0 +1,166 @@
+"""
+Antonio van Dijck
+studentnumber: 12717673
+Email: antonio.van.dijck@student.uva.nl
+
+An inverted index over the entities and terms of the knowledge store, the fast path of search_knowledge. Every
+subject and object is indexed as a normalized phrase, and every word of the subject, predicate and object as a term.
+A question that names an entity ("what does the charcoal canister do?") finds the triplets about it with a few
+dictionary lookups, without running the sentence encoder. The triplets that share more words with the question rank
+higher. The index follows the knowledge store row by row. It is saved next to the FAISS index as a log: every save
+appends the postings of the rows added since the last one, and opening the index reads the log and only indexes the
+records that are not in it yet. The posting lists are in row order, so a query only looks up its candidate rows in
+them, however long the lists of common words are.
+"""
+
+import os
+import re
+import json
+import math
+import threading
+from bisect import bisect_left
+
+MAX_PHRASE_WORDS = 6
+STOPWORDS = {"a", "an", "the", "of", "to", "in", "on", "at", "for", "by", "with", "and", "or", "is", "are", "was",
+             "were", "be", "it", "its", "this", "that", "what", "which", "who", "how", "why", "when", "where", "does",
+             "do", "did", "can", "i", "you", "me", "my", "your", "from", "as", "about"}
+
+def tokenize(text):
+    return re.findall(r"[a-z0-9]+", str(text).lower())
+
+def normalize_phrase(text):
+    # "The Charcoal-Canister" -> "charcoal canister", the articles in front do not make another entity
+    tokens = tokenize(text)
+    while tokens and tokens[0] in ("a", "an", "the"):
+        tokens = tokens[1:]
+    return " ".join(tokens)
+
+def index_terms(tokens):
+    return {token for token in tokens if token not in STOPWORDS}
+
+def _merge(postings, new_postings, start):
+    # The rows from start on of new_postings are added to postings
+    for key, rows in new_postings.items():
+        i = bisect_left(rows, start)
+        if i < len(rows):
+            postings.setdefault(key, []).extend(rows[i:])
+
+def _trim(postings, start):
+    # Only the rows from start on are kept
+    for key in list(postings):
+        rows = postings[key][bisect_left(postings[key], start):]
+        if rows:
+            postings[key] = rows
+        else:
+            del postings[key]
+
+def _in_rows(rows, row):
+    i = bisect_left(rows, row)
+    return i < len(rows) and rows[i] == row
+
+class EntityIndex:
+    def __init__(self, store, index_file):
+        self.store = store
+        self.index_file = index_file
+        self.rows = 0           # records of the store that are indexed
+        self.phrases = None     # normalized subject/object -> rows, in row order
+        self.terms = None       # word of subject/predicate/object -> rows, in row order
+        self.saved_rows = 0     # rows whose postings are in the log
+        self.new_phrases = {}   # the postings of the rows from saved_rows on
+        self.new_terms = {}
+        self.log_offset = 0     # bytes of the log that were read
+        self.lock = threading.RLock()
+
+    def load(self):
+        with self.lock:
+            self.phrases, self.terms, self.rows = {}, {}, 0
+            self.saved_rows, self.new_phrases, self.new_terms, self.log_offset = 0, {}, {}, 0
+            self._read_log()
+
+    def _read_log(self):
+        # The batches appended since the last read, by this process or by another one writing the same store
+        if not os.path.exists(self.index_file):
+            return
+        with open(self.index_file, 'rb') as f:
+            f.seek(self.log_offset)
+            data = f.read()
+        end = data.rfind(b"\n") + 1
+        self.log_offset += end
+        for line in data[:end].splitlines():
+            try:
+                batch = json.loads(line)
+            except json.JSONDecodeError:
+                continue        # torn by a crash
+            # After a gap, or for a store that was cut back after a crash, the rows are indexed from the store
+            if batch["start"] > self.saved_rows or batch["end"] > len(self.store):
+                continue
+            if batch["end"] > self.rows:
+                _merge(self.phrases, batch["phrases"], self.rows)
+                _merge(self.terms, batch["terms"], self.rows)
+                self.rows = batch["end"]
+            self.saved_rows = max(self.saved_rows, batch["end"])
+        _trim(self.new_phrases, self.saved_rows)
+        _trim(self.new_terms, self.saved_rows)
+
+    def update(self):
+        # Index the records the store has beyond the indexed ones, the pending records of the store included
+        with self.lock:
+            if self.phrases is None:
+                self.load()
+            for row, triplet in enumerate(self.store.records(self.rows), start=self.rows):
+                self._add(row, triplet)
+                self.rows = row + 1
+
+    def _add(self, row, triplet):
+        for field in ("subject", "object"):
+            phrase = normalize_phrase(triplet[field])
+            if index_terms(phrase.split()):
+                self.phrases.setdefault(phrase, []).append(row)
+                self.new_phrases.setdefault(phrase, []).append(row)
+        for term in index_terms(tokenize(f"{triplet['subject']} {triplet['predicate']} {triplet['object']}")):
+            self.terms.setdefault(term, []).append(row)
+            self.new_terms.setdefault(term, []).append(row)
+
+    def lookup(self, query, top_k=5):
+        # Rows of the triplets whose subject or object is named in the query, best first, [] if none is. Only
+        # indexing new records takes the lock, searches read the posting lists side by side.
+        if self.phrases is None or self.rows < len(self.store):
+            self.update()
+        tokens = tokenize(query)
+        scores = {}
+        for n in range(min(MAX_PHRASE_WORDS, len(tokens)), 0, -1):
+            for i in range(len(tokens) - n + 1):
+                for row in self.phrases.get(" ".join(tokens[i:i + n]), ()):
+                    # A longer entity is a more specific match
+                    scores[row] = max(scores.get(row, 0), n)
+        if not scores:
+            return []
+
+        # Among the entity matches, the ones sharing more (and rarer) words with the query go first
+        for term in index_terms(tokens):
+            rows = self.terms.get(term, ())
+            if rows:
+                idf = math.log(1 + self.rows / len(rows))
+                # The shorter side is walked, the candidates are looked up in a long posting list by bisection
+                if len(rows) <= len(scores):
+                    matches = [row for row in rows if row in scores]
+                else:
+                    matches = [row for row in scores if _in_rows(rows, row)]
+                for row in matches:
+                    scores[row] += idf
+        return sorted(scores, key=lambda row: (-scores[row], row))[:top_k]
+
+    def save(self):
+        # Appends the postings of the rows added since the last save, what another process saved is not written again
+        with self.lock:
+            if self.phrases is None:
+                return
+            self._read_log()
+            if self.rows <= self.saved_rows:
+                return
+            line = json.dumps({"start": self.saved_rows, "end": self.rows, "phrases": self.new_phrases,
+                               "terms": self.new_terms}, ensure_ascii=False) + "\n"
+            os.makedirs(os.path.dirname(self.index_file) or ".", exist_ok=True)
+            with open(self.index_file, 'ab') as f:
+                f.write(line.encode("utf-8"))
+            self.saved_rows, self.new_phrases, self.new_terms = self.rows, {}, {}
@@ -8,34 +8,11 @@ The evaluation script is a component of the CAKE pipeline that evaluates the per
 
 import json
 import os
-import pickle
-import threading
 import sys
 from datetime import datetime
-from llama_cpp import Llama
-from sentence_transformers import SentenceTransformer
-import faiss
-import numpy as np
 from json import JSONDecodeError
-
-# model check
-llm = Llama.from_pretrained(
-    repo_id="bartowski/Qwen2.5-7B-Instruct-GGUF",
-    filename="*Q4_K_M.gguf",
-    verbose=False,
-    local_dir="pipelines/Knowledge_Extraction_Pipeline/data/models",
-)
-
-class LlamaSingleton:
-    _instance = None
-    _lock = threading.Lock()
-
-    def __new__(cls, model_path="pipelines/Knowledge_Extraction_Pipeline/data/models/Qwen2.5-7B-Instruct-Q4_K_M.gguf", chat_format="chatml"):
-        with cls._lock:
-            if cls._instance is None:
-                cls._instance = super(LlamaSingleton, cls).__new__(cls)
-                cls._instance.llm = Llama(model_path=model_path, chat_format=chat_format, n_ctx=2048)
-            return cls._instance
+from .llm_provider import LLM_MODEL_PATH, get_llm, get_query_encoder
+from .knowledge_index import KnowledgeIndex, RETRIEVAL_HOPS
 
 class Evaluationes:
     def __init__(self, 
@@ -43,16 +20,19 @@ class Evaluationes:
                  knowledge_file='pipelines/Knowledge_Extraction_Pipeline/result/knowledge.json', 
                  faiss_index_file='pipelines/Knowledge_Extraction_Pipeline/result/faiss_index.pkl',
                  model_name='all-MiniLM-L6-v2',
-                 llm_model_path="pipelines/Knowledge_Extraction_Pipeline/data/models/Qwen2.5-7B-Instruct-Q4_K_M.gguf"):
+                 llm_model_path=LLM_MODEL_PATH):
         self.messages_file = messages_file
         self.knowledge_file = knowledge_file
         self.faiss_index_file = faiss_index_file
-        self.llm = LlamaSingleton(model_path=llm_model_path).llm
-        self.model = SentenceTransformer(model_name)
-        self.index = None
-        self.knowledge_data = []
+        self.llm_model_path = llm_model_path
+        self.model_name = model_name
         self.initialize_files()
-        self.load_faiss_index()
+        self.knowledge_index = KnowledgeIndex(knowledge_file, faiss_index_file, model_name)
+
+    # Loaded on first use, the provider swaps the model when another GGUF file is evaluated
+    @property
+    def llm(self):
+        return get_llm(self.llm_model_path)
 
     def initialize_files(self):
         for file in [self.messages_file, self.knowledge_file]:
@@ -64,25 +44,9 @@ class Evaluationes:
         with open(file_path, 'r') as f:
             return json.load(f)
 
-    def load_faiss_index(self):
-        if os.path.exists(self.faiss_index_file):
-            with open(self.faiss_index_file, 'rb') as f:
-                self.index, self.knowledge_data = pickle.load(f)
-        else:
-            self.index = None
-            self.knowledge_data = []
-
-    def search_knowledge(self, query, top_k=5):
-        if self.index is None or len(self.knowledge_data) == 0:
-            return []
-        query_embedding = self.model.encode([query])
-        distances, indices = self.index.search(np.array(query_embedding, dtype=np.float32), top_k)
-        results = []
-        for idx in indices[0]:
-            if idx == -1:
-                continue
-            results.append(self.knowledge_data[idx])
-        return results
+    def search_knowledge(self, query, top_k=5, hops=RETRIEVAL_HOPS):
+        # The same search as the chat, the prompt is only encoded when the entity index does not fill the top k
+        return self.knowledge_index.search(query, top_k, hops)
 
     # generate response with knowledge base
     def generate_response_with_kb(self, user_message):
@@ -125,13 +89,17 @@ def run_evaluation(llm_model_path, questions_path):
     # evalution llm using the provided model path
     chatbot = Evaluationes(llm_model_path=llm_model_path)
 
-    # Loop over all questions
+    # make a prompt that includes the question text and options.
+    prompts = []
     for question in questions:
-        # make a prompt that includes the question text and options.
         prompt = f"Question: {question['question']}\nOptions:\n"
         for idx, opt in enumerate(question['options']):
             # prompt += f"{idx+1}. {opt}\n"         # This is the original line but this has 1.2.3.4 before the options: this is not nice for the eval.
             prompt += f"{opt}\n"
+        prompts.append(prompt)
+
+    # Loop over all questions
+    for question, prompt in zip(questions, prompts):
 
         # Generate responses using the two new functions
         response_with_kb = chatbot.generate_response_with_kb(prompt)
@@ -193,6 +161,7 @@ def run_evaluation(llm_model_path, questions_path):
     print(f"LLM with KB Accuracy: {accuracy_with_kb:.2f}% ({scores['llm_with_kb']} correct out of {total_questions})")
     print(f"LLM without KB Accuracy: {accuracy_without_kb:.2f}% ({scores['llm_without_kb']} correct out of {total_questions})")
     print(f"Accuracy improvement with KB: {improvement:.2f}%")
+    print(f"Query embedding cache: {get_query_encoder(chatbot.model_name).stats()}")
 
 # if __name__ == "__main__": 
 #     # Check command-line arguments
@@ -0,0 +1,98 @@
+"""
+Antonio van Dijck
+studentnumber: 12717673
+Email: antonio.van.dijck@student.uva.nl
+
+A pool of llama.cpp worker processes for the knowledge extraction. Every worker loads its own copy of the model with
+its share of the cores (so the workers together do not oversubscribe the CPU), and runs the extraction and the
+question generation for one chunk at a time. The results come back in chunk order, so the caller can attach the
+start/end times and save the knowledge exactly as in the serial loop. The number of workers is capped by the memory
+that is available for the model copies. When several batch jobs extract side by side, each one plans its pool within
+its share of the cores and the memory, see job_budget().
+"""
+
+import os
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from .llm_tasks import LLM_MODEL_PATH, extract_knowledge, create_questions, triplet_text
+from .llm_provider import ensure_model, get_llm
+
+N_CTX = 2048
+CONTEXT_MEMORY_MB = 512     # KV cache and scratch buffers of one worker on top of the weights
+MIN_THREADS = 4             # below this a worker gets slower per token than it gains in parallelism
+
+_worker_llm = None
+
+def model_memory_mb(model_path=LLM_MODEL_PATH):
+    # The weights are memory-mapped, but every worker touches all of them
+    size = os.path.getsize(model_path) / 2**20 if os.path.exists(model_path) else 4700
+    return size + CONTEXT_MEMORY_MB
+
+def available_memory_mb():
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def job_budget(jobs):
+    # (cores, memory MB) of one of jobs extractions running side by side, measured before any of them loads a model
+    memory = available_memory_mb()
+    return max(1, (os.cpu_count() or 1) // jobs), memory / jobs if memory is not None else None
+
+def plan_workers(workers=None, model_path=LLM_MODEL_PATH, cores=None, memory_mb=None):
+    # (workers, threads per worker) so that workers * threads fits the cores and the model copies fit in memory. Without
+    # cores and memory_mb the pool has the whole machine.
+    cores = cores or os.cpu_count() or 1
+    workers = workers or max(1, cores // (2 * MIN_THREADS))
+
+    memory = memory_mb if memory_mb is not None else available_memory_mb()
+    if memory is not None:
+        workers = min(workers, max(1, int(memory // model_memory_mb(model_path))))
+
+    workers = max(1, min(workers, cores))
+    return workers, max(1, cores // workers)
+
+def _init_worker(model_path, n_threads):
+    global _worker_llm
+    from llama_cpp import Llama
+    _worker_llm = Llama(model_path=model_path, chat_format="chatml", n_ctx=N_CTX, n_threads=n_threads,
+                        n_threads_batch=n_threads, verbose=False)
+
+def process_chunk(llm, text):
+    # Triplets of one chunk and the questions created from them, the same two calls as the serial pipeline
+    knowledge = extract_knowledge(llm, text)
+    questions = create_questions(llm, triplet_text(knowledge)) if knowledge else []
+    return knowledge, questions
+
+def _process_chunk_in_worker(text):
+    return process_chunk(_worker_llm, text)
+
+def extract_chunks(texts, workers=None, model_path=LLM_MODEL_PATH, cores=None, memory_mb=None):
+    # Yields (knowledge, questions) per text, in the order of texts
+    workers, threads = plan_workers(workers, model_path, cores, memory_mb)
+    ensure_model(model_path)
+    started = time.perf_counter()
+
+    if workers == 1:
+        # No pool needed, run in this process on the shared model (limited to the cores of this job in a batch)
+        llm = get_llm(model_path, n_threads=threads if cores else None)
+        for i, text in enumerate(texts, start=1):
+            yield process_chunk(llm, text)
+            _report(i, started)
+        return
+
+    print(f"Extracting knowledge from {len(texts)} chunks with {workers} llama.cpp workers ({threads} threads each)...")
+    # spawn, the llama.cpp thread pools do not survive a fork
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                             initializer=_init_worker, initargs=(model_path, threads)) as executor:
+        # map keeps the input order, chunks finishing early wait until the ones before them are done
+        for i, result in enumerate(executor.map(_process_chunk_in_worker, texts), start=1):
+            yield result
+            _report(i, started)
+
+def _report(done, started):
+    minutes = (time.perf_counter() - started) / 60
+    if minutes > 0:
+        print(f"{done} chunks done, {done / minutes:.1f} chunks/min")
@@ -0,0 +1,193 @@
+"""
+Antonio van Dijck
+studentnumber: 12717673
+Email: antonio.van.dijck@student.uva.nl
+
+The knowledge graph of the knowledge store, for multi-hop retrieval. Entities (the normalized subjects and objects)
+and predicates are interned to integer ids, triplet i of the store is edge i of the graph. The adjacency is kept in
+CSR arrays (indptr, neighbour, edge) in both directions, so the neighbours of an entity are one slice, and a few
+arrays of int32 hold millions of edges. Edges added after the arrays were built are kept in a small dictionary until
+there are enough of them to rebuild. expand() walks k hops out from the entities of the retrieved triplets and returns
+the triplets it passes, nearest first, up to a budget. benchmark_graph() measures the lookups on a graph with millions
+of edges.
+"""
+
+import time
+import threading
+from array import array
+import numpy as np
+from .entity_index import normalize_phrase
+
+DEFAULT_HOPS = 1
+DEFAULT_BUDGET = 10
+REBUILD_FRACTION = 0.1      # rebuild the CSR arrays when the edges added since make up this much of the graph
+
+class KnowledgeGraph:
+    def __init__(self, store=None):
+        self.store = store
+        self.entity_ids = {}
+        self.entities = []
+        self.predicate_ids = {}
+        self.predicates = []
+        # Edge i: subjects[i] -predicates[edge_predicates[i]]-> objects[i]
+        self.subjects = array('i')
+        self.objects = array('i')
+        self.edge_predicates = array('i')
+        self.indptr = np.zeros(1, dtype=np.int64)
+        self.neighbours = np.zeros(0, dtype=np.int32)
+        self.neighbour_edges = np.zeros(0, dtype=np.int32)
+        self.built_edges = 0
+        self.recent = {}            # entity -> [(neighbour, edge)] of the edges after built_edges
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.subjects)
+
+    def _intern(self, ids, names, name):
+        if name not in ids:
+            ids[name] = len(names)
+            names.append(name)
+        return ids[name]
+
+    def entity_id(self, name):
+        return self.entity_ids.get(normalize_phrase(name))
+
+    def add_triplet(self, triplet):
+        with self.lock:
+            subject = self._intern(self.entity_ids, self.entities, normalize_phrase(triplet['subject']))
+            obj = self._intern(self.entity_ids, self.entities, normalize_phrase(triplet['object']))
+            predicate = self._intern(self.predicate_ids, self.predicates, str(triplet['predicate']).strip().lower())
+            edge = len(self.subjects)
+            self.subjects.append(subject)
+            self.objects.append(obj)
+            self.edge_predicates.append(predicate)
+            self.recent.setdefault(subject, []).append((obj, edge))
+            if obj != subject:
+                self.recent.setdefault(obj, []).append((subject, edge))
+
+    def add_edges(self, subjects, objects, predicates):
+        # Bulk load of integer edges, the ids have to be interned already (used by the benchmark)
+        with self.lock:
+            self.subjects.frombytes(np.asarray(subjects, dtype=np.int32).tobytes())
+            self.objects.frombytes(np.asarray(objects, dtype=np.int32).tobytes())
+            self.edge_predicates.frombytes(np.asarray(predicates, dtype=np.int32).tobytes())
+            self.build()
+
+    def update(self):
+        # Follow the store, triplet i of the store is edge i
+        with self.lock:
+            if self.store is None:
+                return
+            for triplet in self.store.records(len(self)):
+                self.add_triplet(triplet)
+            if len(self) - self.built_edges > max(1000, REBUILD_FRACTION * self.built_edges):
+                self.build()
+
+    def build(self):
+        with self.lock:
+            edges = len(self.subjects)
+            subjects = np.frombuffer(self.subjects, dtype=np.int32, count=edges)
+            objects = np.frombuffer(self.objects, dtype=np.int32, count=edges)
+            entities = max(len(self.entities), int(max(subjects.max(initial=-1), objects.max(initial=-1))) + 1)
+            # Both directions, a question can start at the subject or at the object of a triplet
+            loops = subjects == objects
+            heads = np.concatenate([subjects, objects[~loops]])
+            tails = np.concatenate([objects, subjects[~loops]])
+            edge_ids = np.concatenate([np.arange(edges, dtype=np.int32), np.flatnonzero(~loops).astype(np.int32)])
+            order = np.argsort(heads, kind="stable")
+            self.indptr = np.zeros(entities + 1, dtype=np.int64)
+            np.cumsum(np.bincount(heads, minlength=entities), out=self.indptr[1:])
+            self.neighbours = tails[order]
+            self.neighbour_edges = edge_ids[order]
+            self.built_edges = edges
+            self.recent = {}
+
+    def neighbours_of(self, entity, limit=None):
+        # (neighbour entities, edges) of an entity id, limit caps what is read of a hub with very many edges
+        with self.lock:
+            if entity + 1 < len(self.indptr):
+                start, end = self.indptr[entity], self.indptr[entity + 1]
+                if limit is not None:
+                    end = min(end, start + limit)
+                neighbours, edges = self.neighbours[start:end].tolist(), self.neighbour_edges[start:end].tolist()
+            else:
+                neighbours, edges = [], []
+            for neighbour, edge in self.recent.get(entity, ()):
+                neighbours.append(neighbour)
+                edges.append(edge)
+            return neighbours, edges
+
+    def edge(self, edge):
+        return (self.entities[self.subjects[edge]], self.predicates[self.edge_predicates[edge]],
+                self.entities[self.objects[edge]])
+
+    def expand(self, edges, hops=DEFAULT_HOPS, budget=DEFAULT_BUDGET):
+        # Edges (store rows) within hops of the entities of edges, nearest first and at most budget of them
+        with self.lock:
+            self.update()
+            seen = set(edges)
+            frontier = sorted({e for edge in edges if edge < len(self) for e in (self.subjects[edge], self.objects[edge])})
+            visited = set(frontier)
+            found = []
+            for _ in range(hops):
+                next_frontier = []
+                for entity in frontier:
+                    # Every edge that is not seen yet counts towards the budget, no need to read more than this
+                    neighbours, neighbour_edges = self.neighbours_of(entity, budget - len(found) + len(seen))
+                    for neighbour, edge in zip(neighbours, neighbour_edges):
+                        if edge not in seen:
+                            seen.add(edge)
+                            found.append(edge)
+                            if len(found) >= budget:
+                                return found
+                        if neighbour not in visited:
+                            visited.add(neighbour)
+                            next_frontier.append(neighbour)
+                frontier = next_frontier
+            return found
+
+    def memory_mb(self):
+        arrays = [self.indptr, self.neighbours, self.neighbour_edges]
+        return (sum(a.nbytes for a in arrays) + sum(len(a) * a.itemsize for a in
+                (self.subjects, self.objects, self.edge_predicates))) / 2**20
+
+def benchmark_graph(entities=1_000_000, edges=5_000_000, predicates=1000, lookups=10_000, hops=2, budget=50):
+    # A few hub entities with many edges and a long tail with few, like the entities in the knowledge base
+    rng = np.random.default_rng(0)
+
+    def skewed(n):
+        return np.minimum((entities * rng.random(n) ** 3).astype(np.int32), entities - 1)
+
+    graph = KnowledgeGraph()
+    graph.entities = [None] * entities
+    graph.predicates = [None] * predicates
+
+    started = time.perf_counter()
+    graph.add_edges(skewed(edges), rng.integers(entities, size=edges), rng.integers(predicates, size=edges))
+    build_seconds = time.perf_counter() - started
+
+    latencies = []
+    for entity in rng.integers(entities, size=lookups).tolist():
+        started = time.perf_counter()
+        graph.neighbours_of(entity)
+        latencies.append((time.perf_counter() - started) * 1e6)
+
+    expand_latencies = []
+    for edge in rng.integers(edges, size=lookups // 10).tolist():
+        started = time.perf_counter()
+        graph.expand([edge], hops, budget)
+        expand_latencies.append((time.perf_counter() - started) * 1e6)
+
+    results = {"build_seconds": build_seconds, "memory_mb": graph.memory_mb(),
+               "neighbours_p50_us": float(np.percentile(latencies, 50)),
+               "neighbours_p99_us": float(np.percentile(latencies, 99)),
+               "expand_p50_us": float(np.percentile(expand_latencies, 50)),
+               "expand_p99_us": float(np.percentile(expand_latencies, 99))}
+    print(f"{entities} entities, {edges} edges: built in {build_seconds:.2f}s, {results['memory_mb']:.0f} MB")
+    print(f"neighbours: p50 {results['neighbours_p50_us']:.1f} us, p99 {results['neighbours_p99_us']:.1f} us")
+    print(f"expand {hops} hops (budget {budget}): p50 {results['expand_p50_us']:.1f} us, "
+          f"p99 {results['expand_p99_us']:.1f} us")
+    return results
+
+if __name__ == "__main__":
+    benchmark_graph()
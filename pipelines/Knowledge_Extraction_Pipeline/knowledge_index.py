@@ -0,0 +1,463 @@
+"""
+Antonio van Dijck
+studentnumber: 12717673
+Email: antonio.van.dijck@student.uva.nl
+
+The vector index over the knowledge store, shared by the extractor, the chatbot, the evaluation and the webapp. The
+vectors are saved in the native FAISS format and opened memory-mapped (faiss-cpu 1.11 and newer), so opening the
+index does not read it and processes that search the same index share its pages. Row i of the index is record i of the knowledge store, which
+is read from disk only for the search results. The first write reloads the index into memory, a memory-mapped index
+can not grow. An old faiss_index.pkl is converted the first time it is opened.
+
+The type of index follows the size of the knowledge base: exact (flat) search for a few videos, HNSW for up to a
+million triplets, IVF above that and IVF-PQ (compressed, lower recall) for the largest libraries. When the knowledge base outgrows its index, the
+index is rebuilt (and the IVF centroids re-trained) from the vectors in the embedding cache. nprobe and efSearch trade
+recall for speed, benchmark_index_types() measures that trade-off.
+
+With a duplicate_threshold (the extraction pipeline uses DUPLICATE_THRESHOLD), paraphrases of a triplet that is already
+known (the same fact extracted from overlapping chunks) are not added as new triplets, their time ranges are merged into
+the first one, see canonicalize(). Triplets with other numbers ("25 Nm" and "35 Nm") are never merged. A search first looks the query up in the entity index, the encoder only runs when the named entities do not fill the
+top k. With hops, the hits are expanded over the knowledge graph to the triplets around their entities.
+
+Searches hold a read lock and run side by side, a write has the index to itself. With shared=True several processes
+(the workers of a web server) use the same index: every write holds the lock file of the store and starts from the
+newest snapshot and journal. The other processes read the new records from the journal on their next search, so the
+entity lookup and the graph find them right away. The vectors follow with the next snapshot of the index, which is
+saved at most every SNAPSHOT_INTERVAL seconds because it costs the size of the whole index.
+"""
+
+import os
+import re
+import pickle
+import time
+import threading
+from contextlib import contextmanager
+import faiss
+import numpy as np
+from ..instrumentation import profiler
+from ..locks import ReadWriteLock
+from .knowledge_store import KnowledgeStore, merge_time_range, triplet_key
+from .entity_index import EntityIndex
+from .knowledge_graph import KnowledgeGraph, DEFAULT_BUDGET
+from .llm_provider import ENCODER_MODEL, get_cached_encoder, get_query_encoder
+
+EMBED_BATCH_SIZE = 256
+
+# Zero-copy memory mapping of the vectors (flat, HNSW and IVF), faiss-cpu 1.11 and newer. IO_FLAG_MMAP of older
+# versions only maps on-disk inverted lists, every process would still read a flat or HNSW index into memory.
+MMAP_FLAG = getattr(faiss, "IO_FLAG_MMAP_IFC", None)
+
+INDEX_TYPES = ("flat", "hnsw", "ivf", "ivfpq")
+# index_type="auto" picks the first type whose limit is above the number of triplets, ivfpq beyond the last one
+AUTO_INDEX_LIMITS = [(50_000, "flat"), (1_000_000, "hnsw"), (10_000_000, "ivf")]
+MIN_TRAIN_ROWS = 10_000     # below this there is not enough to train IVF centroids and PQ codebooks on
+HNSW_M = 32
+DEFAULT_NPROBE = 16
+DEFAULT_EF_SEARCH = 64
+RETRIEVAL_HOPS = 1          # the chat prompts get the triplets one hop around the entities of the search hits
+SNAPSHOT_INTERVAL = 2.0     # seconds between two saves of a shared index, see _save_later()
+DUPLICATE_THRESHOLD = 0.9   # cosine similarity above which two extracted triplets are the same fact
+DUPLICATE_CANDIDATES = 4    # known triplets a new one is compared with
+NUMBER_PATTERN = re.compile(r"\d+(?:[.,]\d+)?")
+_INDEX_CLASSES = {"IndexFlat": "flat", "IndexFlatL2": "flat", "IndexHNSWFlat": "hnsw", "IndexIVFFlat": "ivf", "IndexIVFPQ": "ivfpq"}
+
+def embedding_text(triplet):
+    return f"{triplet['subject']} {triplet['predicate']} {triplet['object']}"
+
+def same_numbers(a, b):
+    # Embeddings of "bolt torque is 25 Nm" and "bolt torque is 35 Nm" are nearly the same, the numbers are not
+    return sorted(NUMBER_PATTERN.findall(embedding_text(a))) == sorted(NUMBER_PATTERN.findall(embedding_text(b)))
+
+def choose_index_type(rows, index_type="auto"):
+    if index_type == "auto":
+        index_type = next((name for limit, name in AUTO_INDEX_LIMITS if rows < limit), "ivfpq")
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type {index_type}, choose from auto, {', '.join(INDEX_TYPES)}")
+    if index_type in ("ivf", "ivfpq") and rows < MIN_TRAIN_ROWS:
+        return "flat"
+    return index_type
+
+def index_type_of(index):
+    return _INDEX_CLASSES.get(type(index).__name__)
+
+def nlist_for(rows):
+    # About 4 * sqrt(rows) inverted lists, with the 39 training vectors per list faiss asks for
+    return max(1, min(int(4 * np.sqrt(rows)), rows // 39))
+
+def index_factory_string(index_type, rows, dim):
+    if index_type == "hnsw":
+        return f"HNSW{HNSW_M}"
+    if index_type == "ivf":
+        return f"IVF{nlist_for(rows)},Flat"
+    if index_type == "ivfpq":
+        # One byte per sub-vector of (at least) 8 dimensions, 48 bytes per triplet for MiniLM instead of 1536
+        m = max(m for m in range(1, dim // 8 + 1) if dim % m == 0)
+        return f"IVF{nlist_for(rows)},PQ{m}"
+    return "Flat"
+
+def build_index(vectors, index_type):
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    rows, dim = vectors.shape
+    index = faiss.index_factory(dim, index_factory_string(index_type, rows, dim))
+    if not index.is_trained:
+        index.train(vectors)
+    index.add(vectors)
+    return index
+
+def set_search_params(index, nprobe=DEFAULT_NPROBE, ef_search=DEFAULT_EF_SEARCH):
+    if isinstance(index, faiss.IndexIVF):
+        index.nprobe = nprobe
+    elif isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = ef_search
+
+class KnowledgeIndex:
+    def __init__(self, knowledge_file, faiss_index_file, model_name=ENCODER_MODEL, journal_file=None,
+                 index_type="auto", nprobe=DEFAULT_NPROBE, ef_search=DEFAULT_EF_SEARCH,
+                 duplicate_threshold=None, shared=False):
+        self.model_name = model_name
+        self.duplicate_threshold = duplicate_threshold
+        self.index_type = index_type
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        self.store = KnowledgeStore(knowledge_file, journal_file)
+        self.legacy_file = faiss_index_file if faiss_index_file.endswith(".pkl") else None
+        self.index_file = os.path.splitext(faiss_index_file)[0] + ".faiss"
+        self.entities = EntityIndex(self.store, os.path.splitext(faiss_index_file)[0] + ".entities.jsonl")
+        self.graph = KnowledgeGraph(self.store)     # built from the store on the first multi-hop search
+        self.encoder = get_cached_encoder(model_name)
+        self.index = None
+        self.mapped = False
+        self.mapped_warning = False
+        self.pending = []
+        self.shared = shared
+        self.snapshot = None    # identity of the index file that was loaded or saved last
+        self.snapshot_rows = 0  # rows of that file
+        self.last_save = 0.0
+        self._save_timer = None
+        self.lock = ReadWriteLock()
+        self.load()
+
+    def _snapshot(self):
+        try:
+            stat = os.stat(self.index_file)
+        except FileNotFoundError:
+            return None
+        # A save replaces the file, a new file has a new inode
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def load(self):
+        with self.lock.write():
+            if not os.path.exists(self.index_file) and self.legacy_file and os.path.exists(self.legacy_file):
+                # Converted once, by the first of the processes that open it at the same time
+                with self.store.file_lock:
+                    if not os.path.exists(self.index_file):
+                        self.migrate_pickle()
+            self.snapshot = self._snapshot()
+            if os.path.exists(self.index_file) and MMAP_FLAG is None:
+                if not self.mapped_warning:
+                    print(f"faiss {faiss.__version__} can not memory-map {self.index_file} (faiss-cpu >= 1.11 can), "
+                          f"it is read into the memory of this process")
+                    self.mapped_warning = True
+                self.index = faiss.read_index(self.index_file)
+                self.mapped = False
+            elif os.path.exists(self.index_file):
+                self.index = faiss.read_index(self.index_file, MMAP_FLAG)
+                self.mapped = True
+            else:
+                self.index = None
+                self.mapped = False
+            self.snapshot_rows = len(self)
+
+    def migrate_pickle(self):
+        # The pickled index has a row per triplet of the pickled knowledge list, in its own order and with its
+        # duplicates, while row i of the new index has to be record i of the store (created from the knowledge JSON).
+        # The pickled vectors are put in the order of the store, a record without one is embedded again.
+        print(f"Converting {self.legacy_file} to {self.index_file}")
+        with open(self.legacy_file, 'rb') as f:
+            legacy_index, legacy_knowledge = pickle.load(f)
+        legacy_rows = {}
+        for row, triplet in enumerate(legacy_knowledge[:legacy_index.ntotal]):
+            legacy_rows.setdefault(triplet_key(triplet), row)
+        try:
+            legacy_vectors = legacy_index.reconstruct_n(0, legacy_index.ntotal)
+        except RuntimeError:
+            legacy_vectors, legacy_rows = None, {}     # an index that does not keep its vectors
+        records = list(self.store.records())
+        self.index, self.mapped = None, False
+        if records:
+            rows = [legacy_rows.get(triplet_key(triplet)) for triplet in records]
+            missing = [i for i, row in enumerate(rows) if row is None]
+            fresh = self._encode([records[i] for i in missing]) if missing else None
+            # Vectors of another encoder can not be mixed with these, then everything is embedded again
+            if len(missing) < len(records) and (fresh is None or fresh.shape[1] == legacy_vectors.shape[1]):
+                embeddings = np.zeros((len(records), legacy_vectors.shape[1]), dtype=np.float32)
+                found = [i for i, row in enumerate(rows) if row is not None]
+                embeddings[found] = legacy_vectors[[rows[i] for i in found]]
+                if missing:
+                    embeddings[missing] = fresh
+                self.index = build_index(embeddings, choose_index_type(len(records), self.index_type))
+            if len(self) != len(self.store):
+                # Never save an index whose rows are not the records of the store
+                self.rebuild(rows=len(self.store))
+        self.save()
+
+    def __len__(self):
+        # Rows that can be searched, the store is only ahead of the index after a crash, see sync()
+        return self.index.ntotal if self.index is not None else 0
+
+    def _writable(self):
+        if self.mapped:
+            self.index = faiss.read_index(self.index_file)
+            self.mapped = False
+
+    def add(self, triplets):
+        # Queued for the next embedding batch, which canonicalizes them and saves them in the store. A shared index
+        # only writes on commit(), under the lock file.
+        with self.lock.write():
+            self.pending.extend(triplets)
+            if len(self.pending) >= EMBED_BATCH_SIZE and not self.shared:
+                self.embed_pending()
+
+    def _encode(self, triplets):
+        texts = [embedding_text(t) for t in triplets]
+        with profiler.stage("embedding", texts=len(texts)) as info:
+            hits = self.encoder.hits
+            embeddings = self.encoder.encode(texts)
+            info["cache_hits"] = self.encoder.hits - hits
+        return np.array(embeddings, dtype=np.float32).reshape(len(texts), -1)
+
+    def embed_pending(self):
+        with self.lock.write():
+            if not self.pending:
+                return
+            triplets, self.pending = self.pending, []
+            embeddings = self._encode(triplets)
+            if self.duplicate_threshold is not None:
+                triplets, embeddings = self.canonicalize(triplets, embeddings)
+            # The store drops exact duplicates, only the vectors of the triplets it saved go into the index
+            saved = {id(t) for t in self.store.add(triplets)}
+            keep = [i for i, t in enumerate(triplets) if id(t) in saved]
+            self.entities.update()
+            if keep:
+                self._add_vectors(embeddings[keep])
+
+    def _add_vectors(self, embeddings):
+        self._writable()
+        if self.index is None:
+            self.index = build_index(embeddings, choose_index_type(len(embeddings), self.index_type))
+        else:
+            self.index.add(embeddings)
+        index_type = self._rebuild_type()
+        if index_type:
+            self.rebuild(index_type)
+
+    def canonicalize(self, triplets, embeddings):
+        # A triplet as similar as duplicate_threshold (cosine) to one that is already known is merged into it: only
+        # its time range is added to the first one. Returns the triplets that are new, with their vectors.
+        if len(self) > 0:
+            set_search_params(self.index, self.nprobe, self.ef_search)
+            # A few neighbours, the nearest one can be the same fact with another number
+            distances, indices = self.index.search(embeddings, DUPLICATE_CANDIDATES)
+        # The MiniLM vectors are normalized, cosine = 1 - L2^2 / 2 = dot
+        similarities = embeddings @ embeddings.T
+        keep = []
+        for i, triplet in enumerate(triplets):
+            target, best = None, self.duplicate_threshold
+            for distance, row in zip(distances[i], indices[i]) if len(self) > 0 else ():
+                if row != -1 and 1 - distance / 2 >= best and same_numbers(triplet, self.store[int(row)]):
+                    target, best = int(row), 1 - distance / 2
+                    break
+            for j in keep:
+                if similarities[i, j] >= best and same_numbers(triplet, triplets[j]):
+                    target, best = triplets[j], similarities[i, j]
+            if target is None:
+                keep.append(i)
+            elif isinstance(target, int):
+                self.store.merge(target, triplet)
+            else:
+                merge_time_range(target, triplet)
+        return [triplets[i] for i in keep], embeddings[keep]
+
+    def _rebuild_type(self):
+        # The type the index should be rebuilt as, None while it still fits the knowledge base
+        index_type = choose_index_type(len(self), self.index_type)
+        if index_type != index_type_of(self.index):
+            return index_type
+        if index_type in ("ivf", "ivfpq") and nlist_for(len(self)) >= 2 * faiss.extract_index_ivf(self.index).nlist:
+            # The lists got too long since the centroids were trained, train them again on all triplets
+            return index_type
+        return None
+
+    def rebuild(self, index_type=None, rows=None):
+        # Every vector comes from the embedding cache, nothing is encoded again
+        with self.lock.write():
+            rows = len(self) if rows is None else rows
+            index_type = index_type or choose_index_type(rows, self.index_type)
+            with profiler.stage("index_build", index_type=index_type, vectors=rows):
+                print(f"Building the {index_type} index over {rows} triplets")
+                vectors = self.encoder.encode(embedding_text(t) for t in self.store.records(0, rows))
+                self.index = build_index(vectors, index_type)
+                self.mapped = False
+
+    @contextmanager
+    def _writing(self):
+        with self.lock.write(), self.store.file_lock:
+            if not self.shared:
+                yield
+                return
+            # Start from what the other processes wrote: their records, their last snapshot, and the vectors of
+            # records whose snapshot was never saved
+            self.store.catch_up()
+            if self._snapshot() != self.snapshot:
+                self.load()
+            self._sync()
+            yield
+            # The other processes read the new records from the journal right away, the vectors with the next snapshot
+            self.store.commit()
+            self.entities.save()
+            if len(self) != self.snapshot_rows:
+                self._save_later()
+
+    def _save_later(self):
+        # Saving the index costs its whole size, so there is at most one snapshot every SNAPSHOT_INTERVAL seconds
+        delay = self.last_save + SNAPSHOT_INTERVAL - time.time()
+        if delay <= 0:
+            self.save()
+            self.load()     # back to the memory-mapped file, its pages are shared with the other processes
+        elif self._save_timer is None:
+            self._save_timer = threading.Timer(delay, self._save_snapshot)
+            self._save_timer.daemon = True
+            self._save_timer.start()
+
+    def _save_snapshot(self):
+        with self._writing():
+            self._save_timer = None
+
+    def reload_if_changed(self):
+        # Another process saved a new snapshot or committed to the journal: open the snapshot, read the records
+        if self._snapshot() != self.snapshot or self.store.changed():
+            with self.lock.write():
+                if self._snapshot() != self.snapshot:
+                    self.load()
+                self.store.catch_up()
+
+    def sync(self):
+        # The store is ahead of the index when a run stopped before its flush, embed what is missing
+        with self._writing():
+            self._sync(report=True)
+
+    def _sync(self, report=False):
+        # Without report for a shared index, catching up on the records of the other processes is the normal case
+        missing = len(self.store) - len(self)
+        if missing > 0:
+            if report:
+                print(f"Adding {missing} triplets from the journal to the index")
+            self._add_vectors(self._encode(list(self.store.records(len(self)))))
+
+    def commit(self):
+        # Whatever was added so far is in the journal after this, canonicalized
+        with self._writing():
+            self.embed_pending()
+            self.store.commit()
+
+    def save(self):
+        with self.lock.write():
+            if self.index is None:
+                return
+            with profiler.stage("faiss_save", vectors=self.index.ntotal):
+                # Written next to the index and renamed, processes that have the old file mapped keep reading it
+                tmp_file = f"{self.index_file}.{os.getpid()}.tmp"
+                faiss.write_index(self.index, tmp_file)
+                os.replace(tmp_file, self.index_file)
+            self.snapshot = self._snapshot()
+            self.snapshot_rows = len(self)
+            self.last_save = time.time()
+
+    def flush(self):
+        with self._writing():
+            self.embed_pending()
+            self.store.flush()
+            self.save()
+            self.entities.save()
+
+    def encode_query(self, query):
+        # From the query cache shared by everyone in the process
+        return get_query_encoder(self.model_name).encode(query).reshape(1, -1)
+
+    def needs_embedding(self, query, top_k=5):
+        # False when the entity index fills the top k by itself, search() does not run the encoder then
+        if self.shared:
+            self.reload_if_changed()
+        with self.lock.read():
+            return len(self) > 0 and len(self.entities.lookup(query, top_k)) < top_k
+
+    @property
+    def version(self):
+        # A cached answer is checked against this without a search, a worker of a multi-worker server has to see the
+        # knowledge the others saved first
+        if self.shared:
+            self.reload_if_changed()
+        return self.store.version()
+
+    def search(self, query, top_k=5, hops=0, budget=DEFAULT_BUDGET, query_embedding=None):
+        if self.shared:
+            self.reload_if_changed()
+        with self.lock.read():
+            rows = self.entities.lookup(query, top_k)
+            if len(rows) < top_k and len(self) > 0:
+                # Not enough triplets about the entities in the query, the vector search fills up the rest
+                set_search_params(self.index, self.nprobe, self.ef_search)
+                if query_embedding is None:
+                    query_embedding = self.encode_query(query)
+                distances, indices = self.index.search(np.asarray(query_embedding, dtype=np.float32).reshape(1, -1), top_k)
+                rows += [int(idx) for idx in indices[0] if idx != -1 and idx not in rows][:top_k - len(rows)]
+            if hops:
+                # The triplets around the entities of the hits, at most budget more
+                rows += self.graph.expand(rows, hops, budget)
+            return [self.store[row] for row in rows if row < len(self.store)]
+
+def _clustered_vectors(rng, rows, dim, centers):
+    # Triplet embeddings are not uniform, points around topics are closer to what the index sees
+    return (centers[rng.integers(len(centers), size=rows)] +
+            0.5 * rng.standard_normal((rows, dim), dtype=np.float32)).astype(np.float32)
+
+def benchmark_index_types(rows=200_000, dim=384, queries=500, top_k=5, index_types=INDEX_TYPES,
+                          nprobe=DEFAULT_NPROBE, ef_search=DEFAULT_EF_SEARCH):
+    # recall@k against exact search, per query latency and the size of the saved index for every index type
+    rng = np.random.default_rng(0)
+    centers = rng.standard_normal((max(1, rows // 200), dim), dtype=np.float32)
+    vectors = _clustered_vectors(rng, rows, dim, centers)
+    query_vectors = _clustered_vectors(rng, queries, dim, centers)
+    exact = faiss.IndexFlatL2(dim)
+    exact.add(vectors)
+    _, truth = exact.search(query_vectors, top_k)
+    del exact
+
+    results = {}
+    print(f"{rows} vectors of {dim} dimensions, {queries} queries, nprobe={nprobe}, efSearch={ef_search}")
+    print(f"{'index':<7} {'build s':>8} {f'recall@{top_k}':>9} {'p50 ms':>8} {'p99 ms':>8} {'memory MB':>10}")
+    for index_type in index_types:
+        started = time.perf_counter()
+        index = build_index(vectors, choose_index_type(rows, index_type))
+        build_seconds = time.perf_counter() - started
+        set_search_params(index, nprobe, ef_search)
+
+        latencies = []
+        hits = 0
+        for i in range(queries):
+            started = time.perf_counter()
+            _, found = index.search(query_vectors[i:i + 1], top_k)
+            latencies.append((time.perf_counter() - started) * 1000)
+            hits += len(set(found[0].tolist()) & set(truth[i].tolist()))
+        memory_mb = len(faiss.serialize_index(index)) / 2**20
+
+        results[index_type] = {"build_seconds": build_seconds, "recall": hits / (queries * top_k),
+                               "p50_ms": float(np.percentile(latencies, 50)), "p99_ms": float(np.percentile(latencies, 99)),
+                               "memory_mb": memory_mb}
+        r = results[index_type]
+        print(f"{index_type:<7} {build_seconds:>8.1f} {r['recall']:>9.3f} {r['p50_ms']:>8.2f} {r['p99_ms']:>8.2f} {memory_mb:>10.1f}")
+        del index
+    return results
+
+if __name__ == "__main__":
+    benchmark_index_types()
@@ -0,0 +1,296 @@
+"""
+Antonio van Dijck
+studentnumber: 12717673
+Email: antonio.van.dijck@student.uva.nl
+
+The knowledge store writes the triplets to an append-only JSON lines journal next to the knowledge file. New triplets
+are buffered and appended in batches, so saving the knowledge of a chunk costs the size of the chunk and not the size
+of the whole knowledge base. A sidecar file holds the end offset of every record, so record i (row i of the vector
+index) is read on demand from the memory-mapped journal and opening the store does not depend on its size. The dedup
+set on (subject, predicate, object) is only built when something is added. The journal is the source of truth: a
+record torn by a crash is dropped and missing offsets are rebuilt when the store is opened for writing. The knowledge
+JSON file (read by the notebooks and the webapp) is a snapshot that is written atomically on flush. Appends hold a
+lock file next to the journal, so several processes can write to the same store one after the other; catch_up() reads
+what the other processes appended since.
+
+Records are never rewritten. When a near-duplicate of record i is found, its time range is appended to a second
+journal of merges, and record i is read with the union of all its time ranges in "ranges".
+"""
+
+import os
+import mmap
+import json
+import threading
+import numpy as np
+from ..manifest import atomic_write_json, atomic_write_bytes
+from ..locks import FileLock
+
+def triplet_key(triplet):
+    return (triplet['subject'], triplet['predicate'], triplet['object'])
+
+def time_ranges(triplet):
+    if "ranges" in triplet:
+        return [list(r) for r in triplet["ranges"]]
+    return [[triplet["start"], triplet["end"]]] if "start" in triplet and "end" in triplet else []
+
+def union_ranges(ranges):
+    # Sorted, with overlapping and touching ranges joined
+    union = []
+    for start, end in sorted(ranges):
+        if union and start <= union[-1][1]:
+            union[-1][1] = max(union[-1][1], end)
+        else:
+            union.append([start, end])
+    return union
+
+def merge_time_range(triplet, duplicate):
+    ranges = time_ranges(duplicate)
+    if ranges and ("start" in triplet or "ranges" in triplet):
+        triplet["ranges"] = union_ranges(time_ranges(triplet) + ranges)
+
+class KnowledgeStore:
+    def __init__(self, knowledge_file, journal_file=None, batch_size=256):
+        self.knowledge_file = knowledge_file
+        self.journal_file = journal_file or os.path.splitext(knowledge_file)[0] + ".jsonl"
+        self.offsets_file = self.journal_file + ".offsets"
+        self.merges_file = self.journal_file + ".merges"
+        self.batch_size = batch_size
+        self.ends = np.zeros(0, dtype="<u8")    # end offset of every committed record
+        self.pending = []
+        self.pending_merges = []
+        self.merges = None      # row -> time ranges of its near-duplicates
+        self.merges_size = 0
+        self.journal_size = 0   # size of the journal at the last refresh or commit
+        self.keys = None
+        self.lock = threading.RLock()
+        self.file_lock = FileLock(self.journal_file + ".lock")     # between the processes writing to the journal
+        self._map = None
+        self._export_timer = None
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.journal_file) and os.path.exists(self.knowledge_file):
+            # First run on an existing knowledge base, the JSON file becomes the start of the journal. Only the first of
+            # the processes that open the store at the same time imports it.
+            with self.file_lock:
+                if not os.path.exists(self.journal_file):
+                    with open(self.knowledge_file, 'r', encoding='utf-8') as f:
+                        try:
+                            knowledge = json.load(f)
+                        except json.JSONDecodeError:
+                            knowledge = []
+                    self.add(knowledge)
+                    self.commit()
+        self.refresh()
+
+    def refresh(self, repair=False):
+        # Read the offsets again (another process may have appended), repair=True also fixes the files after a crash
+        # and has to hold the lock file: what looks torn may be a record another process is still appending
+        with self.lock:
+            merges_size = os.path.getsize(self.merges_file) if os.path.exists(self.merges_file) else 0
+            if merges_size != self.merges_size:
+                self.merges = None      # read again on the next lookup
+            self.merges_size = merges_size
+            if not os.path.exists(self.journal_file):
+                self.ends = np.zeros(0, dtype="<u8")
+                self.journal_size = 0
+                return
+            size = self.journal_size = os.path.getsize(self.journal_file)
+            has_offsets = os.path.exists(self.offsets_file)
+            ends = np.zeros(0, dtype="<u8")
+            if has_offsets:
+                with open(self.offsets_file, 'rb') as f:
+                    data = f.read()
+                ends = np.frombuffer(data[:len(data) - len(data) % 8], dtype="<u8")
+            # The journal is always written before its offsets, offsets past the end of it are not valid
+            ends = ends[ends <= size]
+
+            end = int(ends[-1]) if len(ends) else 0
+            new_ends, good_until = self._scan(end, size) if end < size else ([], end)
+            if new_ends:
+                ends = np.concatenate([ends, np.array(new_ends, dtype="<u8")])
+            known, self.ends = len(self.ends), ends
+            if self.keys is not None:
+                # Records another process appended are duplicates for this one too
+                self.keys.update(triplet_key(triplet) for triplet in self.records(known, len(ends)))
+
+            if repair and good_until < size:
+                print(f"Dropping an incomplete record at the end of {self.journal_file}")
+                with open(self.journal_file, 'r+b') as f:
+                    f.truncate(good_until)
+            if repair and (not has_offsets or new_ends or len(data) != self.ends.nbytes):
+                # Only under the lock file: replacing the offsets while another process appends to them would leave
+                # a gap, and every row after it would point at the wrong record
+                atomic_write_bytes(self.offsets_file, self.ends.tobytes())
+
+    def changed(self):
+        # Whether another process committed records or merges since the last refresh, two stats
+        journal_size = os.path.getsize(self.journal_file) if os.path.exists(self.journal_file) else 0
+        merges_size = os.path.getsize(self.merges_file) if os.path.exists(self.merges_file) else 0
+        return journal_size != self.journal_size or merges_size != self.merges_size
+
+    def catch_up(self):
+        # The records and merges other processes committed since, not while this one has something pending (the
+        # pending records would change rows)
+        with self.lock:
+            if not self.pending and not self.pending_merges:
+                self.refresh()
+
+    def _scan(self, start, size):
+        # End offsets of the complete records in journal[start:size]
+        ends = []
+        good_until = start
+        with open(self.journal_file, 'rb') as f:
+            f.seek(start)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                good_until += len(line)
+                ends.append(good_until)
+        return ends, good_until
+
+    def _journal_map(self, end):
+        if self._map is None or len(self._map) < end:
+            with open(self.journal_file, 'rb') as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map
+
+    def __len__(self):
+        return len(self.ends) + len(self.pending)
+
+    def version(self):
+        # Changes whenever a record is added or merged into, also across restarts
+        return f"{len(self)}.{self.merges_size + len(self.pending_merges)}"
+
+    def __getitem__(self, index):
+        with self.lock:
+            if index < 0:
+                index += len(self)
+            if index >= len(self.ends):
+                return self.pending[index - len(self.ends)]
+            start = int(self.ends[index - 1]) if index else 0
+            end = int(self.ends[index])
+            triplet = json.loads(self._journal_map(end)[start:end])
+            ranges = self._load_merges().get(index)
+            if ranges and time_ranges(triplet):
+                triplet["ranges"] = union_ranges(time_ranges(triplet) + ranges)
+            return triplet
+
+    def _load_merges(self):
+        if self.merges is None:
+            self.merges = {}
+            if os.path.exists(self.merges_file):
+                with open(self.merges_file, 'rb') as f:
+                    for line in f:
+                        try:
+                            merge = json.loads(line)
+                        except json.JSONDecodeError:
+                            continue    # torn by a crash
+                        self.merges.setdefault(merge["row"], []).extend(merge["ranges"])
+        return self.merges
+
+    def merge(self, index, duplicate):
+        # Record index gets the time ranges of duplicate, written with the next commit()
+        with self.lock:
+            ranges = time_ranges(duplicate)
+            if not ranges:
+                return
+            if index >= len(self.ends):
+                merge_time_range(self.pending[index - len(self.ends)], duplicate)
+                return
+            self._load_merges().setdefault(index, []).extend(ranges)
+            self.pending_merges.append({"row": index, "ranges": ranges})
+
+    def records(self, start=0, stop=None):
+        stop = len(self) if stop is None else min(stop, len(self))
+        for index in range(start, stop):
+            yield self[index]
+
+    def __iter__(self):
+        return self.records()
+
+    def _load_keys(self):
+        # Only a writer needs the dedup set, it also repairs what a crashed writer left behind
+        if self.keys is None:
+            with self.file_lock, self.lock:
+                if self.keys is None:
+                    self.refresh(repair=True)
+                    self.keys = {triplet_key(triplet) for triplet in self.records()}
+        return self.keys
+
+    def __contains__(self, triplet):
+        return triplet_key(triplet) in self._load_keys()
+
+    def add(self, triplets):
+        # Returns the triplets that were new, in the order they were added
+        new_triplets = []
+        keys = self._load_keys()
+        with self.lock:
+            for triplet in triplets:
+                key = triplet_key(triplet)
+                if key not in keys:
+                    keys.add(key)
+                    new_triplets.append(triplet)
+            self.pending.extend(new_triplets)
+            full = len(self.pending) >= self.batch_size
+        if full:
+            # Outside the lock, the lock file is always taken first
+            self.commit()
+        return new_triplets
+
+    def commit(self):
+        # One append and one fsync for the whole batch, then the offsets of the batch, then the merges
+        with self.file_lock, self.lock:
+            self._commit_records()
+            if self.pending_merges:
+                data = "".join(json.dumps(merge) + "\n" for merge in self.pending_merges).encode("utf-8")
+                with open(self.merges_file, 'ab') as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                self.merges_size += len(data)
+                self.pending_merges = []
+
+    def _commit_records(self):
+        with self.lock:
+            if not self.pending:
+                return
+            os.makedirs(os.path.dirname(self.journal_file) or ".", exist_ok=True)
+            lines = [(json.dumps(triplet, ensure_ascii=False) + "\n").encode("utf-8") for triplet in self.pending]
+            with open(self.journal_file, 'ab') as f:
+                start = f.tell()
+                f.write(b"".join(lines))
+                f.flush()
+                os.fsync(f.fileno())
+
+            ends = start + np.cumsum([len(line) for line in lines], dtype=np.uint64)
+            with open(self.offsets_file, 'ab') as f:
+                f.write(ends.astype("<u8").tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            self.ends = np.concatenate([self.ends, ends.astype("<u8")])
+            self.journal_size = int(ends[-1])
+            self.pending = []
+
+    def export(self):
+        with self.file_lock, self.lock:
+            self._export_timer = None
+            # Another process may have written a newer snapshot, this one has to be at least as new
+            self.catch_up()
+            atomic_write_json(self.knowledge_file, list(self.records()), indent=4)
+
+    def export_later(self, delay=2.0):
+        # For a server, many small additions within delay seconds share one snapshot write
+        with self.lock:
+            if self._export_timer is None:
+                self._export_timer = threading.Timer(delay, self.export)
+                self._export_timer.daemon = True
+                self._export_timer.start()
+
+    def flush(self):
+        self.commit()
+        self.export()
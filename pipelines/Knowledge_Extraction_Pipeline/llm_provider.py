@@ -0,0 +1,134 @@
+"""
+Antonio van Dijck
+studentnumber: 12717673
+Email: antonio.van.dijck@student.uva.nl
+
+One lazily initialized provider for the models of the knowledge extraction, the chatbot and the evaluation. Nothing is
+loaded when the modules are imported, the LLM and the sentence encoder are loaded on first use and then shared by
+everyone in the process. Only one LLM is kept loaded at a time, asking for another model (the evaluation loops over
+all GGUF files) releases the previous one first.
+"""
+
+import os
+import sys
+import time
+import threading
+import subprocess
+from ..instrumentation import profiler
+
+MODELS_DIR = "pipelines/Knowledge_Extraction_Pipeline/data/models"
+LLM_REPO_ID = "bartowski/Qwen2.5-7B-Instruct-GGUF"
+LLM_FILENAME = "Qwen2.5-7B-Instruct-Q4_K_M.gguf"
+LLM_MODEL_PATH = os.path.join(MODELS_DIR, LLM_FILENAME)
+ENCODER_MODEL = "all-MiniLM-L6-v2"
+
+def ensure_model(model_path=LLM_MODEL_PATH):
+    # The default model is downloaded from huggingface into the models folder the first time it is needed
+    if not os.path.exists(model_path) and os.path.abspath(model_path) == os.path.abspath(LLM_MODEL_PATH):
+        from huggingface_hub import hf_hub_download
+        print(f"Downloading {LLM_FILENAME} to {MODELS_DIR}...")
+        hf_hub_download(repo_id=LLM_REPO_ID, filename=LLM_FILENAME, local_dir=MODELS_DIR)
+    return model_path
+
+class ModelProvider:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._llm = None
+        self._llm_key = None
+        self._encoders = {}
+        self._cached_encoders = {}
+        self._query_encoders = {}
+
+    def get_llm(self, model_path=LLM_MODEL_PATH, chat_format="chatml", n_ctx=2048, n_threads=None):
+        # n_threads=None leaves the number of threads to llama.cpp (half the cores)
+        key = (os.path.abspath(model_path), chat_format, n_ctx, n_threads)
+        with self._lock:
+            if self._llm_key != key:
+                # Drop the old model before loading the next one, two 7B models do not fit next to each other
+                self._llm = None
+                self._llm_key = None
+                from llama_cpp import Llama
+                with profiler.stage("model_load", model=model_path):
+                    print(f"Loading LLM {model_path}...")
+                    self._llm = Llama(model_path=ensure_model(model_path), chat_format=chat_format, n_ctx=n_ctx,
+                                      n_threads=n_threads, n_threads_batch=n_threads, verbose=False)
+                self._llm_key = key
+            return self._llm
+
+    def get_encoder(self, model_name=ENCODER_MODEL):
+        with self._lock:
+            if model_name not in self._encoders:
+                from sentence_transformers import SentenceTransformer
+                with profiler.stage("model_load", model=model_name):
+                    self._encoders[model_name] = SentenceTransformer(model_name)
+            return self._encoders[model_name]
+
+    def get_cached_encoder(self, model_name=ENCODER_MODEL):
+        # The encoder behind it is only loaded on the first cache miss
+        from .embedding_cache import CachedEncoder
+        with self._lock:
+            if model_name not in self._cached_encoders:
+                self._cached_encoders[model_name] = CachedEncoder(model_name)
+            return self._cached_encoders[model_name]
+
+    def get_query_encoder(self, model_name=ENCODER_MODEL):
+        # One LRU cache of question embeddings per model for the whole process
+        from .embedding_cache import QueryEncoder
+        with self._lock:
+            if model_name not in self._query_encoders:
+                self._query_encoders[model_name] = QueryEncoder(model_name)
+            return self._query_encoders[model_name]
+
+    def loaded(self):
+        return [key[0] for key in [self._llm_key] if key] + list(self._encoders)
+
+# One provider per process, shared by the extractor, the chatbot and the evaluation
+provider = ModelProvider()
+
+def get_llm(model_path=LLM_MODEL_PATH, n_threads=None):
+    return provider.get_llm(model_path, n_threads=n_threads)
+
+def get_encoder(model_name=ENCODER_MODEL):
+    return provider.get_encoder(model_name)
+
+def get_cached_encoder(model_name=ENCODER_MODEL):
+    return provider.get_cached_encoder(model_name)
+
+def get_query_encoder(model_name=ENCODER_MODEL):
+    return provider.get_query_encoder(model_name)
+
+# What every CLI mode of main.py has to do before it can start working
+STARTUP_MODES = {
+    "import": "import main",
+    "run": "import main\n"
+           "from pipelines.Semantic_Context_Transcription_Pipeline.SCT_pipeline import Semantic_Context_Transcription_Pipeline\n"
+           "from pipelines.Knowledge_Extraction_Pipeline.CAKE_pipeline import Knowledge_Extraction_Pipeline",
+    "chat": "import main\n"
+            "from pipelines.Knowledge_Extraction_Pipeline.chat import Chatbot\n"
+            "Chatbot().llm",
+    "eval": "import main\n"
+            "from pipelines.Knowledge_Extraction_Pipeline.evaluate import Evaluationes\n"
+            "Evaluationes().llm",
+}
+
+def benchmark_startup(modes=None, repeats=3):
+    # Every mode in a fresh interpreter, the time until it is ready for its first prompt or chunk
+    results = {}
+    for mode in modes or STARTUP_MODES:
+        code = STARTUP_MODES[mode] + "\nfrom pipelines.Knowledge_Extraction_Pipeline.llm_provider import provider\nprint('loaded:', provider.loaded())"
+        timings = []
+        for _ in range(repeats):
+            started = time.perf_counter()
+            process = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True)
+            timings.append(time.perf_counter() - started)
+            if process.returncode != 0:
+                print(f"{mode}: failed\n{process.stderr.strip().splitlines()[-1] if process.stderr.strip() else ''}")
+                break
+        else:
+            loaded = [line for line in process.stdout.splitlines() if line.startswith("loaded:")]
+            results[mode] = min(timings)
+            print(f"{mode:<8} {results[mode]:.2f}s  {loaded[-1] if loaded else ''}")
+    return results
+
+if __name__ == "__main__":
+    benchmark_startup()
@@ -0,0 +1,146 @@
+"""
+Antonio van Dijck
+studentnumber: 12717673
+Email: antonio.van.dijck@student.uva.nl
+
+The two LLM tasks of the knowledge extraction, extracting triplets from a chunk and creating exam questions from them.
+They only need a Llama instance, so the extractor and the extraction worker processes share the prompts and the parsing.
+"""
+
+import json
+from json import JSONDecodeError
+from ..manifest import text_hash
+from ..instrumentation import profiler
+from .prompt_cache import prefix_cache
+from .llm_provider import LLM_MODEL_PATH
+
+EXTRACTION_SYSTEM_PROMPT = (
+    "You are a knowledge extractor. Try to extract any knowledge.\n"
+    "Return ONLY JSON with the following schema:\n"
+    "{\n"
+    "  \"valuable_knowledge\": [\n"
+    "    {\n"
+    "      \"subject\": \"...\",\n"
+    "      \"predicate\": \"...\",\n"
+    "      \"object\": \"...\"\n"
+    "    }\n"
+    "  ]\n"
+    "}\n"
+    "If no knowledge can be extracted, return:\n"
+    "{\"valuable_knowledge\": []}"
+)
+
+EXTRACTION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "valuable_knowledge": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "subject": {"type": "string"},
+                    "predicate": {"type": "string"},
+                    "object": {"type": "string"}
+                },
+                "required": ["subject", "predicate", "object"]
+            }
+        }
+    },
+    "required": ["valuable_knowledge"],
+}
+
+QUESTIONS_SYSTEM_PROMPT = (
+    "You are a knowledge question creator. Given an input text, generate a list of two exam multiple-choice questions.\n"
+    "in the following JSON format:\n\n"
+    "[\n"
+    "    {\n"
+    "      \"question\": \"Question text\",\n"
+    "      \"options\": [\n"
+    "        \"Option 1\",\n"
+    "        \"Option 2\",\n"
+    "        \"Option 3\",\n"
+    "        \"Option 4\"\n"
+    "      ],\n"
+    "      \"correct_answer\": \"Correct answer\"\n"
+    "    }\n"
+    "    // ... more questions\n"
+    "]\n\n"
+    "Return ONLY valid JSON.\n"
+    "If no questions can be generated, return an empty list: []."
+)
+
+QUESTIONS_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "question": {"type": "string"},
+            "options": {
+                "type": "array",
+                "items": {"type": "string"},
+                "minItems": 4,
+                "maxItems": 4
+            },
+            "correct_answer": {"type": "string"}
+        },
+        "required": ["question", "options", "correct_answer"]
+    }
+}
+
+# Changes whenever one of the prompts or schemas changes, so the manifest knows old results are stale
+PROMPT_VERSION = text_hash(EXTRACTION_SYSTEM_PROMPT, json.dumps(EXTRACTION_SCHEMA, sort_keys=True),
+                           QUESTIONS_SYSTEM_PROMPT, json.dumps(QUESTIONS_SCHEMA, sort_keys=True))[:12]
+
+def extract_knowledge(llm, message, reuse_prefix=True, **kwargs):
+    if reuse_prefix:
+        # Only the chunk is evaluated, the system prompt comes from the saved llama state
+        prefix_cache(llm).restore(EXTRACTION_SYSTEM_PROMPT)
+    response = profiler.chat_completion(
+        "llm_extraction", llm,
+        messages=[
+            {"role": "system", "content": EXTRACTION_SYSTEM_PROMPT},
+            {"role": "user", "content": message},
+        ],
+        response_format={"type": "json", "schema": EXTRACTION_SCHEMA},
+        temperature=0.7,
+        **kwargs,
+    )
+    try:
+        knowledge_data = json.loads(response['choices'][0]['message']['content'])
+        print("Extracted knowledge from a chunk:", knowledge_data)
+        if "valuable_knowledge" not in knowledge_data:
+            knowledge_data["valuable_knowledge"] = []
+        return knowledge_data["valuable_knowledge"]
+    except (JSONDecodeError, KeyError):
+        return []
+
+#again response format is used to get the questions in the right format
+def create_questions(llm, chunk_text, reuse_prefix=True, **kwargs):
+    if reuse_prefix:
+        prefix_cache(llm).restore(QUESTIONS_SYSTEM_PROMPT)
+    response = profiler.chat_completion(
+        "question_generation", llm,
+        messages=[
+            {"role": "system", "content": QUESTIONS_SYSTEM_PROMPT},
+            {"role": "user", "content": chunk_text},
+        ],
+        response_format={"type": "json", "schema": QUESTIONS_SCHEMA},
+        temperature=0.7,
+        **kwargs,
+    )
+    try:
+        questions_data = json.loads(response['choices'][0]['message']['content'])
+        if isinstance(questions_data, list):
+
+            # Add the required eval fields manually after AI generation
+            for question in questions_data:
+                question["llm_answer_with_kb"] = ""
+                question["llm_answer_without_kb"] = ""
+            return questions_data
+        return []
+    except (JSONDecodeError, KeyError):
+        return []
+
+def triplet_text(triplets):
+    # The questions are created from the extracted triplets, not from the raw chunk
+    return str([f"{t['subject']} {t['predicate']} {t['object']}" for t in triplets])
@@ -0,0 +1,102 @@
+"""
+Antonio van Dijck
+studentnumber: 12717673
+Email: antonio.van.dijck@student.uva.nl
+
+Reuse of the llama.cpp KV cache for the fixed system prompts. The extraction and the question generation each start
+with the same long system prompt, but they alternate per chunk, so the prefix match of llama.cpp never gets to reuse
+more than a few tokens. The first time a system prompt is used its prefix (everything before the user text) is
+evaluated once and the llama state is saved, every later call restores that state and only evaluates the chunk.
+"""
+
+import os
+import json
+import time
+import weakref
+
+# Two different user texts, the common part of both renders is the fixed prefix of the prompt
+PROBE_TEXTS = ("a", "b")
+
+_caches = weakref.WeakKeyDictionary()
+
+def chatml_prefix(system_prompt):
+    from llama_cpp.llama_chat_format import format_chatml
+
+    renders = [format_chatml(messages=[{"role": "system", "content": system_prompt},
+                                       {"role": "user", "content": text}]).prompt for text in PROBE_TEXTS]
+    return os.path.commonprefix(renders)
+
+class PromptPrefixCache:
+    def __init__(self, llm):
+        # A weak reference, the cache is the value of its own model in _caches and must not keep it alive
+        self._llm = weakref.ref(llm)
+        self.tokens = {}
+        self.states = {}
+
+    @property
+    def llm(self):
+        return self._llm()
+
+    def prefix_tokens(self, system_prompt):
+        if system_prompt not in self.tokens:
+            # Tokenized like the chat handler does, the last token is left out because it can merge with the user text
+            tokens = self.llm.tokenize(chatml_prefix(system_prompt).encode("utf-8"), special=True)
+            self.tokens[system_prompt] = tokens[:-1]
+        return self.tokens[system_prompt]
+
+    def restore(self, system_prompt):
+        # Put the evaluated prefix of system_prompt in the context, returns the number of prefix tokens
+        tokens = self.prefix_tokens(system_prompt)
+        n = len(tokens)
+        if self.llm.n_tokens >= n and self.llm.input_ids[:n].tolist() == tokens:
+            # Still there from the previous call with this prompt
+            return n
+
+        state = self.states.get(system_prompt)
+        if state is None:
+            self.llm.reset()
+            self.llm.eval(tokens)
+            self.states[system_prompt] = self.llm.save_state()
+        else:
+            self.llm.load_state(state)
+        return n
+
+def prefix_cache(llm):
+    # One cache per model instance, dropped together with the model
+    if llm not in _caches:
+        _caches[llm] = PromptPrefixCache(llm)
+    return _caches[llm]
+
+def benchmark_prompt_cache(chunks_file="pipelines/Semantic_Context_Transcription_Pipeline/result/output_audio_1_chunks.json",
+                           n_chunks=8, model_path=None):
+    from llama_cpp import Llama
+    from .llm_tasks import LLM_MODEL_PATH, EXTRACTION_SYSTEM_PROMPT, QUESTIONS_SYSTEM_PROMPT, extract_knowledge, create_questions, triplet_text
+
+    with open(chunks_file, "r", encoding="utf-8") as f:
+        texts = [chunk["text"] for chunk in json.load(f)["chunks"][:n_chunks]]
+
+    llm = Llama(model_path=model_path or LLM_MODEL_PATH, chat_format="chatml", n_ctx=2048, verbose=False)
+    cache = prefix_cache(llm)
+    print(f"Fixed prefix: {len(cache.prefix_tokens(EXTRACTION_SYSTEM_PROMPT))} tokens (extraction), "
+          f"{len(cache.prefix_tokens(QUESTIONS_SYSTEM_PROMPT))} tokens (questions)")
+
+    timings = {}
+    for use_cache in (False, True):
+        llm.reset()
+        per_chunk = []
+        for text in texts:
+            started = time.perf_counter()
+            # Short answers, the benchmark is about the prompt evaluation and not about the generation
+            knowledge = extract_knowledge(llm, text, reuse_prefix=use_cache, max_tokens=32)
+            create_questions(llm, triplet_text(knowledge) if knowledge else text, reuse_prefix=use_cache, max_tokens=32)
+            per_chunk.append(time.perf_counter() - started)
+        # The first chunk also pays for evaluating and saving the prefixes
+        timings[use_cache] = sum(per_chunk[1:]) / max(1, len(per_chunk) - 1)
+        print(f"{'with' if use_cache else 'without'} prefix cache: {timings[use_cache]:.3f}s per chunk "
+              f"(first chunk {per_chunk[0]:.3f}s)")
+
+    print(f"Saved {timings[False] - timings[True]:.3f}s per chunk ({timings[False] / timings[True]:.2f}x)")
+    return timings
+
+if __name__ == "__main__":
+    benchmark_prompt_cache()
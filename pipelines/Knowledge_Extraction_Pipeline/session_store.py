@@ -0,0 +1,102 @@
+"""
+Antonio van Dijck
+studentnumber: 12717673
+Email: antonio.van.dijck@student.uva.nl
+
+The conversation log of the chatbot and the webapp. Every message is appended as one JSON line with its session id,
+so saving a turn does not read or rewrite the history. The recent messages of every session are kept in a bounded
+ring buffer in memory, which is what the chat prompt is built from. After a restart the buffers are filled once from
+the end of the log (at most RECENT_LOG_BYTES of it), however long the history is. Afterwards only what was appended
+to the log since is read, also by other processes, so every worker of a web server sees the whole conversation. An old
+messages.json is moved into the log under the default session the first time.
+"""
+
+import os
+import json
+import threading
+from collections import deque
+from datetime import datetime
+
+DEFAULT_SESSION = "default"
+HISTORY_SIZE = 20           # messages per session kept in memory
+RECENT_LOG_BYTES = 4 * 2**20    # the end of the log the buffers are filled from, older sessions start empty
+
+class SessionStore:
+    def __init__(self, log_file, legacy_file=None, history_size=HISTORY_SIZE):
+        self.log_file = log_file
+        self.history_size = history_size
+        self.sessions = None    # session id -> deque of the last history_size messages
+        self.offset = 0         # bytes of the log that are in the buffers
+        self.lock = threading.Lock()
+        if legacy_file and os.path.exists(legacy_file) and not os.path.exists(log_file):
+            self._migrate(legacy_file)
+
+    def _migrate(self, legacy_file):
+        try:
+            with open(legacy_file, 'r', encoding='utf-8') as f:
+                messages = json.load(f)
+        except json.JSONDecodeError:
+            messages = []
+        os.makedirs(os.path.dirname(self.log_file) or ".", exist_ok=True)
+        with open(self.log_file, 'a', encoding='utf-8') as f:
+            for message in messages:
+                f.write(json.dumps({"session": DEFAULT_SESSION, **message}, ensure_ascii=False) + "\n")
+
+    def _load(self):
+        self.sessions = {}
+        self.offset = 0
+        if os.path.exists(self.log_file):
+            self._read(max(0, os.path.getsize(self.log_file) - RECENT_LOG_BYTES))
+
+    def _read(self, start):
+        with open(self.log_file, 'rb') as f:
+            # One byte before start tells whether start is the beginning of a line
+            f.seek(max(0, start - 1))
+            previous = f.read(1) if start > 0 else b"\n"
+            data = f.read()
+        # A message that is still being written is read the next time
+        end = data.rfind(b"\n") + 1
+        lines = data[:end].split(b"\n")
+        if previous != b"\n":
+            lines = lines[1:]   # starts in the middle of a message
+        self.offset = start + end
+        for line in lines:
+            try:
+                message = json.loads(line)
+            except json.JSONDecodeError:
+                continue        # empty, or torn by a crash
+            self._history(message.pop("session", DEFAULT_SESSION)).append(message)
+
+    def _catch_up(self):
+        # The messages appended since the last read, by this process or another one
+        if self.sessions is None:
+            self._load()
+            return
+        size = os.path.getsize(self.log_file) if os.path.exists(self.log_file) else 0
+        if size < self.offset:
+            self._load()        # the log was replaced
+        elif size > self.offset:
+            self._read(self.offset)
+
+    def _history(self, session_id):
+        if self.sessions is None:
+            self._load()
+        if session_id not in self.sessions:
+            self.sessions[session_id] = deque(maxlen=self.history_size)
+        return self.sessions[session_id]
+
+    def append(self, session_id, role, content):
+        message = {"role": role, "content": content, "timestamp": datetime.utcnow().isoformat()}
+        line = (json.dumps({"session": session_id, **message}, ensure_ascii=False) + "\n").encode("utf-8")
+        with self.lock:
+            os.makedirs(os.path.dirname(self.log_file) or ".", exist_ok=True)
+            # One write in append mode, the lines of processes writing at the same time do not interleave
+            with open(self.log_file, 'ab') as f:
+                f.write(line)
+            self._catch_up()
+        return message
+
+    def recent(self, session_id=DEFAULT_SESSION, n=3):
+        with self.lock:
+            self._catch_up()
+            return list(self._history(session_id))[-n:] if n else []
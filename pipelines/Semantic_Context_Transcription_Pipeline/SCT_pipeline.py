@@ -10,41 +10,60 @@ from .helpers import *
 from .transcribe import *
 from .full_text import *
 from .chunker import *
+from ..manifest import Manifest, file_hash, text_hash
+from ..instrumentation import profiler
 
-def Semantic_Context_Transcription_Pipeline(input_link = "https://www.youtube.com/watch?v=g4lHxSAyf7M"):
+def transcribe_changed_audio(audio_dir, transcription_dir, shard_seconds, manifest):
+    # Only audio that changed since the last run (or has no transcript yet) is transcribed again
+    for filename in os.listdir(audio_dir):
+        if filename.endswith(AUDIO_EXTENSIONS):
+            audio_path = os.path.join(audio_dir, filename)
+            output_path = os.path.join(transcription_dir, f"{os.path.splitext(filename)[0]}.{TRANSCRIPT_FORMAT}")
+            input_hash = text_hash(file_hash(audio_path), ASR_MODEL)
+            if manifest.is_fresh(f"transcribe:{filename}", input_hash):
+                print(f"Skipping unchanged audio: {filename}")
+                continue
+            transcribe(audio_path, transcription_dir, shard_seconds)
+            manifest.record(f"transcribe:{filename}", input_hash, [output_path])
+
+def Semantic_Context_Transcription_Pipeline(input_link = "https://www.youtube.com/watch?v=g4lHxSAyf7M",
+                                            data_dir = "pipelines/Semantic_Context_Transcription_Pipeline/data",
+                                            output_folder = "pipelines/Semantic_Context_Transcription_Pipeline/result",
+                                            name = "1",
+                                            shard_seconds = None,
+                                            manifest_file = None):
+
+    audio_dir = os.path.join(data_dir, "audio_data")
+    video_dir = os.path.join(data_dir, "video_data")
+    transcription_dir = os.path.join(data_dir, "transcription_data")
+    os.makedirs(video_dir, exist_ok=True)
+    manifest = Manifest(manifest_file or os.path.join(data_dir, "manifest.json"))
 
     #check if video_data folder is empty
-    if not os.listdir("pipelines/Semantic_Context_Transcription_Pipeline/data/video_data"):
+    if not os.listdir(video_dir):
         print("No video data found. Downloading video data...")
 
-        # Download and convert to wav and download video
-        process_links_from_file(input_link)
+        # Download and decode the audio to PCM and download video
+        with profiler.stage("download", link=input_link):
+            process_links_from_file(input_link, audio_dir, video_dir, f"output_audio_{name}", f"input_video_{name}")
 
-        # Process all WAV files in the folder
-        for filename in os.listdir("pipelines/Semantic_Context_Transcription_Pipeline/data/audio_data"):
-            if filename.endswith(".wav"):
-                audio_path = os.path.join("pipelines/Semantic_Context_Transcription_Pipeline/data/audio_data", filename)
-                transcribe(audio_path)
+        # Process all audio files in the folder
+        transcribe_changed_audio(audio_dir, transcription_dir, shard_seconds, manifest)
         print("All audio and video files downloaded and converted!")
     else:
         #process_links_from_file(input_link)
 
         print("Video data found. Skipping download...")
 
-        # Process all WAV files in the folder
-        for filename in os.listdir("pipelines/Semantic_Context_Transcription_Pipeline/data/audio_data"):
-            if filename.endswith(".wav"):
-                audio_path = os.path.join("pipelines/Semantic_Context_Transcription_Pipeline/data/audio_data", filename)
-                transcribe(audio_path)
+        # Process all audio files in the folder
+        transcribe_changed_audio(audio_dir, transcription_dir, shard_seconds, manifest)
 
     print("All audio files transcribed!")
 
     # Convert transcriptions to full text
-    convert_to_full_text()
+    with profiler.stage("full_text"):
+        convert_to_full_text(transcription_dir, transcription_dir, manifest)
 
-    text_folder = 'pipelines/Semantic_Context_Transcription_Pipeline/data/transcription_data'
-    json_folder = 'pipelines/Semantic_Context_Transcription_Pipeline/data/transcription_data'
-    output_folder = 'pipelines/Semantic_Context_Transcription_Pipeline/result'
-    process_text_and_json(text_folder, json_folder, output_folder)
+    process_text_and_json(transcription_dir, transcription_dir, output_folder, manifest)
 
 # result op: pipelines/Semantic_Context_Transcription_Pipeline/data/transcription_data/output_audio_1_chunks.json
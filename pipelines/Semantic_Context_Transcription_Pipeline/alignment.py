@@ -0,0 +1,204 @@
+"""
+Antonio van Dijck
+studentnumber: 12717673
+Email: antonio.van.dijck@student.uva.nl
+
+Alignment of the semantic chunks to the WhisperX word timestamps. Every word is mapped to a character offset in the
+full text in one linear pass over the text tokens, so chunks (character spans) get their words and start/end times
+without matching token by token. When the text and the words drift apart (punctuation, numbers or tokens that
+WhisperX splits differently) a bounded lookahead finds the next point where they agree again instead of failing.
+"""
+
+import re
+import time
+import random
+
+TOKEN_PATTERN = re.compile(r"\S+")
+NON_WORD_PATTERN = re.compile(r"[\W_]+", re.UNICODE)
+LOOKAHEAD = 8
+
+def normalize_token(token):
+    # "Today," / "today" and "12mm" / "12 mm" should compare equal after normalization
+    return NON_WORD_PATTERN.sub("", token.lower())
+
+def tokenize_with_offsets(text):
+    offsets = []
+    norms = []
+    for match in TOKEN_PATTERN.finditer(text):
+        offsets.append(match.start())
+        norms.append(normalize_token(match.group()))
+    return offsets, norms
+
+def _resync(tokens, words, ti, wi, lookahead):
+    # Smallest total skip (dt + dw) after which a text token and a word agree again
+    for total in range(1, 2 * lookahead + 1):
+        for dt in range(max(0, total - lookahead), min(total, lookahead) + 1):
+            dw = total - dt
+            if ti + dt < len(tokens) and wi + dw < len(words) and tokens[ti + dt] and tokens[ti + dt] == words[wi + dw]:
+                return dt, dw
+    return None
+
+def word_char_offsets(text, words, lookahead=LOOKAHEAD):
+    # For every word the character offset in text of the token it belongs to
+    token_offsets, tokens = tokenize_with_offsets(text)
+    word_norms = [normalize_token(w) for w in words]
+    offsets = [0] * len(words)
+
+    ti = 0
+    wi = 0
+    while wi < len(words):
+        if ti >= len(tokens):
+            # Text ran out, the remaining words belong to the end of the text
+            offsets[wi] = token_offsets[-1] if token_offsets else 0
+            wi += 1
+            continue
+
+        token = tokens[ti]
+        word = word_norms[wi]
+
+        if not token:
+            # Punctuation only token in the text, no word for it
+            ti += 1
+            continue
+        if not word or word == token:
+            offsets[wi] = token_offsets[ti]
+            wi += 1
+            if word:
+                ti += 1
+            continue
+
+        # One text token spread over several words ("12mm" -> "12", "mm")
+        if token.startswith(word):
+            joined = word
+            end = wi + 1
+            while end < len(words) and len(joined) < len(token) and token.startswith(joined + word_norms[end]):
+                joined += word_norms[end]
+                end += 1
+            if joined == token:
+                for k in range(wi, end):
+                    offsets[k] = token_offsets[ti]
+                wi = end
+                ti += 1
+                continue
+
+        # One word spread over several text tokens ("12" "mm" -> "12mm")
+        if word.startswith(token):
+            joined = token
+            end = ti + 1
+            while end < len(tokens) and len(joined) < len(word) and word.startswith(joined + tokens[end]):
+                joined += tokens[end]
+                end += 1
+            if joined == word:
+                offsets[wi] = token_offsets[ti]
+                wi += 1
+                ti = end
+                continue
+
+        # Drift, look a few tokens ahead in both sequences for the point where they agree again
+        skip = _resync(tokens, word_norms, ti, wi, lookahead)
+        if skip is None:
+            # Nothing agrees within the window, treat it as a substitution and move on
+            offsets[wi] = token_offsets[ti]
+            wi += 1
+            ti += 1
+            continue
+
+        dt, dw = skip
+        # Skipped words have no text token of their own, they stay at the current position
+        for k in range(wi, wi + dw):
+            offsets[k] = token_offsets[ti]
+        wi += dw
+        ti += dt
+
+    return offsets
+
+def chunk_spans(text, chunks):
+    # (start, end) character span of every chunk, from the chunker when it gives them
+    spans = []
+    cursor = 0
+    for chunk in chunks:
+        start = getattr(chunk, "start_index", None)
+        end = getattr(chunk, "end_index", None)
+        chunk_text = getattr(chunk, "text", chunk)
+        if start is None or end is None:
+            found = text.find(chunk_text, cursor)
+            start = found if found != -1 else cursor
+            end = start + len(chunk_text)
+        spans.append((start, end))
+        cursor = end
+    return spans
+
+def _is_time(value):
+    return isinstance(value, (int, float))
+
+def align_chunks(text, chunks, word_list, lookahead=LOOKAHEAD):
+    # word_list holds [word, start, end] items, returns the chunks with their words and start/end times
+    offsets = word_char_offsets(text, [w[0] for w in word_list], lookahead)
+    spans = chunk_spans(text, chunks)
+
+    final_chunks = []
+    wi = 0
+    for index, (chunk, (start, end)) in enumerate(zip(chunks, spans)):
+        is_last = index == len(chunks) - 1
+        chunk_word_data = []
+        # Words before the first chunk go into the first, words after the last chunk into the last
+        while wi < len(word_list) and (offsets[wi] < end or is_last):
+            word, word_start, word_end = word_list[wi]
+            chunk_word_data.append({"word": word, "start": word_start, "end": word_end})
+            wi += 1
+
+        starts = [w["start"] for w in chunk_word_data if _is_time(w["start"])]
+        ends = [w["end"] for w in chunk_word_data if _is_time(w["end"])]
+        final_chunks.append({
+            "text": getattr(chunk, "text", chunk),
+            "start": starts[0] if starts else None,
+            "end": ends[-1] if ends else None,
+            "words": chunk_word_data
+        })
+
+    return final_chunks
+
+def _synthetic_transcript(n_words, drift_rate, seed=0):
+    rng = random.Random(seed)
+    vocabulary = ["the", "evap", "system", "canister", "fuel", "tank", "vapor", "12mm", "valve", "engine",
+                  "purge", "pressure", "sensor", "charcoal", "line", "vent", "is", "to", "and", "of"]
+
+    words = []
+    tokens = []
+    t = 0.0
+    for i in range(n_words):
+        word = rng.choice(vocabulary)
+        words.append([word, round(t, 3), round(t + 0.2, 3)])
+        t += 0.25
+        r = rng.random()
+        if r < drift_rate / 3:
+            tokens.append(word.upper() + ",")           # punctuation and case
+        elif r < 2 * drift_rate / 3:
+            tokens.append("twelve")                      # normalized differently
+        elif r < drift_rate:
+            continue                                     # missing from the text
+        else:
+            tokens.append(word)
+        if i % 17 == 16:
+            tokens[-1] = tokens[-1] + "."
+    return " ".join(tokens), words
+
+def benchmark_alignment(n_words=200_000, drift_rate=0.02, chunk_words=300):
+    text, words = _synthetic_transcript(n_words, drift_rate)
+
+    # Fixed size chunks as plain strings, the engine finds their spans itself
+    token_list = text.split(" ")
+    chunks = [" ".join(token_list[i:i + chunk_words]) for i in range(0, len(token_list), chunk_words)]
+
+    started = time.perf_counter()
+    aligned = align_chunks(text, chunks, words)
+    elapsed = time.perf_counter() - started
+
+    assigned = sum(len(c["words"]) for c in aligned)
+    print(f"Aligned {len(words)} words to {len(chunks)} chunks in {elapsed:.3f}s "
+          f"({len(words) / elapsed:,.0f} words/s, drift rate {drift_rate:.0%}, {assigned} words assigned)")
+    return elapsed
+
+if __name__ == "__main__":
+    for n in (10_000, 100_000, 500_000):
+        benchmark_alignment(n)
@@ -8,7 +8,13 @@ The file contains the semantic chunker, a component of the CAKE pipeline is used
 
 import os
 import json
+import numpy as np
 from chonkie import SDPMChunker
+from ..manifest import file_hash, text_hash
+from ..instrumentation import profiler
+from .alignment import align_chunks
+from .full_text import find_transcript
+from .transcript_format import load_transcript
 
 def load_document(file_path: str) -> str:
 
@@ -28,73 +34,144 @@ def load_json(file_path: str) -> dict:
         except json.JSONDecodeError as e:
             raise ValueError(f"Error: Failed to decode JSON file. Details: {e}")
 
-def create_chunker(embedding_model="minishlab/potion-base-8M", chunk_size=512, min_sentences=1):
+CHUNKER_CONFIG = {"embedding_model": "minishlab/potion-base-8M", "chunk_size": 512, "min_sentences": 1}
+
+def create_chunker(embedding_model=CHUNKER_CONFIG["embedding_model"], chunk_size=CHUNKER_CONFIG["chunk_size"], min_sentences=CHUNKER_CONFIG["min_sentences"]):
     return SDPMChunker(
         embedding_model=embedding_model,
         chunk_size=chunk_size,
         min_sentences=min_sentences
     )
 
-def process_text_and_json(text_folder: str, json_folder: str, output_folder: str):
+class BatchedEmbeddings:
+    # Wraps the chunker's embedding model: embeddings computed up front for many documents are served from memory
+    def __init__(self, embedding_model, batch_size=4096):
+        self.embedding_model = embedding_model
+        self.batch_size = batch_size
+        self.cache = {}
+        self.misses = 0     # texts the chunker asked for that were not prefetched
+
+    def __getattr__(self, name):
+        return getattr(self.embedding_model, name)
+
+    def prefetch(self, texts):
+        missing = list(dict.fromkeys(t for t in texts if t not in self.cache))
+        for i in range(0, len(missing), self.batch_size):
+            batch = missing[i:i + self.batch_size]
+            for text, embedding in zip(batch, self.embedding_model.embed_batch(batch)):
+                self.cache[text] = embedding
+
+    def embed(self, text):
+        return self.embed_batch([text])[0]
+
+    def embed_batch(self, texts):
+        self.misses += len(set(texts) - self.cache.keys())
+        self.prefetch(texts)
+        return np.stack([self.cache[t] for t in texts]) if texts else []
+
+    def clear(self):
+        self.cache.clear()
+
+class ChunkerService:
+    # One long-lived chunker: the embedding model is loaded once and sentences of many documents are embedded together
+    def __init__(self, embedding_model=CHUNKER_CONFIG["embedding_model"], chunk_size=CHUNKER_CONFIG["chunk_size"],
+                 min_sentences=CHUNKER_CONFIG["min_sentences"], embed_batch_size=4096):
+        self.chunker = create_chunker(embedding_model, chunk_size, min_sentences)
+        self.embeddings = BatchedEmbeddings(self.chunker.embedding_model, embed_batch_size)
+        self.chunker.embedding_model = self.embeddings
+        # chunk() stores the "auto" threshold it computes on the chunker, it has to be reset for every document
+        self.initial_threshold = getattr(self.chunker, "similarity_threshold", None)
+
+    def _chunk_one(self, text):
+        if hasattr(self.chunker, "similarity_threshold"):
+            self.chunker.similarity_threshold = self.initial_threshold
+        return self.chunker.chunk(text)
+
+    def _sentence_groups(self, text):
+        # The same sentence windows the semantic chunker embeds in _prepare_sentences (chonkie 0.4.1, pinned in
+        # requirements.txt, tests/test_chunker.py checks that they match)
+        split_sentences = getattr(self.chunker, "_split_sentences", None)
+        if split_sentences is None or not text.strip():
+            return []
+        sentences = split_sentences(text)
+        window = getattr(self.chunker, "similarity_window", 1)
+        return ["".join(sentences[max(0, i - window):i + window + 1]) for i in range(len(sentences))]
+
+    def chunk(self, text):
+        return self.chunk_documents([text])[0]
+
+    def chunk_documents(self, texts):
+        # Embed the sentences of all documents in large batches first, chunking then only reads from memory
+        groups = []
+        for text in texts:
+            groups.extend(self._sentence_groups(text))
+        self.embeddings.prefetch(groups)
+        misses = self.embeddings.misses
+        try:
+            return [self._chunk_one(text) for text in texts]
+        finally:
+            self.embeddings.clear()
+            if self.embeddings.misses > misses:
+                # Another chonkie version that embeds other sentence windows, the prefetch was extra work
+                print(f"Warning: the chunker embedded {self.embeddings.misses - misses} sentence groups that were not "
+                      f"prefetched, check _sentence_groups against the installed chonkie")
+
+_service = None
+
+def get_chunker_service():
+    global _service
+    if _service is None:
+        _service = ChunkerService()
+    return _service
+
+def chunk_documents(texts):
+    return get_chunker_service().chunk_documents(texts)
+
+def process_text_and_json(text_folder: str, json_folder: str, output_folder: str, manifest=None):
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
 
+    # First collect every document that needs chunking, then chunk them all in one go
+    documents = []
     for text_file in os.listdir(text_folder):
         if text_file.endswith(".txt"):
             base_name = os.path.splitext(text_file)[0]
             text_path = os.path.join(text_folder, text_file)
-            json_path = os.path.join(json_folder, base_name + ".json")
+            json_path = find_transcript(json_folder, base_name)
+
+            if json_path is None:
+                print(f"Warning: No matching transcript file for {text_file}")
+                continue
 
-            if not os.path.exists(json_path):
-                print(f"Warning: No matching JSON file for {text_file}")
+            # Skip documents whose transcript and chunker settings did not change since the last run
+            output_json_path = os.path.join(output_folder, base_name + "_chunks.json")
+            input_hash = text_hash(file_hash(text_path), file_hash(json_path), json.dumps(CHUNKER_CONFIG, sort_keys=True))
+            if manifest and manifest.is_fresh(f"chunks:{text_file}", input_hash):
+                print(f"Skipping unchanged file: {text_file}")
                 continue
 
             text_content = load_document(text_path)
-            json_data = load_json(json_path)
-            segments = json_data.get('word_segments', [])
-
-            if not segments:
-                raise ValueError(f"Error: No segments found in the JSON file {json_path}.")
-
-            word_list = [[seg.get('word', '').strip(), seg.get('start', ''), seg.get('end', '')] for seg in segments if seg.get('word', '').strip()]
-            chunker = create_chunker()
-            chunks = chunker.chunk(text_content)
-
-            final_chunks = []
-            current_word_index = 0
-            for chunk in chunks:
-                chunk_text = chunk.text
-                chunk_words = chunk_text.split()
-                chunk_word_data = []
-                chunk_start = None
-                chunk_end = None
-
-                for chunk_word in chunk_words:
-                    if current_word_index < len(word_list):
-                        word_info = word_list[current_word_index]
-                        if chunk_word == word_info[0]:
-                            chunk_word_data.append({
-                                "word": word_info[0],
-                                "start": word_info[1],
-                                "end": word_info[2]
-                            })
-                            if chunk_start is None:
-                                chunk_start = word_info[1]
-                            chunk_end = word_info[2]
-                            current_word_index += 1
-                        else:
-                            raise ValueError(f"Word mismatch at chunk '{chunk_text}': Expected '{word_info[0]}', found '{chunk_word}'.")
-                    else:
-                        raise IndexError("Ran out of words in word_data to match with chunks.")
-
-                final_chunks.append({
-                    "text": chunk_text,
-                    "start": chunk_start,
-                    "end": chunk_end,
-                    "words": chunk_word_data
-                })
+            transcript = load_transcript(json_path)
 
-            output_json_path = os.path.join(output_folder, base_name + "_chunks.json")
-            with open(output_json_path, 'w', encoding='utf-8') as f:
-                json.dump({"chunks": final_chunks}, f, ensure_ascii=False, indent=4)
-                print(f"Processed {text_file} and saved to {output_json_path}")
\ No newline at end of file
+            if not len(transcript):
+                raise ValueError(f"Error: No segments found in the transcript file {json_path}.")
+
+            word_list = transcript.word_list()
+            documents.append((text_file, text_content, word_list, output_json_path, input_hash))
+
+    if not documents:
+        return
+
+    with profiler.stage("chunking", documents=len(documents), characters=sum(len(document[1]) for document in documents)):
+        all_chunks = chunk_documents([document[1] for document in documents])
+
+    for (text_file, text_content, word_list, output_json_path, input_hash), chunks in zip(documents, all_chunks):
+        # Map the chunks to the word timestamps by character offset, tolerant to token drift
+        with profiler.stage("alignment", file=text_file, words=len(word_list), chunks=len(chunks)):
+            final_chunks = align_chunks(text_content, chunks, word_list)
+
+        with open(output_json_path, 'w', encoding='utf-8') as f:
+            json.dump({"chunks": final_chunks}, f, ensure_ascii=False, indent=4)
+            print(f"Processed {text_file} and saved to {output_json_path}")
+        if manifest:
+            manifest.record(f"chunks:{text_file}", input_hash, [output_json_path])
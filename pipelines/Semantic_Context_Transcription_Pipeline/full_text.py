@@ -7,45 +7,66 @@ A helper script to convert transcriptions to full text.
 """
 
 import os
-import json
+import zipfile
+from ..manifest import file_hash
+from .transcript_format import load_transcript
 
-def convert_to_full_text():
-    # Input directory containing JSON files
-    json_folder = 'pipelines/Semantic_Context_Transcription_Pipeline/data/transcription_data'
-    output_dir = 'pipelines/Semantic_Context_Transcription_Pipeline/data/transcription_data'
+TRANSCRIPT_EXTENSIONS = ('.npz', '.json')
+
+def find_transcript(folder, base_name):
+    # The columnar .npz transcript wins over the JSON of an older run
+    for extension in TRANSCRIPT_EXTENSIONS:
+        path = os.path.join(folder, base_name + extension)
+        if os.path.exists(path):
+            return path
+    return None
+
+def convert_to_full_text(json_folder='pipelines/Semantic_Context_Transcription_Pipeline/data/transcription_data',
+                         output_dir='pipelines/Semantic_Context_Transcription_Pipeline/data/transcription_data',
+                         manifest=None):
+    # json_folder: input directory containing the transcripts (.npz or JSON files)
 
     # Maak output directory aan als deze niet bestaat
     os.makedirs(output_dir, exist_ok=True)
     print(f"Output directory '{output_dir}' is ready.")
 
-    # Process each JSON file individually
+    # Process each transcript individually
     for json_file in os.listdir(json_folder):
-        if json_file.endswith('.json'):
+        base_name, extension = os.path.splitext(json_file)
+        if extension in TRANSCRIPT_EXTENSIONS:
             json_path = os.path.join(json_folder, json_file)
+            if find_transcript(json_folder, base_name) != json_path:
+                continue
+            individual_output_path = os.path.join(output_dir, base_name + '.txt')
+
+            # Skip transcripts that did not change since the last run
+            input_hash = file_hash(json_path)
+            if manifest and manifest.is_fresh(f"full_text:{json_file}", input_hash):
+                print(f"Skipping unchanged file: {json_file}")
+                continue
             print(f"Processing file: {json_file}")
 
-            # Controleer of het JSON-bestand geldig is
+            # Controleer of het bestand geldig is
             try:
-                with open(json_path, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-            except (json.JSONDecodeError, FileNotFoundError) as e:
+                transcript = load_transcript(json_path)
+            except (ValueError, OSError, zipfile.BadZipFile) as e:
                 print(f"Error: Failed to process '{json_file}'. Details: {e}")
                 continue
 
-            segments = data.get('segments', [])
+            segments = transcript.segment_texts()
             if not segments:
                 print(f"Warning: No segments found in '{json_file}'.")
                 continue
 
             # Create output text file for the individual transcript
-            individual_output_path = os.path.join(output_dir, json_file.replace('.json', '.txt'))
-
             with open(individual_output_path, 'w', encoding='utf-8') as individual_file:
                 for i, segment in enumerate(segments, start=1):
-                    text = segment.get('text', '').strip()
+                    text = segment.strip()
                     if not text:
                         print(f"Warning: Segment {i} in '{json_file}' is empty.")
                         continue
                     individual_file.write(f"{text} ")
 
             print(f"Transcript saved to '{individual_output_path}'.")
+            if manifest:
+                manifest.record(f"full_text:{json_file}", input_hash, [individual_output_path])
@@ -7,27 +7,49 @@ Helper functions to download audio and video data from YouTube links.
 """
 
 import os
-from pydub import AudioSegment
 import subprocess
 
-def download_and_convert_to_wav(youtube_url, output_wav_path):
+# Whisper works on 16 kHz mono float32 audio, the .pcm files hold exactly that as raw little-endian samples
+SAMPLE_RATE = 16000
 
-    print(f"Downloading audio from {youtube_url}...")
-    audio_file = "temp_audio.mp4"  # Temporary file
-    os.system(f'yt-dlp -f "worstaudio" -o "{audio_file}" "{youtube_url}"')
+def download_audio_to_pcm(youtube_url, output_pcm_path):
 
-    print("Converting to WAV format...")
-    audio = AudioSegment.from_file(audio_file)
-    audio.export(output_wav_path, format="wav")
+    print(f"Downloading and decoding audio from {youtube_url}...")
+    partial_path = output_pcm_path + ".part"
 
-    os.remove(audio_file)
-    print(f"Conversion complete! WAV file saved to: {output_wav_path}")
+    # yt-dlp streams the audio to stdout and a single ffmpeg pass decodes it straight to 16 kHz mono float32
+    download = subprocess.Popen(
+        ["yt-dlp", "-f", "worstaudio", "--quiet", "-o", "-", youtube_url],
+        stdout=subprocess.PIPE
+    )
+    try:
+        try:
+            subprocess.run(
+                ["ffmpeg", "-nostdin", "-loglevel", "error", "-y", "-i", "pipe:0",
+                 "-f", "f32le", "-acodec", "pcm_f32le", "-ac", "1", "-ar", str(SAMPLE_RATE), partial_path],
+                stdin=download.stdout, check=True
+            )
+        finally:
+            download.stdout.close()
+            download.wait()
+
+        if download.returncode != 0:
+            raise subprocess.CalledProcessError(download.returncode, "yt-dlp")
+    except BaseException:
+        # A failed download or decode leaves no partial file behind
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+
+    # Only a complete decode ends up under the final name
+    os.replace(partial_path, output_pcm_path)
+    print(f"Decoding complete! PCM file saved to: {output_pcm_path}")
 
 def download_video(youtube_url, output_video_path):
 
     try:
         print(f"Downloading video from {youtube_url} (high quality video only)...")
-        output_template = "temp_video.mp4"
+        output_template = os.path.splitext(output_video_path)[0] + "_temp_video.mp4"
 
         command = [
             "yt-dlp", "-f", "worstvideo[ext=mp4]", "-o", output_template, youtube_url
@@ -44,17 +66,21 @@ def download_video(youtube_url, output_video_path):
     except subprocess.CalledProcessError as e:
         print(f"Error downloading video: {e}")
 
-def process_links_from_file(input_link):
+def process_links_from_file(input_link,
+                            audio_dir="pipelines/Semantic_Context_Transcription_Pipeline/data/audio_data",
+                            video_dir="pipelines/Semantic_Context_Transcription_Pipeline/data/video_data",
+                            audio_name="output_audio_1",
+                            video_name="input_video_1"):
 
-    os.makedirs("pipelines/Semantic_Context_Transcription_Pipeline/data/audio_data", exist_ok=True)
-    os.makedirs("pipelines/Semantic_Context_Transcription_Pipeline/data/video_data", exist_ok=True)
+    os.makedirs(audio_dir, exist_ok=True)
+    os.makedirs(video_dir, exist_ok=True)
 
     
     link = input_link
     if link:
-        output_wav_path = os.path.join("pipelines/Semantic_Context_Transcription_Pipeline/data/audio_data", f"output_audio_1.wav")
-        output_video_path = os.path.join("pipelines/Semantic_Context_Transcription_Pipeline/data/video_data", f"input_video_1.mp4")
-        download_and_convert_to_wav(link, output_wav_path)
+        output_pcm_path = os.path.join(audio_dir, f"{audio_name}.pcm")
+        output_video_path = os.path.join(video_dir, f"{video_name}.mp4")
+        download_audio_to_pcm(link, output_pcm_path)
         download_video(link, output_video_path)
 
 # input_file = "pipelines/Semantic_Context_Transcription_Pipeline/data/youtube_links.txt"
@@ -0,0 +1,111 @@
+"""
+Antonio van Dijck
+studentnumber: 12717673
+Email: antonio.van.dijck@student.uva.nl
+
+A process-wide registry for the WhisperX models. Loading the ASR model and the alignment models takes
+most of the time per file on CPU, so the registry keeps them loaded between files, keyed by
+(model, device, compute_type, language), and evicts the least recently used model when the memory cap is reached.
+"""
+
+import gc
+import os
+import threading
+from collections import OrderedDict
+import torch
+import whisperx
+from ..instrumentation import profiler
+
+# Rough memory use in MB of the faster-whisper models in float16, int8 is about half of that
+ASR_MODEL_SIZES_MB = {
+    "tiny": 75,
+    "base": 145,
+    "small": 480,
+    "medium": 1500,
+    "large": 3000,
+    "large-v1": 3000,
+    "large-v2": 3000,
+    "large-v3": 3000,
+}
+
+def estimate_asr_size_mb(model_name, compute_type):
+    size = ASR_MODEL_SIZES_MB["medium"]
+    for name, mb in ASR_MODEL_SIZES_MB.items():
+        if model_name == name:
+            size = mb
+    if compute_type == "int8":
+        size = size // 2
+    return size
+
+def estimate_torch_size_mb(model):
+    try:
+        return sum(p.numel() * p.element_size() for p in model.parameters()) // (1024 * 1024)
+    except AttributeError:
+        return 0
+
+class ModelRegistry:
+    def __init__(self, max_models=4, max_memory_mb=None):
+        self.max_models = max_models
+        self.max_memory_mb = max_memory_mb or int(os.environ.get("CAKE_MODEL_MEMORY_MB", 6000))
+        self._models = OrderedDict()  # key -> (model, size_mb)
+        self._lock = threading.RLock()
+
+    def memory_mb(self):
+        return sum(size for _, size in self._models.values())
+
+    def get(self, key, loader, size_fn):
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                return self._models[key][0]
+
+            with profiler.stage("model_load", model=str(key)):
+                model = loader()
+            size = size_fn(model)
+            self._models[key] = (model, size)
+            self._evict(keep=key)
+            return model
+
+    def _evict(self, keep):
+        # Drop least recently used models until we are under both caps, but never the one just loaded
+        while len(self._models) > 1 and (len(self._models) > self.max_models or self.memory_mb() > self.max_memory_mb):
+            key = next(iter(self._models))
+            if key == keep:
+                break
+            print(f"Evicting model {key} from the registry")
+            del self._models[key]
+            self._free_memory(key[1])
+
+    def _free_memory(self, device):
+        gc.collect()
+        if device == "cuda":
+            torch.cuda.empty_cache()
+
+    def clear(self):
+        with self._lock:
+            devices = {key[1] for key in self._models}
+            self._models.clear()
+            for device in devices:
+                self._free_memory(device)
+
+    def get_asr_model(self, model_name, device, compute_type, language=None, model_path=None, download_root=None, threads=4):
+        # model_path points to a local snapshot of model_name, the key stays model_name either way
+        key = (model_name, device, compute_type, language)
+        return self.get(
+            key,
+            lambda: whisperx.load_model(model_path or model_name, device, compute_type=compute_type, language=language,
+                                        download_root=download_root, threads=threads),
+            lambda model: estimate_asr_size_mb(model_name, compute_type),
+        )
+
+    def get_align_model(self, language, device, model_name=None):
+        # Returns (model_a, metadata), load_align_model raises ValueError for unsupported languages
+        key = (model_name or "align", device, None, language)
+        return self.get(
+            key,
+            lambda: whisperx.load_align_model(language_code=language, device=device, model_name=model_name),
+            lambda loaded: estimate_torch_size_mb(loaded[0]),
+        )
+
+# Shared by every transcription in this process
+registry = ModelRegistry()
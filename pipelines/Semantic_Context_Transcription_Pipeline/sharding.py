@@ -0,0 +1,118 @@
+"""
+Antonio van Dijck
+studentnumber: 12717673
+Email: antonio.van.dijck@student.uva.nl
+
+Long-audio mode for the transcription. The recording is cut into shards at pauses in the speech (found with a
+simple energy based voice activity detector), the shards are transcribed and aligned in a process pool and the
+segments and word_segments are stitched back together with their global start/end times.
+"""
+
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from .helpers import SAMPLE_RATE
+
+FRAME_SECONDS = 0.03      # 30 ms frames for the voice activity detection
+PAUSE_SECONDS = 0.5       # cut in the middle of the quietest half second
+SEARCH_SECONDS = 30       # look for that pause within 30 s of the target shard length
+
+def frame_energies(audio, frame_len):
+    # RMS energy per frame, computed in blocks so a memory-mapped file is never copied as a whole
+    n_frames = len(audio) // frame_len
+    energies = np.empty(n_frames, dtype=np.float32)
+    block = 2000
+    for i in range(0, n_frames, block):
+        j = min(i + block, n_frames)
+        frames = np.asarray(audio[i * frame_len:j * frame_len], dtype=np.float32).reshape(j - i, frame_len)
+        energies[i:j] = np.sqrt(np.mean(frames ** 2, axis=1))
+    return energies
+
+def find_shard_boundaries(audio, shard_seconds, sample_rate=SAMPLE_RATE):
+    # Returns a list of (start_sample, end_sample) with every cut placed in a pause
+    frame_len = int(FRAME_SECONDS * sample_rate)
+    energies = frame_energies(audio, frame_len)
+
+    # Smooth over the pause length, so a cut lands in a pause and not between two syllables
+    pause_frames = max(1, int(PAUSE_SECONDS / FRAME_SECONDS))
+    smoothed = np.convolve(energies, np.ones(pause_frames, dtype=np.float32) / pause_frames, mode="same")
+
+    shard_frames = int(shard_seconds / FRAME_SECONDS)
+    search_frames = int(SEARCH_SECONDS / FRAME_SECONDS)
+
+    cuts = [0]
+    target = shard_frames
+    while target < len(smoothed) - shard_frames // 2:
+        lo = max(cuts[-1] + 1, target - search_frames)
+        hi = min(len(smoothed), target + search_frames)
+        cut = lo + int(np.argmin(smoothed[lo:hi]))
+        cuts.append(cut)
+        target = cut + shard_frames
+
+    boundaries = [cut * frame_len for cut in cuts] + [len(audio)]
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+def _transcribe_shard(source, start, end, threads):
+    # Runs in a worker process, every worker keeps its own models loaded in its registry
+    from .transcribe import load_audio, transcribe_audio
+
+    audio = load_audio(source) if isinstance(source, str) else source
+    shard = np.ascontiguousarray(audio[start:end], dtype=np.float32)
+    return transcribe_audio(shard, threads=threads)
+
+def _shift_word(word, offset):
+    # WhisperX leaves some words (numbers, symbols) without timestamps
+    word = dict(word)
+    for key in ("start", "end"):
+        if key in word:
+            word[key] = round(word[key] + offset, 3)
+    return word
+
+def stitch_results(results, offsets):
+    segments = []
+    word_segments = []
+    language = None
+
+    for result, offset in zip(results, offsets):
+        language = language or result.get("language")
+        for segment in result.get("segments", []):
+            segment = dict(segment)
+            segment["start"] = round(segment["start"] + offset, 3)
+            segment["end"] = round(segment["end"] + offset, 3)
+            if "words" in segment:
+                segment["words"] = [_shift_word(w, offset) for w in segment["words"]]
+            segments.append(segment)
+        # New dicts for the words, whisperx shares the word objects between segments and word_segments
+        word_segments.extend(_shift_word(w, offset) for w in result.get("word_segments", []))
+
+    stitched = {"segments": segments, "word_segments": word_segments}
+    if language:
+        stitched["language"] = language
+    return stitched
+
+def default_shard_workers():
+    return max(1, (os.cpu_count() or 1) // 4)
+
+def transcribe_sharded(audio_file, audio, shard_seconds=600, workers=None):
+    workers = workers or default_shard_workers()
+    shards = find_shard_boundaries(audio, shard_seconds)
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    print(f"Transcribing {len(shards)} shards of ~{shard_seconds}s with {workers} workers ({threads} threads each)...")
+
+    # Raw PCM is memory-mapped again in every worker, other audio is sent over as array slices
+    zero_copy = audio_file.endswith(".pcm")
+
+    # spawn instead of fork, CTranslate2 and torch thread pools do not survive a fork
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        futures = []
+        for start, end in shards:
+            if zero_copy:
+                futures.append(executor.submit(_transcribe_shard, audio_file, start, end, threads))
+            else:
+                futures.append(executor.submit(_transcribe_shard, np.asarray(audio[start:end]), 0, end - start, threads))
+        results = [future.result() for future in futures]
+
+    offsets = [start / SAMPLE_RATE for start, _ in shards]
+    return stitch_results(results, offsets)
@@ -7,23 +7,26 @@ The transcribe.py file is a component of the Semantic_Context_Transcription_Pipe
 """
 
 import whisperx
-import gc
 import torch
 import json
 import os
+import numpy as np
+from .model_registry import registry
+from .helpers import SAMPLE_RATE
+from .transcript_format import save_transcript
+from ..instrumentation import profiler
 
-def transcribe(audio_file):
-    
-    # Define paths
-    wav_folder = "pipelines/Semantic_Context_Transcription_Pipeline/data/audio_data"
-    output_folder = "pipelines/Semantic_Context_Transcription_Pipeline/data/transcription_data"
-    # unsupported_folder = "pipelines/Semantic_Context_Transcription_Pipeline/data/unsupported_language"
-    model_dir = "pipelines/Semantic_Context_Transcription_Pipeline/data/whisper-models"
+AUDIO_EXTENSIONS = (".pcm", ".wav")
+ASR_MODEL = "medium"
+TRANSCRIPT_FORMAT = "npz"  # columnar transcript, use "json" for the WhisperX JSON
 
-    # Ensure output folders exist
-    os.makedirs(output_folder, exist_ok=True)
-    # os.makedirs(unsupported_folder, exist_ok=True)
+def load_audio(audio_file):
+    # Raw 16 kHz float32 PCM is opened zero-copy, anything else goes through ffmpeg in whisperx
+    if audio_file.endswith(".pcm"):
+        return np.memmap(audio_file, dtype="<f4", mode="r")
+    return whisperx.load_audio(audio_file)
 
+def get_device_config():
     # Check system for compatibility
     if torch.cuda.is_available():
         device = "cuda"
@@ -40,13 +43,19 @@ def transcribe(audio_file):
         device = "cpu"
         compute_type = "int8"
         batch_size = 4
+    return device, compute_type, batch_size
 
+def load_asr_model(device, compute_type, threads=4):
+    model_dir = "pipelines/Semantic_Context_Transcription_Pipeline/data/whisper-models"
+
+    # The registry keeps the model loaded between files, so a batch pays the load cost once
     if not os.path.exists(model_dir):
-        model = whisperx.load_model("medium", device, compute_type=compute_type, download_root=model_dir)
-    else:
-        model = whisperx.load_model("pipelines/Semantic_Context_Transcription_Pipeline/data/whisper-models/models--Systran--faster-whisper-medium/snapshots/08e178d48790749d25932bbc082711ddcfdfbc4f", device, compute_type=compute_type)
+        return registry.get_asr_model(ASR_MODEL, device, compute_type, download_root=model_dir, threads=threads)
+    return registry.get_asr_model(ASR_MODEL, device, compute_type, model_path="pipelines/Semantic_Context_Transcription_Pipeline/data/whisper-models/models--Systran--faster-whisper-medium/snapshots/08e178d48790749d25932bbc082711ddcfdfbc4f", threads=threads)
 
-    audio = whisperx.load_audio(audio_file)
+def transcribe_audio(audio, threads=4):
+    device, compute_type, batch_size = get_device_config()
+    model = load_asr_model(device, compute_type, threads)
 
     # Perform transcription with automatic language detection
     result = model.transcribe(audio, batch_size=batch_size)
@@ -62,18 +71,45 @@ def transcribe(audio_file):
 
     # Try alignment, handle missing model error
     try:
-        model_a, metadata = whisperx.load_align_model(language_code=detected_language, device=device)
-        result = whisperx.align(result["segments"], model_a, metadata, audio, device, return_char_alignments=False)
-        gc.collect()
-        torch.cuda.empty_cache()
-        del model_a
+        with profiler.stage("forced_alignment", language=detected_language, segments=len(result["segments"])):
+            model_a, metadata = registry.get_align_model(detected_language, device)
+            result = whisperx.align(result["segments"], model_a, metadata, audio, device, return_char_alignments=False)
     except ValueError as e:
         print(f"Skipping alignment due to error: {e}")
 
-    # Save as JSON
+    return result
+
+def save_transcription(result, audio_file, output_folder, transcript_format=TRANSCRIPT_FORMAT):
     base_filename = os.path.splitext(os.path.basename(audio_file))[0]
-    output_json_path = os.path.join(output_folder, f"{base_filename}.json")
-    with open(output_json_path, 'w') as f:
-        json.dump(result, f, indent=2)
+    output_path = os.path.join(output_folder, f"{base_filename}.{transcript_format}")
+
+    if transcript_format == "npz":
+        save_transcript(result, output_path)
+    else:
+        # Save as JSON
+        with open(output_path, 'w') as f:
+            json.dump(result, f, indent=2)
+
+    print(f"Results saved to {output_path}")
+    return output_path
+
+def transcribe(audio_file, output_folder="pipelines/Semantic_Context_Transcription_Pipeline/data/transcription_data", shard_seconds=None, workers=None):
+
+    # unsupported_folder = "pipelines/Semantic_Context_Transcription_Pipeline/data/unsupported_language"
+
+    # Ensure output folders exist
+    os.makedirs(output_folder, exist_ok=True)
+    # os.makedirs(unsupported_folder, exist_ok=True)
+
+    audio = load_audio(audio_file)
+
+    with profiler.stage("transcribe", audio_file=audio_file, audio_seconds=round(len(audio) / SAMPLE_RATE, 2)) as info:
+        # Long recordings are cut into shards at pauses and transcribed in parallel
+        if shard_seconds and len(audio) > 1.5 * shard_seconds * SAMPLE_RATE:
+            from .sharding import transcribe_sharded
+            result = transcribe_sharded(audio_file, audio, shard_seconds, workers)
+            info["shards"] = True
+        else:
+            result = transcribe_audio(audio)
 
-    print(f"Results saved to {output_json_path}")
+    save_transcription(result, audio_file, output_folder)
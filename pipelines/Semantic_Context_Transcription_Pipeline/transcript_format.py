@@ -0,0 +1,136 @@
+"""
+Antonio van Dijck
+studentnumber: 12717673
+Email: antonio.van.dijck@student.uva.nl
+
+A compact columnar on-disk format for word level transcripts. Instead of an indented JSON file with a dict per word,
+the words, starts, ends and scores are stored as arrays in an uncompressed .npz file, with all strings in one UTF-8
+string table plus offsets. Missing timestamps and scores (WhisperX leaves them out for e.g. numbers) are NaN.
+The JSON exporter writes the WhisperX shape again for tools that need it.
+"""
+
+import json
+import numpy as np
+
+def _string_table(strings):
+    encoded = [s.encode("utf-8") for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(e) for e in encoded])
+    blob = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+    return blob, offsets
+
+def _strings(blob, offsets):
+    data = blob.tobytes()
+    bounds = offsets.tolist()
+    text = data.decode("utf-8")
+    if len(text) == len(data):
+        # Pure ASCII, byte offsets are character offsets, so slice the decoded string directly
+        return [text[bounds[i]:bounds[i + 1]] for i in range(len(bounds) - 1)]
+    return [data[bounds[i]:bounds[i + 1]].decode("utf-8") for i in range(len(bounds) - 1)]
+
+def _column(items, key, dtype):
+    return np.array([item.get(key, np.nan) for item in items], dtype=dtype)
+
+def _value(x):
+    # NaN marks a missing value, those keys are left out again like WhisperX does
+    x = float(x)
+    return x if x == x else None
+
+def transcript_arrays(result):
+    segments = result.get("segments", [])
+    words = result.get("word_segments", [])
+
+    # The words of segment i are words[segment_word_offsets[i]:segment_word_offsets[i + 1]]
+    counts = [len(segment.get("words", [])) for segment in segments]
+    segment_word_offsets = np.zeros(len(segments) + 1, dtype=np.int64)
+    if sum(counts) == len(words):
+        segment_word_offsets[1:] = np.cumsum(counts)
+
+    word_blob, word_offsets = _string_table([w.get("word", "") for w in words])
+    segment_blob, segment_offsets = _string_table([s.get("text", "") for s in segments])
+
+    return {
+        "word_text": word_blob,
+        "word_offsets": word_offsets,
+        "word_start": _column(words, "start", np.float64),
+        "word_end": _column(words, "end", np.float64),
+        "word_score": _column(words, "score", np.float32),
+        "segment_text": segment_blob,
+        "segment_offsets": segment_offsets,
+        "segment_start": _column(segments, "start", np.float64),
+        "segment_end": _column(segments, "end", np.float64),
+        "segment_word_offsets": segment_word_offsets,
+        "language": np.array(result.get("language") or ""),
+    }
+
+def save_transcript(result, path):
+    with open(path, "wb") as f:
+        np.savez(f, **transcript_arrays(result))
+
+class Transcript:
+    def __init__(self, arrays):
+        self.word_start = arrays["word_start"]
+        self.word_end = arrays["word_end"]
+        self.word_score = arrays["word_score"]
+        self.segment_start = arrays["segment_start"]
+        self.segment_end = arrays["segment_end"]
+        self.segment_word_offsets = arrays["segment_word_offsets"]
+        self.language = str(arrays["language"]) or None
+        self._word_text = (arrays["word_text"], arrays["word_offsets"])
+        self._segment_text = (arrays["segment_text"], arrays["segment_offsets"])
+
+    @classmethod
+    def from_whisperx(cls, result):
+        return cls(transcript_arrays(result))
+
+    def __len__(self):
+        return len(self.word_start)
+
+    def words(self):
+        return _strings(*self._word_text)
+
+    def segment_texts(self):
+        return _strings(*self._segment_text)
+
+    def word_list(self):
+        # [word, start, end] per non-empty word, the input the chunker aligns against
+        # NaN != NaN, missing times become '' like the JSON path of the chunker
+        starts = [x if x == x else '' for x in self.word_start.tolist()]
+        ends = [x if x == x else '' for x in self.word_end.tolist()]
+        return [[w.strip(), s, e] for w, s, e in zip(self.words(), starts, ends) if w.strip()]
+
+    def to_whisperx(self):
+        # Back to the JSON shape WhisperX writes
+        words = []
+        columns = zip(self.words(), self.word_start.tolist(), self.word_end.tolist(), self.word_score.tolist())
+        for word, start, end, score in columns:
+            item = {"word": word}
+            for key, value in (("start", start), ("end", end), ("score", score)):
+                if value == value:
+                    item[key] = round(value, 3)
+            words.append(item)
+
+        segments = []
+        for i, text in enumerate(self.segment_texts()):
+            segment = {"start": _value(self.segment_start[i]), "end": _value(self.segment_end[i]), "text": text}
+            lo, hi = self.segment_word_offsets[i], self.segment_word_offsets[i + 1]
+            if hi > lo:
+                segment["words"] = words[lo:hi]
+            segments.append(segment)
+
+        result = {"segments": segments, "word_segments": words}
+        if self.language:
+            result["language"] = self.language
+        return result
+
+def load_transcript(path):
+    # .npz written by save_transcript, or the WhisperX JSON of older runs
+    if path.endswith(".json"):
+        with open(path, "r", encoding="utf-8") as f:
+            return Transcript.from_whisperx(json.load(f))
+    with np.load(path, allow_pickle=False) as arrays:
+        return Transcript({key: arrays[key] for key in arrays.files})
+
+def export_json(npz_path, json_path):
+    with open(json_path, "w", encoding="utf-8") as f:
+        json.dump(load_transcript(npz_path).to_whisperx(), f, indent=2)
@@ -0,0 +1,122 @@
+"""
+Antonio van Dijck
+studentnumber: 12717673
+Email: antonio.van.dijck@student.uva.nl
+
+Batch ingestion for the CAKE pipeline. Every video gets its own job directory keyed by its
+video ID (or a hash of the link), so audio, transcripts, chunks and knowledge of different
+videos never overwrite each other, and a pool of worker processes drives the jobs.
+"""
+
+import os
+import re
+import hashlib
+import traceback
+from .instrumentation import profiler
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+JOBS_DIR = "pipelines/data/jobs"
+
+# YouTube video IDs are 11 characters of [A-Za-z0-9_-]
+YOUTUBE_ID_PATTERN = re.compile(r"(?:v=|youtu\.be/|shorts/|embed/|live/)([A-Za-z0-9_-]{11})")
+
+def job_id_for_link(link):
+    match = YOUTUBE_ID_PATTERN.search(link)
+    if match:
+        return match.group(1)
+    # No recognizable video ID, key the job by a hash of the link instead
+    return hashlib.sha256(link.strip().encode("utf-8")).hexdigest()[:16]
+
+def read_links(source):
+    # Accept a list of links or a path to a file with one link per line (# for comments)
+    if isinstance(source, (list, tuple)):
+        lines = source
+    else:
+        with open(source, "r", encoding="utf-8") as f:
+            lines = f.read().splitlines()
+
+    links = []
+    for line in lines:
+        line = line.strip()
+        if line and not line.startswith("#") and line not in links:
+            links.append(line)
+    return links
+
+class Job:
+    def __init__(self, link, jobs_dir=JOBS_DIR):
+        self.link = link
+        self.job_id = job_id_for_link(link)
+        self.dir = os.path.join(jobs_dir, self.job_id)
+
+        # Same layout as the single video pipeline, but scoped to this job
+        self.data_dir = os.path.join(self.dir, "data")
+        self.result_dir = os.path.join(self.dir, "result")
+        self.knowledge_dir = os.path.join(self.dir, "knowledge")
+
+        self.chunks_file = os.path.join(self.result_dir, f"output_audio_{self.job_id}_chunks.json")
+        self.knowledge_file = os.path.join(self.knowledge_dir, "knowledge.json")
+        self.faiss_index_file = os.path.join(self.knowledge_dir, "faiss_index.pkl")
+        self.questions_file = os.path.join(self.knowledge_dir, "questions.json")
+        self.manifest_file = os.path.join(self.dir, "manifest.json")
+
+    def make_dirs(self):
+        for folder in [self.data_dir, self.result_dir, self.knowledge_dir]:
+            os.makedirs(folder, exist_ok=True)
+
+def run_job(link, jobs_dir=JOBS_DIR, shard_seconds=None, llm_workers=None, budget=(None, None)):
+    # Imported here so the worker processes load the heavy pipeline modules themselves
+    from .Semantic_Context_Transcription_Pipeline.SCT_pipeline import Semantic_Context_Transcription_Pipeline
+    from .Knowledge_Extraction_Pipeline.CAKE_pipeline import Knowledge_Extraction_Pipeline
+
+    job = Job(link, jobs_dir)
+    job.make_dirs()
+    print(f"[{job.job_id}] Starting job for {link}")
+
+    try:
+        with profiler.stage("job", job_id=job.job_id, link=link):
+            Semantic_Context_Transcription_Pipeline(link, job.data_dir, job.result_dir, job.job_id, shard_seconds, job.manifest_file)
+            Knowledge_Extraction_Pipeline(job.chunks_file, job.knowledge_file, job.faiss_index_file, job.questions_file, job.manifest_file,
+                                          workers=llm_workers, cores=budget[0], memory_mb=budget[1])
+    except Exception as e:
+        # One broken video should not take down the rest of the batch
+        print(f"[{job.job_id}] Job failed: {e}")
+        return {"job_id": job.job_id, "link": link, "status": "failed", "error": traceback.format_exc()}
+
+    print(f"[{job.job_id}] Job complete, results in {job.dir}")
+    return {"job_id": job.job_id, "link": link, "status": "done", "dir": job.dir}
+
+def default_workers():
+    # Whisper and llama.cpp are multi-threaded themselves, so give every job a few cores
+    return max(1, (os.cpu_count() or 1) // 4)
+
+def run_batch(source, workers=None, jobs_dir=JOBS_DIR, shard_seconds=None, llm_workers=None):
+    links = read_links(source)
+    workers = workers or default_workers()
+    print(f"Processing {len(links)} videos with {workers} workers...")
+
+    # Every job plans its llama.cpp pool within its share of the cores and the memory, not the whole machine
+    from .Knowledge_Extraction_Pipeline.extraction_pool import job_budget, plan_workers
+    budget = job_budget(max(1, min(workers, len(links))))
+    if llm_workers:
+        planned, threads = plan_workers(llm_workers, cores=budget[0], memory_mb=budget[1])
+        if planned < llm_workers:
+            memory = f"{budget[1]:.0f} MB" if budget[1] is not None else "unknown memory"
+            print(f"{workers} jobs x {llm_workers} llama.cpp workers do not fit in the cores and memory "
+                  f"({budget[0]} cores and {memory} per job), every job runs {planned} llama.cpp workers "
+                  f"with {threads} threads")
+
+    results = []
+    if workers == 1:
+        for link in links:
+            results.append(run_job(link, jobs_dir, shard_seconds, llm_workers))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(run_job, link, jobs_dir, shard_seconds, llm_workers, budget) for link in links]
+            for future in as_completed(futures):
+                results.append(future.result())
+
+    failed = [r for r in results if r["status"] != "done"]
+    print(f"Batch complete: {len(results) - len(failed)} done, {len(failed)} failed.")
+    for r in failed:
+        print(f"  {r['job_id']} ({r['link']}) failed")
+    return results
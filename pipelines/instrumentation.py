@@ -0,0 +1,225 @@
+"""
+Antonio van Dijck
+studentnumber: 12717673
+Email: antonio.van.dijck@student.uva.nl
+
+Per-stage instrumentation for the CAKE pipeline. Every stage (download, transcription, chunking, alignment, LLM
+extraction, question generation, embedding, FAISS persistence) records its wall and CPU time and the peak RSS, the
+transcription its real-time factor and every LLM call its prompt and completion tokens per second. Streamed chat
+responses record their time to first token and the latency between tokens. The records are appended as JSON lines to a run report. Profiling is off unless it is enabled (main.py --profile); worker processes
+pick it up from the CAKE_PROFILE environment variable.
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+PROFILE_ENV = "CAKE_PROFILE"
+RUN_ID_ENV = "CAKE_PROFILE_RUN_ID"
+PROFILE_FILE = "pipelines/data/profile_report.jsonl"
+
+def _usage(children=False):
+    # (cpu seconds, peak rss in bytes) of this process or of its finished children
+    if resource is None:
+        return 0.0, 0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    rss = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+    return usage.ru_utime + usage.ru_stime, rss
+
+def peak_rss_mb():
+    # Peak resident memory of this process and of its finished children (ffmpeg, shard workers)
+    _, own = _usage()
+    _, children = _usage(children=True)
+    return round(own / 2**20, 1), round(children / 2**20, 1)
+
+def _llama_timings(llm):
+    # Prompt and generation time as measured by llama.cpp itself and the number of prompt tokens it evaluated, None
+    # when this llama_cpp version has no perf API
+    try:
+        import llama_cpp
+        data = llama_cpp.llama_perf_context(llm._ctx.ctx)
+        return data.t_p_eval_ms / 1000, data.t_eval_ms / 1000, data.n_p_eval
+    except Exception:
+        return None
+
+def _reset_llama_timings(llm):
+    try:
+        import llama_cpp
+        llama_cpp.llama_perf_context_reset(llm._ctx.ctx)
+    except Exception:
+        pass
+
+def _rate(count, seconds):
+    return round(count / seconds, 2) if count and seconds else None
+
+def _ms(seconds):
+    return round(seconds * 1000, 2) if seconds is not None else None
+
+def _percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+class Profiler:
+    def __init__(self, report_file=None, run_id=None):
+        self.report_file = report_file or os.environ.get(PROFILE_ENV)
+        self.run_id = run_id or os.environ.get(RUN_ID_ENV) or uuid.uuid4().hex[:12]
+        self.totals = {}
+
+    @property
+    def enabled(self):
+        return bool(self.report_file)
+
+    def enable(self, report_file=PROFILE_FILE):
+        self.report_file = report_file
+        # Inherited by the batch and shard worker processes, they all append to the same report
+        os.environ[PROFILE_ENV] = report_file
+        os.environ[RUN_ID_ENV] = self.run_id
+        os.makedirs(os.path.dirname(report_file) or ".", exist_ok=True)
+        print(f"Profiling enabled, writing the run report to {report_file} (run {self.run_id})")
+
+    def write(self, event, **fields):
+        if not self.enabled:
+            return
+        record = {"run_id": self.run_id, "pid": os.getpid(), "time": datetime.utcnow().isoformat(), "event": event}
+        record.update(fields)
+        # One write per line in append mode, so lines from several processes do not interleave
+        with open(self.report_file, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    @contextmanager
+    def stage(self, name, **fields):
+        # The body can add fields (audio_seconds, items, ...) to the yielded dict
+        info = dict(fields)
+        if not self.enabled:
+            yield info
+            return
+
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        children_start, _ = _usage(children=True)
+        status = "ok"
+        try:
+            yield info
+        except BaseException:
+            status = "failed"
+            raise
+        finally:
+            wall = time.perf_counter() - wall_start
+            cpu = time.process_time() - cpu_start
+            children_cpu = _usage(children=True)[0] - children_start
+            rss, children_rss = peak_rss_mb()
+
+            info.update({
+                "stage": name,
+                "status": status,
+                "wall_seconds": round(wall, 4),
+                "cpu_seconds": round(cpu, 4),
+                "children_cpu_seconds": round(children_cpu, 4),
+                "peak_rss_mb": rss,
+                "children_peak_rss_mb": children_rss,
+            })
+            if info.get("audio_seconds"):
+                # Real-time factor, below 1 means faster than the audio plays
+                info["rtf"] = round(wall / info["audio_seconds"], 4)
+
+            total = self.totals.setdefault(name, {"calls": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0})
+            total["calls"] += 1
+            total["wall_seconds"] += wall
+            total["cpu_seconds"] += cpu
+            self.write("stage", **info)
+
+    def chat_completion(self, name, llm, **kwargs):
+        # llm.create_chat_completion with the token counts and rates of the call recorded under stage name
+        if not self.enabled:
+            return llm.create_chat_completion(**kwargs)
+
+        _reset_llama_timings(llm)
+        with self.stage(name) as info:
+            started = time.perf_counter()
+            response = llm.create_chat_completion(**kwargs)
+            elapsed = time.perf_counter() - started
+
+            usage = response.get("usage") or {}
+            prompt_tokens = usage.get("prompt_tokens", 0)
+            completion_tokens = usage.get("completion_tokens", 0)
+            timings = _llama_timings(llm)
+            if timings:
+                # The prompt tokens that were already in the context (the prefix restored by the prompt cache, the
+                # prefix llama.cpp matched itself) are counted in prompt_tokens but not evaluated and not timed
+                prompt_seconds, completion_seconds, evaluated_tokens = timings
+            else:
+                # Without the llama.cpp timings only the total is known, rate both over the whole call
+                prompt_seconds = completion_seconds = elapsed
+                evaluated_tokens = None
+
+            info.update({
+                "prompt_tokens": prompt_tokens,
+                "prompt_tokens_evaluated": evaluated_tokens,
+                "completion_tokens": completion_tokens,
+                "prompt_tokens_per_second": _rate(prompt_tokens if evaluated_tokens is None else evaluated_tokens,
+                                                  prompt_seconds),
+                "completion_tokens_per_second": _rate(completion_tokens, completion_seconds),
+            })
+        return response
+
+    def token_stream(self, name, tokens, stats=None, **fields):
+        # Passes the text pieces of a streamed completion through and measures them, the time to the first piece and
+        # the gaps between the pieces end up in stats (also when profiling is off) and in the report
+        stats = {} if stats is None else stats
+        started = time.perf_counter()
+        last = None
+        gaps = []
+        status = "ok"
+        try:
+            for token in tokens:
+                now = time.perf_counter()
+                if last is None:
+                    stats["ttft_seconds"] = round(now - started, 4)
+                else:
+                    gaps.append(now - last)
+                last = now
+                yield token
+        except BaseException:
+            status = "failed"
+            raise
+        finally:
+            stats.update({
+                "status": status,
+                "tokens": len(gaps) + (last is not None),
+                "total_seconds": round(time.perf_counter() - started, 4),
+                "inter_token_ms_mean": _ms(sum(gaps) / len(gaps)) if gaps else None,
+                "inter_token_ms_p50": _ms(_percentile(gaps, 0.5)),
+                "inter_token_ms_p99": _ms(_percentile(gaps, 0.99)),
+            })
+            stats.setdefault("ttft_seconds", None)
+            self.write("stream", stream=name, **fields, **stats)
+
+    def summary(self):
+        # Totals per stage for this process, also written to the report
+        if not self.enabled or not self.totals:
+            return {}
+        totals = {name: {"calls": t["calls"], "wall_seconds": round(t["wall_seconds"], 3), "cpu_seconds": round(t["cpu_seconds"], 3)}
+                  for name, t in self.totals.items()}
+        rss, children_rss = peak_rss_mb()
+        self.write("summary", stages=totals, peak_rss_mb=rss, children_peak_rss_mb=children_rss)
+
+        print("\nStage timings:")
+        for name, t in sorted(totals.items(), key=lambda item: -item[1]["wall_seconds"]):
+            print(f"  {name:<24} {t['calls']:>5} calls  {t['wall_seconds']:>10.2f}s wall  {t['cpu_seconds']:>10.2f}s cpu")
+        print(f"  peak RSS {rss} MB (children {children_rss} MB)")
+        return totals
+
+# One profiler per process, shared by all pipeline modules
+profiler = Profiler()
@@ -0,0 +1,86 @@
+"""
+Antonio van Dijck
+studentnumber: 12717673
+Email: antonio.van.dijck@student.uva.nl
+
+The manifest records per job which stages (and which chunks) are done, together with a content hash of their inputs.
+A re-run skips every stage whose inputs did not change, and an interrupted knowledge extraction resumes at the first
+chunk that was not processed yet.
+"""
+
+import os
+import json
+import hashlib
+import threading
+from datetime import datetime
+
+def file_hash(path, block_size=1 << 20):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+def text_hash(*parts):
+    sha = hashlib.sha256()
+    for part in parts:
+        sha.update(str(part).encode("utf-8"))
+        sha.update(b"\0")
+    return sha.hexdigest()
+
+def _tmp_path(path):
+    # One temp file per process and thread, two writers of the same file do not write into each other's temp file
+    return f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+def atomic_write_json(path, data, indent=None):
+    # Write to a temp file and rename, so a crash never leaves a half written file behind
+    tmp_path = _tmp_path(path)
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=indent)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def atomic_write_bytes(path, data):
+    tmp_path = _tmp_path(path)
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+class Manifest:
+    def __init__(self, path):
+        self.path = path
+        self.data = {"stages": {}, "chunks": {}}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.data.update(json.load(f))
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        atomic_write_json(self.path, self.data, indent=2)
+
+    def is_fresh(self, stage, input_hash):
+        # A stage is only skipped when its inputs are unchanged and its outputs are still there
+        entry = self.data["stages"].get(stage)
+        if not entry or entry["input_hash"] != input_hash:
+            return False
+        return all(os.path.exists(output) for output in entry["outputs"])
+
+    def record(self, stage, input_hash, outputs):
+        self.data["stages"][stage] = {
+            "input_hash": input_hash,
+            "outputs": list(outputs),
+            "completed_at": datetime.utcnow().isoformat(),
+        }
+        self.save()
+
+    def chunk_result(self, chunk_key):
+        return self.data["chunks"].get(chunk_key)
+
+    def record_chunk(self, chunk_key, result, save=True):
+        # save=False lets the caller save once per batch of chunks, after their knowledge is committed
+        self.data["chunks"][chunk_key] = result
+        if save:
+            self.save()
@@ -0,0 +1,69 @@
+"""
+Antonio van Dijck
+studentnumber: 12717673
+Email: antonio.van.dijck@student.uva.nl
+
+The ChunkerService embeds the sentence windows of all documents up front, by rebuilding the windows the semantic
+chunker of chonkie embeds. This checks that the chunker does not ask for a single window that was not prefetched, and
+that the chunks are the same as without the prefetch. Run it from the root of the repository: python -m pytest tests
+"""
+
+import hashlib
+import numpy as np
+import pytest
+
+pytest.importorskip("chonkie")
+from chonkie.embeddings import BaseEmbeddings
+from pipelines.Semantic_Context_Transcription_Pipeline.chunker import ChunkerService, create_chunker
+
+class HashEmbeddings(BaseEmbeddings):
+    # A deterministic vector per text, no model download
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+
+    @property
+    def dimension(self):
+        return 32
+
+    def embed(self, text):
+        self.calls += 1
+        seed = int(hashlib.sha256(text.encode("utf-8")).hexdigest()[:8], 16)
+        return np.random.default_rng(seed).standard_normal(32).astype(np.float32)
+
+    def embed_batch(self, texts):
+        return np.stack([self.embed(text) for text in texts]) if texts else []
+
+    def count_tokens(self, text):
+        return len(text.split())
+
+    def count_tokens_batch(self, texts):
+        return [self.count_tokens(text) for text in texts]
+
+    def get_tokenizer_or_token_counter(self):
+        return self.count_tokens
+
+    def similarity(self, u, v):
+        return float(np.dot(u, v) / (np.linalg.norm(u) * np.linalg.norm(v)))
+
+    @classmethod
+    def is_available(cls):
+        return True
+
+DOCUMENTS = [
+    " ".join(f"Sentence {i} is about topic {i % 7} of the engine." for i in range(200)),
+    " ".join(f"Step {i}: loosen bolt {i % 5} and check the brakes!" for i in range(120)),
+    "",
+]
+
+def test_prefetch_matches_the_chunker():
+    service = ChunkerService(embedding_model=HashEmbeddings())
+    service.chunk_documents(DOCUMENTS)
+    assert service.embeddings.misses == 0
+
+def test_prefetch_does_not_change_the_chunks():
+    service = ChunkerService(embedding_model=HashEmbeddings())
+    chunks = service.chunk_documents(DOCUMENTS)
+    for text, batched in zip(DOCUMENTS, chunks):
+        plain = create_chunker(embedding_model=HashEmbeddings()).chunk(text)
+        assert [chunk.text for chunk in batched] == [chunk.text for chunk in plain]